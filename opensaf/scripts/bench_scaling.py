@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+""" Benchmark scale-out-opensaf.py and scale-in-opensaf.py on synthetic AMF
+    models of growing size, against the in-memory IMM of imm_offline
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from queue import Empty
+
+TO_ADD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'to-add')
+sys.path.insert(0, TO_ADD)
+
+from imm_offline import ImmModel, eSaAmfRedundancyModelT  # noqa: E402
+from imm_snapshot import rdn_value  # noqa: E402
+from scale_metrics import ScaleMetrics  # noqa: E402
+
+DEFAULT_NODES = [10, 50, 100]
+# Seconds between two checks that the child running a size is still alive
+CHILD_POLL_INTERVAL = 1
+DEFAULT_MIX = '2n=1,nway-active=1,nored=2'
+REDUNDANCY = {'2n': eSaAmfRedundancyModelT.SA_AMF_2N_REDUNDANCY_MODEL,
+              'nway-active': eSaAmfRedundancyModelT.SA_AMF_N_WAY_ACTIVE_REDUNDANCY_MODEL,
+              'nored': eSaAmfRedundancyModelT.SA_AMF_NO_REDUNDANCY_MODEL}
+AMF_CLUSTER = 'safAmfCluster=myAmfCluster'
+CLM_CLUSTER = 'safCluster=myClmCluster'
+CONFIG = 'SA_CONFIG'
+RUNTIME = 'SA_RUNTIME'
+# The classes and attributes the scaling scripts read, rdn and attributes
+CLASSES = {
+    'SaAmfCluster': ('safAmfCluster', {}),
+    'SaClmCluster': ('safCluster', {}),
+    'SaClmNode': ('safNode', {}),
+    'SaAmfNode': ('safAmfNode', {'saAmfNodeClmNode': ('SA_NAME_T', CONFIG),
+                                 'saAmfNodeAdminState': ('SA_UINT32_T', CONFIG)}),
+    'SaAmfNodeSwBundle': ('safInstalledSwBundle',
+                          {'saAmfNodeSwBundlePathPrefix': ('SA_STRING_T', CONFIG)}),
+    'SaAmfNodeGroup': ('safAmfNodeGroup', {'saAmfNGNodeList': ('SA_NAME_T', CONFIG)}),
+    'SaAmfApplication': ('safApp', {'saAmfAppType': ('SA_NAME_T', CONFIG)}),
+    'SaAmfSGBaseType': ('safSgType', {}),
+    'SaAmfSGType': ('safVersion', {'saAmfSgtRedundancyModel': ('SA_UINT32_T', CONFIG)}),
+    'SaAmfSUBaseType': ('safSuType', {}),
+    'SaAmfSUType': ('safVersion', {'saAmfSutProvidesSvcTypes': ('SA_NAME_T', CONFIG)}),
+    'SaAmfSvcBaseType': ('safSvcType', {}),
+    'SaAmfSvcType': ('safVersion', {}),
+    'SaAmfSG': ('safSg', {'saAmfSGType': ('SA_NAME_T', CONFIG)}),
+    'SaAmfSU': ('safSu', {'saAmfSUType': ('SA_NAME_T', CONFIG),
+                          'saAmfSUHostNodeOrNodeGroup': ('SA_NAME_T', CONFIG),
+                          'saAmfSUAdminState': ('SA_UINT32_T', CONFIG),
+                          'saAmfSUHostedByNode': ('SA_NAME_T', RUNTIME)}),
+    'SaAmfComp': ('safComp', {'saAmfCompType': ('SA_NAME_T', CONFIG)}),
+    'SaAmfCompCsType': ('safSupportedCsType', {}),
+    'SaAmfHealthcheck': ('safHealthcheckKey', {'saAmfHealthcheckPeriod': ('SA_TIME_T', CONFIG)}),
+    'SaAmfSI': ('safSi', {'saAmfSvcType': ('SA_NAME_T', CONFIG),
+                          'saAmfSIProtectedbySG': ('SA_NAME_T', CONFIG)}),
+    'SaAmfCSI': ('safCsi', {'saAmfCSType': ('SA_NAME_T', CONFIG)}),
+    'SaAmfCSIAttribute': ('safCsiAttr', {'saAmfCSIAttriValue': ('SA_STRING_T', CONFIG)}),
+    'SaAmfSIAssignment': ('safSISU', {'safSISU': ('SA_NAME_T', RUNTIME)}),
+}
+
+
+def parse_mix(text):
+    """ Redundancy models weighted as in 2n=1,nored=2
+        returns: list of redundancy model values, one per weight
+    """
+    models = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in REDUNDANCY:
+            raise ValueError('Unknown redundancy model %s, one of %s' % (name, ', '.join(REDUNDANCY)))
+        models.extend([REDUNDANCY[name]] * int(weight or 1))
+    return models
+
+
+def hostname_of(index):
+    return 'PL-%d' % (index + 3)
+
+
+def generate_model(nodes, apps, sgs, comps, sis, csis, mix):
+    """ An AMF model with an SU of every SG on every node. A NoRed SG has one SI
+        per SU assigned to it, the SIs of a 2N SG are assigned to its first two
+        SUs and those of an N-Way-Active SG to all of its SUs.
+        returns: ImmModel
+    """
+    model = ImmModel()
+    for class_name, (rdn, attrs) in CLASSES.items():
+        model.define(class_name, rdn, attrs)
+    model.add('SaAmfCluster', AMF_CLUSTER, {})
+    model.add('SaClmCluster', CLM_CLUSTER, {})
+
+    amfnode_dns = []
+    for index in range(nodes):
+        hostname = hostname_of(index)
+        clmnode_dn = 'safNode=%s,%s' % (hostname, CLM_CLUSTER)
+        amfnode_dn = 'safAmfNode=%s,%s' % (hostname, AMF_CLUSTER)
+        model.add('SaClmNode', clmnode_dn, {})
+        model.add('SaAmfNode', amfnode_dn, {'saAmfNodeClmNode': [clmnode_dn],
+                                            'saAmfNodeAdminState': [1]})
+        for app in range(apps):
+            model.add('SaAmfNodeSwBundle', 'safInstalledSwBundle=safSmfBundle=App%d,%s' %
+                      (app, amfnode_dn), {'saAmfNodeSwBundlePathPrefix': ['/opt/app%d' % app]})
+        amfnode_dns.append(amfnode_dn)
+    model.add('SaAmfNodeGroup', 'safAmfNodeGroup=AllNodes,%s' % AMF_CLUSTER,
+              {'saAmfNGNodeList': amfnode_dns})
+
+    sg_index = 0
+    for app in range(apps):
+        app_dn = 'safApp=App%d' % app
+        model.add('SaAmfApplication', app_dn, {'saAmfAppType': ['safVersion=1,safAppType=App']})
+        for sg in range(sgs):
+            redundancy = mix[sg_index % len(mix)]
+            sg_index += 1
+            name = 'App%d-SG%d' % (app, sg)
+            sg_type = 'safVersion=1,safSgType=%s' % name
+            su_type = 'safVersion=1,safSuType=%s' % name
+            svc_type = 'safVersion=1,safSvcType=%s' % name
+            for class_name, type_dn, attrs in (
+                    ('SaAmfSGType', sg_type, {'saAmfSgtRedundancyModel': [redundancy]}),
+                    ('SaAmfSUType', su_type, {'saAmfSutProvidesSvcTypes': [svc_type]}),
+                    ('SaAmfSvcType', svc_type, {})):
+                model.add(class_name.replace('Type', 'BaseType'), type_dn.split(',', 1)[1], {})
+                model.add(class_name, type_dn, attrs)
+            sg_dn = 'safSg=SG%d,%s' % (sg, app_dn)
+            model.add('SaAmfSG', sg_dn, {'saAmfSGType': [sg_type]})
+
+            su_dns = []
+            for amfnode_dn in amfnode_dns:
+                su_dn = 'safSu=%s,%s' % (amfnode_dn.split(',')[0].split('=')[1], sg_dn)
+                model.add('SaAmfSU', su_dn, {'saAmfSUType': [su_type],
+                                             'saAmfSUHostNodeOrNodeGroup': [amfnode_dn],
+                                             'saAmfSUAdminState': [1],
+                                             'saAmfSUHostedByNode': [amfnode_dn]})
+                for comp in range(comps):
+                    comp_dn = 'safComp=Comp%d,%s' % (comp, su_dn)
+                    model.add('SaAmfComp', comp_dn, {'saAmfCompType': ['safVersion=1,safCompType=Comp']})
+                    model.add('SaAmfCompCsType', 'safSupportedCsType=safVersion=1\\,safCSType=%s,%s' %
+                              (name, comp_dn), {})
+                    model.add('SaAmfHealthcheck', 'safHealthcheckKey=hc,%s' % comp_dn,
+                              {'saAmfHealthcheckPeriod': [10000000000]})
+                su_dns.append(su_dn)
+
+            if redundancy == REDUNDANCY['nored']:
+                assigned = [[su_dn] for su_dn in su_dns]
+            elif redundancy == REDUNDANCY['2n']:
+                assigned = [su_dns[:2]] * sis
+            else:
+                assigned = [su_dns] * sis
+            for si, si_sus in enumerate(assigned):
+                si_dn = 'safSi=%s-SI%d,%s' % (name, si, app_dn)
+                model.add('SaAmfSI', si_dn, {'saAmfSvcType': [svc_type],
+                                             'saAmfSIProtectedbySG': [sg_dn]})
+                for csi in range(csis):
+                    csi_dn = 'safCsi=CSI%d,%s' % (csi, si_dn)
+                    model.add('SaAmfCSI', csi_dn, {'saAmfCSType': ['safVersion=1,safCSType=%s' % name]})
+                    model.add('SaAmfCSIAttribute', 'safCsiAttr=attr,%s' % csi_dn,
+                              {'saAmfCSIAttriValue': ['value']})
+                for su_dn in si_sus:
+                    model.add('SaAmfSIAssignment', 'safSISU=%s,%s' % (su_dn.replace(',', '\\,'), si_dn), {})
+    return model
+
+
+class AdminCalls(object):
+    """ Stand-in for subprocess.call of the admin commands: counts them, and
+        locking the instantiation of an SU removes its SI assignments like AMF does
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.assignments = None
+
+    def __call__(self, command):
+        with self.lock:
+            self.model.calls['admin ' + ' '.join(command[:-1])] += 1
+            if command[:2] == ['amf-adm', 'lock-in'] and command[-1].startswith('safSu='):
+                if self.assignments is None:
+                    self.assignments = dict()
+                    for dn, immobj in self.model.objects.items():
+                        if immobj.class_name == 'SaAmfSIAssignment':
+                            su_dn = rdn_value(dn).replace('\\,', ',')
+                            self.assignments.setdefault(su_dn, []).append(dn)
+                for dn in self.assignments.pop(command[-1], []):
+                    del self.model.objects[dn]
+        return 0
+
+
+def load_script(name):
+    """ Import one of the scaling scripts, their file names are not module names """
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+                                                  os.path.join(TO_ADD, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_model(module, model):
+    module.inst_iter = model.iterator
+    module.Ccb = model.ccb
+    module.accessor = model.accessor()
+    module.admin_call = AdminCalls(model)
+    module.metrics = ScaleMetrics(module.metrics.operation)
+
+
+def measure(model, func, *args):
+    """ Run one scaling operation on the model
+        returns: dict of the measurements
+    """
+    calls = Counter(model.calls)
+    ccbs = len(model.ccb_sizes)
+    start = time.time()
+    # Keep the object listings of the scripts out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args)
+    seconds = time.time() - start
+    calls = dict((kind, count - calls[kind]) for kind, count in sorted(model.calls.items())
+                 if count != calls[kind])
+    return {'seconds': seconds,
+            'calls': calls,
+            'ccb_sizes': model.ccb_sizes[ccbs:]}
+
+
+def current_rss_kb():
+    """ Resident set size of the process in kB, from /proc where there is one """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_size(nodes, options):
+    """ Scale out and then scale in a model of a number of nodes
+        returns: dict of the measurements
+    """
+    model = generate_model(nodes, options.apps, options.sgs, options.comps, options.sis,
+                           options.csis, parse_mix(options.mix))
+    if options.write_xml:
+        model.write(os.path.join(options.write_xml, 'imm-%d.xml' % nodes))
+    scale_out = load_script('scale-out-opensaf')
+    scale_in = load_script('scale-in-opensaf')
+    use_model(scale_out, model)
+    use_model(scale_in, model)
+    objects = len(model.objects)
+    baseline_rss = current_rss_kb()
+
+    new_hostnames = [hostname_of(nodes + index) for index in range(options.scale_nodes)]
+    out = measure(model, scale_out.scale_out, new_hostnames, hostname_of(0), options.nodes_per_ccb)
+    # The nodes scaled in have SUs with SI assignments, the new ones do not yet
+    old_hostnames = [hostname_of(index) for index in range(max(1, nodes - options.scale_nodes), nodes)]
+    back = measure(model, scale_in.scale_in, old_hostnames, options.workers)
+    out['phases'] = scale_out.metrics.phases
+    back['phases'] = scale_in.metrics.phases
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'nodes': nodes,
+            'objects': objects,
+            'scale_out': out,
+            'scale_in': back,
+            'peak_rss_kb': peak_rss,
+            'rss_growth_kb': max(0, peak_rss - baseline_rss)}
+
+
+def _run_size_child(queue, nodes, options):
+    try:
+        queue.put((run_size(nodes, options), None))
+    except Exception:
+        # The parent waits for a result, it gets the error instead
+        queue.put((None, traceback.format_exc()))
+        raise
+
+
+def run_isolated(nodes, options):
+    """ Run a size in a forked child so its peak RSS is its own
+        raises: RuntimeError if the child failed or died without a result
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        return run_size(nodes, options)
+    queue = context.Queue()
+    child = context.Process(target=_run_size_child, args=(queue, nodes, options))
+    child.start()
+    while True:
+        try:
+            result, error = queue.get(timeout=CHILD_POLL_INTERVAL)
+            break
+        except Empty:
+            if not child.is_alive():
+                # The result may have been queued right before the exit
+                try:
+                    result, error = queue.get(timeout=CHILD_POLL_INTERVAL)
+                    break
+                except Empty:
+                    child.join()
+                    raise RuntimeError('%d nodes died with exit code %s without a result' %
+                                       (nodes, child.exitcode))
+    child.join()
+    if error:
+        raise RuntimeError('%d nodes failed:\n%s' % (nodes, error))
+    return result
+
+
+def compare(results, baseline_path, tolerance):
+    """ Sizes slower than the baseline by more than tolerance
+        returns: list of messages
+    """
+    with open(baseline_path) as f:
+        baseline = dict((r['nodes'], r) for r in json.load(f)['results'])
+    regressions = []
+    for result in results:
+        before = baseline.get(result['nodes'])
+        if not before:
+            continue
+        for phase in ('scale_out', 'scale_in'):
+            if result[phase]['seconds'] > before[phase]['seconds'] * (1 + tolerance):
+                regressions.append('{0} nodes {1}: {2:.3f} s, baseline {3:.3f} s'.format(
+                    result['nodes'], phase, result[phase]['seconds'], before[phase]['seconds']))
+    return regressions
+
+
+def summary(phase):
+    calls = phase['calls']
+    ccb_ops = sum(count for kind, count in calls.items()
+                  if kind.startswith('ccb ') and kind != 'ccb apply')
+    admin = sum(count for kind, count in calls.items() if kind.startswith('admin '))
+    return '{0:8.3f} s {1:4d} iter {2:5d} get {3:6d} ccb ops in {4} ccbs {5:4d} admin'.format(
+        phase['seconds'], calls.get('iterator', 0), calls.get('get', 0), ccb_ops,
+        len(phase['ccb_sizes']), admin)
+
+
+def parse_argument(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark scale-out and scale-in on synthetic AMF models offline')
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=DEFAULT_NODES,
+                        help='Node counts of the models (default: %(default)s)')
+    parser.add_argument('--apps', type=int, default=2,
+                        help='Applications of a model (default: %(default)s)')
+    parser.add_argument('--sgs', type=int, default=2,
+                        help='SGs of an application, each with an SU on every node (default: %(default)s)')
+    parser.add_argument('--comps', type=int, default=2,
+                        help='Components of an SU (default: %(default)s)')
+    parser.add_argument('--sis', type=int, default=2,
+                        help='SIs of a 2N or N-Way-Active SG, a NoRed SG has one per SU '
+                        '(default: %(default)s)')
+    parser.add_argument('--csis', type=int, default=2,
+                        help='CSIs of an SI (default: %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Redundancy models of the SGs with their weights, of %s (default: %%(default)s)'
+                        % ', '.join(sorted(REDUNDANCY)))
+    parser.add_argument('--scale-nodes', dest='scale_nodes', type=int, default=4,
+                        help='Nodes scaled out and then scaled in (default: %(default)s)')
+    parser.add_argument('--nodes-per-ccb', dest='nodes_per_ccb', type=int, default=0,
+                        help='Nodes created per CCB by scale-out, all in one CCB if 0 (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Admin operations run at the same time by scale-in (default: %(default)s)')
+    parser.add_argument('--write-xml', dest='write_xml', default=None,
+                        help='Directory to write the models to as imm-<nodes>.xml, for --imm-xml')
+    parser.add_argument('-o', '--output', default=None, help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON results of an earlier run, exit 1 when a size got slower')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline (default: %(default)s)')
+    options = parser.parse_args(args=args)
+    try:
+        parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    return options
+
+
+def main():
+    options = parse_argument(sys.argv[1:])
+    results = []
+    for nodes in options.nodes:
+        result = run_isolated(nodes, options)
+        results.append(result)
+        print('{0:5d} nodes {1:7d} objects rss +{2:7d} kB'.format(
+            nodes, result['objects'], result['rss_growth_kb']), file=sys.stderr)
+        print('    scale-out {0}'.format(summary(result['scale_out'])), file=sys.stderr)
+        print('    scale-in  {0}'.format(summary(result['scale_in'])), file=sys.stderr)
+
+    report = {'model': {'apps': options.apps, 'sgs': options.sgs, 'comps': options.comps,
+                        'sis': options.sis, 'csis': options.csis, 'mix': options.mix,
+                        'scale_nodes': options.scale_nodes, 'nodes_per_ccb': options.nodes_per_ccb,
+                        'workers': options.workers},
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if options.baseline:
+        regressions = compare(results, options.baseline, options.tolerance)
+        for message in regressions:
+            print('Regression {0}'.format(message), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+""" Start, scale out and scale in an opensaf-cluster of containers.
+    Containers are launched in parallel, a bounded number at a time, and a node
+    is ready once opensafd is active and it is a member of CLM. All nodes are
+    waited for at the same time, the PL nodes join once an SC is up, so a
+    cluster is up in about the time of its slowest node.
+    Container names and hostnames are sc<N>/SC-<N> and pl<N>/PL-<N>, new PL IDs
+    are allocated under a lock in the workspace so concurrent runs do not race.
+"""
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE = 'opensaf-cluster'
+CLM_CLUSTER = 'safCluster=myClmCluster'
+SC_COUNT = 2
+FIRST_PL = SC_COUNT + 1
+DEFAULT_PARALLEL = 8
+DEFAULT_TIMEOUT = 300.0
+POLL_INTERVAL = 1.0
+SCALE_IN = '/usr/local/lib/opensaf/scale-in-opensaf.py'
+NAME_RE = re.compile(r'^(sc|pl)(\d+)$')
+
+
+def node_name(kind, number):
+    """ Container name and hostname of a node, e.g. pl3 and PL-3 """
+    return '%s%d' % (kind, number), '%s-%d' % (kind.upper(), number)
+
+
+class DockerRuntime(object):
+    """ Containers of the opensaf-cluster image run by the docker CLI """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    def list(self):
+        """ The names of the containers of the image, running or not """
+        output = subprocess.check_output(
+            ['docker', 'ps', '-a', '--filter', 'ancestor=%s' % IMAGE, '--format', '{{.Names}}'])
+        return output.decode().split()
+
+    def run(self, name, hostname):
+        subprocess.check_call(
+            ['docker', 'run', '-d', '--name', name, '-h', hostname, '--privileged',
+             '-v', '/sys/fs/cgroup:/sys/fs/cgroup:ro',
+             '-v', '%s:/etc/opensaf/sharedfs' % os.path.join(self.workspace, 'sharedfs'),
+             '-it', IMAGE, '/sbin/init'], stdout=subprocess.DEVNULL)
+
+    def exec(self, name, command):
+        """ returns: exit code and output of a command in a container """
+        process = subprocess.run(['docker', 'exec', name] + command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        return process.returncode, process.stdout.decode(errors='replace')
+
+    def remove(self, name):
+        subprocess.check_call(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL)
+
+
+class FakeRuntime(object):
+    """ Stand-in for docker to try the orchestration without containers: a node
+        gets ready after a random boot time, a PL only joins CLM once an SC is
+        ready. The containers are kept in a JSON file of the workspace so
+        consecutive runs see them.
+    """
+
+    def __init__(self, workspace, boot_seconds=2.0):
+        self.path = os.path.join(workspace, 'fake-containers.json')
+        self.boot_seconds = boot_seconds
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def containers(self):
+        with self.lock, open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            containers = dict()
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    containers = json.load(f)
+            yield containers
+            with open(self.path, 'w') as f:
+                json.dump(containers, f, indent=2)
+
+    def list(self):
+        with self.containers() as containers:
+            return sorted(containers)
+
+    def run(self, name, hostname):
+        with self.containers() as containers:
+            if name in containers:
+                raise RuntimeError('Container %s exists' % name)
+            boot = self.boot_seconds * random.uniform(0.5, 1.5)
+            containers[name] = {'hostname': hostname, 'ready_at': time.time() + boot}
+
+    def exec(self, name, command):
+        with self.containers() as containers:
+            container = containers.get(name)
+            if container is None:
+                return 1, 'No such container: %s' % name
+            up = container['ready_at'] <= time.time()
+            if command[:2] == ['systemctl', 'is-active']:
+                return (0, 'active') if up else (3, 'activating')
+            if command[0] == 'immlist':
+                sc_up = any(other['ready_at'] <= time.time() for other_name, other in
+                            containers.items() if other_name.startswith('sc'))
+                return 0, 'saClmNodeIsMember  SA_UINT32_T  %d' % (1 if up and sc_up else 0)
+            if SCALE_IN in command:
+                return 0, 'Scaling in done'
+            return 0, ''
+
+    def remove(self, name):
+        with self.containers() as containers:
+            containers.pop(name, None)
+
+
+RUNTIMES = {'docker': DockerRuntime, 'fake': FakeRuntime}
+
+
+def is_ready(runtime, name, hostname):
+    """ Whether opensafd is active on a node and the node is a member of CLM """
+    code, _ = runtime.exec(name, ['systemctl', 'is-active', '--quiet', 'opensafd'])
+    if code != 0:
+        return False
+    code, output = runtime.exec(name, ['immlist', '-a', 'saClmNodeIsMember',
+                                       'safNode=%s,%s' % (hostname, CLM_CLUSTER)])
+    return code == 0 and re.search(r'saClmNodeIsMember\s+\S+\s+1\b', output) is not None
+
+
+def wait_ready(runtime, name, hostname, timeout=DEFAULT_TIMEOUT):
+    """ Poll a node until it is ready
+        returns: seconds it took
+    """
+    start = time.time()
+    while not is_ready(runtime, name, hostname):
+        if time.time() - start > timeout:
+            raise RuntimeError('%s is not ready after %d s' % (hostname, timeout))
+        time.sleep(POLL_INTERVAL)
+    return time.time() - start
+
+
+def create(runtime, nodes, parallel=DEFAULT_PARALLEL):
+    """ Run the containers of nodes, parallel at a time
+        params:
+            nodes - list of (container name, hostname)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        list(executor.map(lambda node: runtime.run(*node), nodes))
+
+
+def wait_all(runtime, nodes, timeout=DEFAULT_TIMEOUT):
+    """ Wait until all nodes are ready, they are polled at the same time
+        returns: dict of seconds until ready by hostname
+    """
+    start = time.time()
+
+    def wait(node):
+        name, hostname = node
+        wait_ready(runtime, name, hostname, timeout)
+        seconds = time.time() - start
+        print('%s ready after %.1f s' % (hostname, seconds))
+        return hostname, seconds
+
+    if not nodes:
+        return dict()
+    with ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        return dict(executor.map(wait, nodes))
+
+
+@contextlib.contextmanager
+def id_lock(workspace):
+    """ Held while IDs are allocated and their containers created """
+    with open(os.path.join(workspace, '.cluster.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def existing_nodes(runtime, kind):
+    """ The numbers of the nodes of a kind, sc or pl """
+    numbers = []
+    for name in runtime.list():
+        match = NAME_RE.match(name)
+        if match and match.group(1) == kind:
+            numbers.append(int(match.group(2)))
+    return sorted(numbers)
+
+
+def prepare_workspace(workspace, clean=False):
+    sharedfs = os.path.join(workspace, 'sharedfs')
+    if clean:
+        shutil.rmtree(sharedfs, ignore_errors=True)
+    if not os.path.isdir(sharedfs):
+        os.makedirs(sharedfs)
+        os.chmod(sharedfs, 0o755)
+
+
+def start(runtime, workspace, size, parallel=DEFAULT_PARALLEL, timeout=DEFAULT_TIMEOUT):
+    """ Start a cluster of 2 SCs and size - 2 PLs on a clean sharedfs """
+    prepare_workspace(workspace, clean=True)
+    scs = [node_name('sc', number) for number in range(1, min(size, SC_COUNT) + 1)]
+    pls = [node_name('pl', number) for number in range(FIRST_PL, size + 1)]
+    # The PLs are created with the SCs, they join CLM once an SC is up
+    with id_lock(workspace):
+        create(runtime, scs + pls, parallel)
+    return wait_all(runtime, scs + pls, timeout)
+
+
+def scale_out(runtime, workspace, count, parallel=DEFAULT_PARALLEL, timeout=DEFAULT_TIMEOUT):
+    """ Add count PL nodes with the next free IDs, the scale-out hook of the SC
+        copies the configuration to them when they join
+    """
+    prepare_workspace(workspace)
+    with id_lock(workspace):
+        numbers = existing_nodes(runtime, 'pl')
+        first = max(numbers + [FIRST_PL - 1]) + 1
+        nodes = [node_name('pl', number) for number in range(first, first + count)]
+        create(runtime, nodes, parallel)
+    return wait_all(runtime, nodes, timeout)
+
+
+def scale_in(runtime, workspace, hostnames, parallel=DEFAULT_PARALLEL, force=False):
+    """ Remove the IMM configuration of PL nodes on an SC, then their containers """
+    nodes = [node_name('pl', int(hostname.split('-')[1])) for hostname in hostnames]
+    code, output = 1, 'No SC node'
+    for name, _ in [node_name('sc', number) for number in existing_nodes(runtime, 'sc')]:
+        code, output = runtime.exec(name, ['python', SCALE_IN, '--hostname'] +
+                                    [hostname for _, hostname in nodes])
+        if code == 0:
+            break
+    print(output.rstrip())
+    if code != 0 and not force:
+        raise RuntimeError('scale-in-opensaf.py failed, the containers are kept')
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        list(executor.map(runtime.remove, [name for name, _ in nodes]))
+
+
+def parse_argument(args):
+    parser = argparse.ArgumentParser(description='Start and scale an opensaf-cluster of containers')
+    parser.add_argument('-w', '--workspace', required=True,
+                        help='Workspace of the sharedfs of the cluster')
+    parser.add_argument('--runtime', choices=sorted(RUNTIMES), default='docker',
+                        help='Container runtime, fake runs no containers (default: %(default)s)')
+    parser.add_argument('-p', '--parallel', type=int, default=DEFAULT_PARALLEL,
+                        help='Most containers created or removed at the same time '
+                        '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds a node may take to get ready (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('start', help='Start a cluster of 2 SCs and PLs')
+    command.add_argument('-s', '--size', type=int, required=True,
+                         help='Number of nodes of the cluster')
+    command = commands.add_parser('scale-out', help='Add PL nodes')
+    command.add_argument('-s', '--size', type=int, required=True,
+                         help='Number of nodes to add')
+    command = commands.add_parser('scale-in', help='Remove PL nodes')
+    group = command.add_mutually_exclusive_group(required=True)
+    group.add_argument('--hostname', nargs='+', help='Hostnames of the nodes to remove, e.g. PL-5')
+    group.add_argument('-s', '--size', type=int, help='Number of PL nodes to remove, the last ones')
+    command.add_argument('--force', action='store_true',
+                         help='Remove the containers even if scale-in-opensaf.py failed')
+    options = parser.parse_args(args=args)
+    if options.command is None:
+        parser.error('a command is required')
+    return options
+
+
+def main():
+    options = parse_argument(sys.argv[1:])
+    workspace = os.path.abspath(os.path.expanduser(options.workspace))
+    runtime = RUNTIMES[options.runtime](workspace)
+    begin = time.time()
+    try:
+        if options.command == 'start':
+            ready = start(runtime, workspace, options.size, options.parallel, options.timeout)
+        elif options.command == 'scale-out':
+            ready = scale_out(runtime, workspace, options.size, options.parallel, options.timeout)
+        else:
+            numbers = existing_nodes(runtime, 'pl')
+            hostnames = options.hostname or [
+                node_name('pl', number)[1]
+                for number in numbers[max(0, len(numbers) - options.size):]]
+            scale_in(runtime, workspace, hostnames, options.parallel, options.force)
+            ready = dict()
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        sys.exit(str(e))
+    print('%s done in %.1f s%s' % (options.command, time.time() - begin,
+                                   ', slowest node %.1f s' % max(ready.values()) if ready else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,249 @@
 #!/usr/bin/env python
 # Test remote function using xmlrpc
 # Usage: echo_client.py <echo_server_ip> <text>
+#        echo_client.py <echo_server_ip> [--workers N] [--duration S] [--batch B]
+#                       [--rate R] [--timeline FILE]
+# With a text the echo is called once, without one probes are sent by workers
+# over persistent connections and the throughput and latencies are reported.
+# A timeline records every request, e.g. while a node is scaled in or failed
+# over, and shows how long the service was unavailable.
+import argparse
+import csv
+import http.client
+import json
+import os
 import sys
+import threading
+import time
 import xmlrpc.client
 
-ECHO_PORT = 11881
+TO_ADD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'to-add')
+sys.path.insert(0, TO_ADD)
 
-if len(sys.argv) != 3:
-    print("Usage: echo_client <echo_server_ip> <text>")
-    exit(1)
+from echo_transport import TimeoutTransport, ECHO_PORT, DEFAULT_TIMEOUT  # noqa: E402
 
-echo_server = xmlrpc.client.ServerProxy("http://%s:%d" % (sys.argv[1], ECHO_PORT))
-print(echo_server.echo(sys.argv[2]))
+DEFAULT_WORKERS = 4
+DEFAULT_DURATION = 10.0
+# Pause of a worker after a failed request, so a refused connection does not spin
+RETRY_DELAY = 0.05
+ERRORS = (OSError, xmlrpc.client.Error, http.client.HTTPException)
+
+
+class EchoClient(object):
+    """ Client of an echo server over one persistent connection, reconnected
+        after an error. Not thread safe, use one per thread.
+    """
+
+    def __init__(self, host, port=ECHO_PORT, timeout=DEFAULT_TIMEOUT):
+        self.proxy = xmlrpc.client.ServerProxy('http://%s:%d' % (host, port),
+                                               transport=TimeoutTransport(timeout))
+
+    def echo(self, text):
+        return self.proxy.echo(text)
+
+    def probe(self, count=1, text='probe'):
+        """ Echo count texts, in one system.multicall request when more than one
+            returns: list of replies
+        """
+        if count == 1:
+            return [self.proxy.echo(text)]
+        multicall = xmlrpc.client.MultiCall(self.proxy)
+        for _ in range(count):
+            multicall.echo(text)
+        return list(multicall())
+
+    def close(self):
+        self.proxy('close')()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_worker(client, records, deadline, requests, batch, rate, counter):
+    """ Probe until the deadline or until the requests are used up, appending
+        (start, seconds, error, host) per request to records
+    """
+    interval = 1.0 / rate if rate else 0.0
+    next_start = time.time()
+    while time.time() < deadline:
+        if requests:
+            with counter['lock']:
+                if counter['sent'] >= requests:
+                    return
+                counter['sent'] += 1
+        start = time.time()
+        try:
+            replies = client.probe(batch)
+            records.append((start, time.time() - start, None, replies[0].split(':', 1)[0]))
+        except ERRORS as e:
+            records.append((start, time.time() - start, type(e).__name__, None))
+            time.sleep(RETRY_DELAY)
+        if interval:
+            next_start += interval
+            time.sleep(max(0.0, next_start - time.time()))
+
+
+def run_load(host, port, workers=DEFAULT_WORKERS, duration=DEFAULT_DURATION, requests=0,
+             batch=1, rate=0.0, timeout=DEFAULT_TIMEOUT):
+    """ Probe an echo server from workers, each with its own connection
+        params:
+            requests - total requests, 0 to run for the duration
+            batch - probes per request, sent as one multicall when more than one
+            rate - requests per second of a worker, 0 for as many as it can
+        returns: list of (start, seconds, error, host) of every request in start order
+    """
+    deadline = time.time() + duration if not requests else float('inf')
+    counter = {'lock': threading.Lock(), 'sent': 0}
+    records = [[] for _ in range(workers)]
+    clients = [EchoClient(host, port, timeout) for _ in range(workers)]
+    threads = [threading.Thread(target=run_worker,
+                                args=(client, worker_records, deadline, requests, batch,
+                                      rate, counter))
+               for client, worker_records in zip(clients, records)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    return sorted((record for worker_records in records for record in worker_records),
+                  key=lambda record: record[0])
+
+
+def outages(records):
+    """ The periods without a successful request, from the first failed request
+        to the next successful one
+        returns: list of (start, seconds, failed requests)
+    """
+    result = []
+    down = None
+    failed = 0
+    for start, seconds, error, _ in records:
+        if error:
+            if down is None:
+                down = start
+            failed += 1
+        elif down is not None:
+            result.append((down, start + seconds - down, failed))
+            down = None
+            failed = 0
+    if down is not None:
+        last = records[-1]
+        result.append((down, last[0] + last[1] - down, failed))
+    return result
+
+
+def failovers(records):
+    """ The requests answered by another host than the request before
+        returns: list of (start, from host, to host)
+    """
+    result = []
+    previous = None
+    for start, _, error, host in records:
+        if error:
+            continue
+        if previous is not None and host != previous:
+            result.append((start, previous, host))
+        previous = host
+    return result
+
+
+def summary(records, batch):
+    """ Throughput and latencies of the successful requests
+        returns: dict
+    """
+    latencies = [seconds for _, seconds, error, _ in records if not error]
+    elapsed = (max(start + seconds for start, seconds, _, _ in records) -
+               records[0][0]) if records else 0.0
+    begin = records[0][0] if records else 0.0
+    return {'requests': len(records),
+            'errors': len(records) - len(latencies),
+            'probes': len(latencies) * batch,
+            'seconds': elapsed,
+            'requests_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+            'probes_per_sec': len(latencies) * batch / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': max(latencies) * 1000 if latencies else 0.0,
+            'outages': [{'at': down - begin, 'seconds': seconds, 'failed': failed}
+                        for down, seconds, failed in outages(records)],
+            'failovers': [{'at': start - begin, 'from': old, 'to': new}
+                          for start, old, new in failovers(records)]}
+
+
+def write_timeline(path, records):
+    """ One CSV row per request: seconds since the first, latency, error, host """
+    begin = records[0][0] if records else 0.0
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time_s', 'latency_ms', 'error', 'host'])
+        for start, seconds, error, host in records:
+            writer.writerow(['%.6f' % (start - begin), '%.3f' % (seconds * 1000),
+                             error or '', host or ''])
+
+
+def parse_argument(args):
+    parser = argparse.ArgumentParser(
+        description='Call the echo server once, or probe it from several workers and '
+        'report throughput and latencies')
+    parser.add_argument('host', help='Address of the echo server')
+    parser.add_argument('text', nargs='?', default=None,
+                        help='Text to echo once, probe the server when not set')
+    parser.add_argument('--port', type=int, default=ECHO_PORT,
+                        help='Port of the echo server (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a reply (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Workers, each with its own connection (default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_DURATION,
+                        help='Seconds to probe for (default: %(default)s)')
+    parser.add_argument('-n', '--requests', type=int, default=0,
+                        help='Total requests to send instead of probing for a duration')
+    parser.add_argument('-b', '--batch', type=int, default=1,
+                        help='Probes per request, sent as one system.multicall (default: %(default)s)')
+    parser.add_argument('-r', '--rate', type=float, default=0.0,
+                        help='Requests per second of a worker, 0 for as many as it can')
+    parser.add_argument('--timeline', default=None,
+                        help='Write every request as a CSV row to this file')
+    parser.add_argument('-o', '--output', default=None, help='Write the results as JSON to this file')
+    return parser.parse_args(args=args)
+
+
+def main():
+    options = parse_argument(sys.argv[1:])
+    if options.text is not None:
+        print(EchoClient(options.host, options.port, options.timeout).echo(options.text))
+        return
+
+    records = run_load(options.host, options.port, options.workers, options.duration,
+                       options.requests, options.batch, options.rate, options.timeout)
+    result = summary(records, options.batch)
+    print('{requests} requests {errors} errors {requests_per_sec:.0f} req/s {probes_per_sec:.0f} '
+          'probes/s p50 {p50_ms:.2f} ms p95 {p95_ms:.2f} ms p99 {p99_ms:.2f} ms '
+          'max {max_ms:.2f} ms'.format(**result), file=sys.stderr)
+    for outage in result['outages']:
+        print('unavailable at {at:.3f} s for {seconds:.3f} s, {failed} failed requests'.format(
+            **outage), file=sys.stderr)
+    for failover in result['failovers']:
+        print('answered by {to} instead of {from} at {at:.3f} s'.format(**failover),
+              file=sys.stderr)
+    if options.timeline:
+        write_timeline(options.timeline, records)
+
+    report = {'server': '%s:%d' % (options.host, options.port),
+              'workers': options.workers, 'batch': options.batch, 'rate': options.rate,
+              'results': result}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+""" Tests of the IMM model cache of the scale-out service, against the
+    in-memory IMM of imm_offline: python3 -m unittest test_imm_cache
+"""
+import os
+import sys
+import unittest
+
+from bench_scaling import AMF_CLUSTER, generate_model, hostname_of, parse_mix
+
+TO_ADD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'to-add')
+sys.path.insert(0, TO_ADD)
+
+from imm_cache import ImmCache  # noqa: E402
+
+NODE_DNS = ['safAmfNode=%s,%s' % (hostname_of(index), AMF_CLUSTER) for index in range(2)]
+SU_DN = 'safSu=%s,safSg=SG0,safApp=App0' % hostname_of(0)
+SI_DN = 'safSi=App0-SG0-SI0,safApp=App0'
+
+
+class ImmCacheTest(unittest.TestCase):
+    """ The model is changed without apply_change(), as IMM does when the
+        applier is not told about a class or before the poller woke up
+    """
+
+    def setUp(self):
+        self.model = generate_model(2, 1, 1, 1, 1, 1, parse_mix('2n=1'))
+        self.cache = ImmCache(self.model.iterator)
+
+    def comps_of(self, su_dn):
+        return [comp.dn for comp in self.cache.under('SaAmfComp', [self.cache.get('SaAmfSU', su_dn)])]
+
+    def test_refresh_reads_unwatched_class_again(self):
+        self.assertEqual(self.comps_of(SU_DN), ['safComp=Comp0,' + SU_DN])
+        self.model.add('SaAmfComp', 'safComp=Comp1,' + SU_DN,
+                       {'saAmfCompType': ['safVersion=1,safCompType=Comp']})
+        self.assertEqual(len(self.comps_of(SU_DN)), 1)
+        self.cache.refresh()
+        self.assertEqual(self.comps_of(SU_DN), ['safComp=Comp0,' + SU_DN, 'safComp=Comp1,' + SU_DN])
+
+    def test_forget_reads_csis_again(self):
+        si = self.cache.get('SaAmfSI', SI_DN)
+        self.assertEqual(len(self.cache.under('SaAmfCSI', [si])), 1)
+        self.model.add('SaAmfCSI', 'safCsi=CSI1,' + SI_DN, {'saAmfCSType': ['safVersion=1,safCSType=App0-SG0']})
+        self.cache.forget()
+        self.assertEqual(len(self.cache.under('SaAmfCSI', [si])), 2)
+        self.assertIsNotNone(self.cache.get('SaAmfCSI', 'safCsi=CSI1,' + SI_DN))
+
+    def test_refresh_applies_watched_class(self):
+        self.assertEqual(len(self.cache.sus_hosted_by(NODE_DNS[1])), 1)
+        stamp = self.cache.stamp()
+        self.model.add('SaAmfSU', 'safSu=%s,safSg=SG0,safApp=App0' % hostname_of(2),
+                       {'saAmfSUHostedByNode': [NODE_DNS[1]]})
+        self.assertEqual(self.cache.refresh(), 1)
+        self.assertTrue(self.cache.changed_since(stamp, ['SaAmfSU']))
+        self.assertFalse(self.cache.changed_since(stamp, ['SaAmfSI']))
+        self.assertEqual(len(self.cache.sus_hosted_by(NODE_DNS[1])), 2)
+
+    def test_indexes_read_are_not_modified(self):
+        sus_by_node = self.cache.sus_hosted_by(NODE_DNS[0])
+        by_dn = self.cache.by_dn
+        self.comps_of(SU_DN)
+        dns = set(by_dn)
+        self.model.remove(SU_DN)
+        self.cache.refresh()
+        self.cache.objects('SaAmfSU')
+        self.assertEqual([itsu.dn for itsu in sus_by_node], [SU_DN])
+        self.assertEqual(set(by_dn), dns)
+        self.assertIsNone(self.cache.get('SaAmfSU', SU_DN))
+        self.assertEqual(self.cache.sus_hosted_by(NODE_DNS[0]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+""" Run the admin commands of many AMF/CLM objects at the same time """
+import subprocess
+import threading
+from collections import deque
+
+DEFAULT_WORKERS = 8
+
+
+def run_jobs(jobs, workers=DEFAULT_WORKERS, call=None):
+    """ Run jobs on a bounded pool of threads, the commands of one job are run
+        one after the other
+        params:
+            jobs - list of jobs, a job is a list of commands as argument lists
+            workers - most jobs run at the same time
+            call - runs one command, subprocess.call by default
+        returns: the return codes of the commands of every job, in the order of jobs
+    """
+    call = call or subprocess.call
+    results = [None] * len(jobs)
+    pending = deque(enumerate(jobs))
+
+    def worker():
+        while True:
+            try:
+                index, job = pending.popleft()
+            except IndexError:
+                return
+            results[index] = [call(command) for command in job]
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max(1, workers), len(jobs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
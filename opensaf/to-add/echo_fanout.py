@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+""" Probe the echo service of every node of the cluster at the same time.
+    The nodes are read from a file, given on the command line or read from the
+    CLM and AMF nodes in IMM. Every node has its own timeout, a sweep of the
+    whole cluster takes about one timeout.
+"""
+from __future__ import print_function
+import argparse
+import json
+import sys
+import time
+
+try:
+    import xmlrpc.client as xmlrpclib
+except ImportError:
+    import xmlrpclib
+
+from amf_admin import run_jobs
+from echo_transport import TimeoutTransport, ECHO_PORT, DEFAULT_TIMEOUT
+from imm_snapshot import ImmSnapshot, rdn_value, inst_iter
+
+# Most nodes probed at the same time
+DEFAULT_WORKERS = 256
+
+
+def read_nodes(path):
+    """ Nodes of a file, a line is a hostname and optionally its address,
+        lines starting with # are comments
+        returns: list of (hostname, address)
+    """
+    nodes = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                nodes.append((fields[0], fields[1] if len(fields) > 1 else fields[0]))
+    return nodes
+
+
+def imm_nodes(iterator=inst_iter):
+    """ The CLM nodes in IMM, addressed by their hostname
+        returns: list of (hostname, address)
+    """
+    snapshot = ImmSnapshot(iterator)
+    hostnames = [rdn_value(clmnode.dn) for clmnode in snapshot.objects('SaClmNode')]
+    # AMF nodes without a CLM node are probed too, e.g. while one is scaled out
+    for amfnode in snapshot.objects('SaAmfNode'):
+        hostname = rdn_value(amfnode.dn)
+        if hostname not in hostnames:
+            hostnames.append(hostname)
+    return [(hostname, hostname) for hostname in sorted(hostnames)]
+
+
+def probe(node, port=ECHO_PORT, timeout=DEFAULT_TIMEOUT):
+    """ Call the echo of a node
+        returns: dict of the hostname, address, whether it answered, the
+                 latency and the reply or error
+    """
+    hostname, address = node
+    result = {'hostname': hostname, 'address': address}
+    start = time.time()
+    try:
+        proxy = xmlrpclib.ServerProxy('http://%s:%d' % (address, port),
+                                      transport=TimeoutTransport(timeout))
+        reply = proxy.echo(hostname)
+        result.update(ok=True, reply=reply.split(':', 1)[0])
+    except Exception as e:
+        # Refused, timed out, or not an echo server answering
+        result.update(ok=False, error=str(e) or type(e).__name__)
+    result['latency_ms'] = (time.time() - start) * 1000
+    return result
+
+
+def sweep(nodes, port=ECHO_PORT, timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS):
+    """ Probe the nodes concurrently
+        returns: list of probe results in the order of nodes
+    """
+    results = run_jobs([[node] for node in nodes], workers,
+                       lambda node: probe(node, port, timeout))
+    return [result[0] for result in results]
+
+
+def print_table(results, out=sys.stdout):
+    width = max([len(result['hostname']) for result in results] + [8])
+    print('%-*s %-15s %-6s %10s  %s' % (width, 'HOSTNAME', 'ADDRESS', 'STATUS', 'LATENCY',
+                                        'REPLY/ERROR'), file=out)
+    for result in results:
+        print('%-*s %-15s %-6s %7.1f ms  %s' % (
+            width, result['hostname'], result['address'], 'up' if result['ok'] else 'DOWN',
+            result['latency_ms'], result['reply'] if result['ok'] else result['error']), file=out)
+
+
+def parse_argument():
+    parser = argparse.ArgumentParser(
+        description='Probe the echo service of all nodes of the cluster concurrently')
+    parser.add_argument('--nodes', nargs='+', default=None,
+                        help='Hostnames or addresses of the nodes, IMM is read if neither '
+                        '--nodes nor --nodes-file is set')
+    parser.add_argument('--nodes-file', default=None,
+                        help='File with a node per line: hostname [address]')
+    parser.add_argument('--port', type=int, default=ECHO_PORT,
+                        help='Port of the echo server (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for a node (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Most nodes probed at the same time (default: %(default)s)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the results as JSON to this file instead of stdout')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_argument()
+    if args.nodes_file:
+        nodes = read_nodes(args.nodes_file)
+    elif args.nodes:
+        nodes = [(node, node) for node in args.nodes]
+    elif inst_iter is None:
+        sys.exit('pyosaf is not installed, give the nodes with --nodes or --nodes-file')
+    else:
+        nodes = imm_nodes()
+
+    start = time.time()
+    results = sweep(nodes, args.port, args.timeout, args.workers)
+    seconds = time.time() - start
+    down = [result['hostname'] for result in results if not result['ok']]
+
+    print_table(results, sys.stderr)
+    print('%d nodes, %d up, %d down in %.2f s' % (len(results), len(results) - len(down),
+                                                  len(down), seconds), file=sys.stderr)
+    report = {'port': args.port, 'timeout': args.timeout, 'seconds': seconds,
+              'up': len(results) - len(down), 'down': down, 'nodes': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if down else 0)
@@ -1,32 +1,252 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Testing remote function using xmlrpc
-from xmlrpc.server import SimpleXMLRPCServer
+# The echo is the liveness/failover probe of the application on a node, the
+# server answers probes concurrently over keep-alive connections:
+#   threads - SimpleXMLRPCServer with a bounded pool of worker threads, idle
+#             connections wait for their next request in a selector
+#   asyncio - HTTP/1.1 server on an asyncio event loop, one thread
+#   simple  - SimpleXMLRPCServer, one request at a time
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler, \
+    SimpleXMLRPCDispatcher
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
 import logging
+import selectors
 import socket
+import threading
+import time
 
 
 ECHO_PORT = 11881
+MODES = ('threads', 'asyncio', 'simple')
+DEFAULT_WORKERS = 32
+# Seconds an idle keep-alive connection is kept open
+IDLE_TIMEOUT = 30
+# Seconds a request may take to arrive once its connection is readable
+REQUEST_TIMEOUT = 10
+# Seconds between two checks of the idle connections of the threads mode
+IDLE_CHECK_INTERVAL = 1
 host_name = socket.gethostname()
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-
-server = SimpleXMLRPCServer(('', ECHO_PORT), logRequests=True)
-logging.debug("Server listening at host %s with port %d",
-              host_name, ECHO_PORT)
-
 
 # Expose a function
 def echo(text):
-    logging.debug("processing echo(%s)", text)
     return "%s: %s" % (host_name, text)
 
 
-server.register_function(echo)
+def logged_echo(text):
+    logging.debug("processing echo(%s)", text)
+    return echo(text)
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """ Serves one request of a connection, the server keeps the connection
+        open for the next one unless the client closes it
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        # Clients wait for the reply before sending the next request, as the
+        # xmlrpc clients do, nothing of it is left in the buffer of rfile
+        self.close_connection = True
+        self.handle_one_request()
+
+
+class ThreadPoolXMLRPCServer(SimpleXMLRPCServer):
+    """ SimpleXMLRPCServer serving the requests on a bounded pool of threads.
+        A kept-alive connection waits for its next request in a selector, it
+        takes a worker while a request is served only
+    """
+
+    def __init__(self, addr, workers=DEFAULT_WORKERS, **kwargs):
+        SimpleXMLRPCServer.__init__(self, addr, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.idle = selectors.DefaultSelector()
+        # Connections handed to the idle thread, which alone uses the selector
+        self.parked = []
+        self.parked_lock = threading.Lock()
+        self.wakeup, self.waker = socket.socketpair()
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.closed = False
+        self.idle_thread = threading.Thread(target=self.watch_idle)
+        self.idle_thread.daemon = True
+        self.idle_thread.start()
+
+    def process_request(self, request, client_address):
+        self.park(request, client_address)
+
+    def park(self, request, client_address):
+        """ Let a connection wait for its next request without a worker """
+        with self.parked_lock:
+            self.parked.append((request, client_address))
+        self.waker.send(b'\0')
+
+    def watch_idle(self):
+        """ Hand the connections with a request to the workers and close the
+            ones idle for longer than IDLE_TIMEOUT
+        """
+        while not self.closed:
+            now = time.time()
+            for key, _ in self.idle.select(IDLE_CHECK_INTERVAL):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    with self.parked_lock:
+                        parked, self.parked = self.parked, []
+                    for request, client_address in parked:
+                        self.idle.register(request, selectors.EVENT_READ, (client_address, now))
+                else:
+                    self.idle.unregister(key.fileobj)
+                    self.executor.submit(self.process_request_thread, key.fileobj, key.data[0])
+            for key in list(self.idle.get_map().values()):
+                if key.fileobj is not self.wakeup and now - key.data[1] > IDLE_TIMEOUT:
+                    self.idle.unregister(key.fileobj)
+                    self.shutdown_request(key.fileobj)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        if handler.close_connection or self.closed:
+            self.shutdown_request(request)
+        else:
+            self.park(request, client_address)
+
+    def server_close(self):
+        SimpleXMLRPCServer.server_close(self)
+        self.closed = True
+        self.waker.send(b'\0')
+        self.idle_thread.join()
+        for key in list(self.idle.get_map().values()):
+            if key.fileobj is not self.wakeup:
+                self.shutdown_request(key.fileobj)
+        with self.parked_lock:
+            for request, _ in self.parked:
+                self.shutdown_request(request)
+        self.idle.close()
+        self.wakeup.close()
+        self.waker.close()
+        self.executor.shutdown(wait=False)
+
+
+class AsyncXMLRPCServer(object):
+    """ XML-RPC over HTTP/1.1 with keep-alive on an asyncio event loop """
+    rpc_paths = ('/', '/RPC2')
+
+    def __init__(self, addr, log_requests=False):
+        self.addr = addr
+        self.log_requests = log_requests
+        self.dispatcher = SimpleXMLRPCDispatcher(allow_none=False, encoding=None)
+
+    def register_function(self, function, name=None):
+        self.dispatcher.register_function(function, name)
+
+    def register_multicall_functions(self):
+        self.dispatcher.register_multicall_functions()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                if not request_line:
+                    return
+                method, path, version = request_line.decode('latin-1').split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' and \
+                    (version == 'HTTP/1.1' or connection == 'keep-alive')
+                if method != 'POST':
+                    status, response = '501 Not Implemented', b''
+                elif path not in self.rpc_paths:
+                    status, response = '404 Not Found', b''
+                else:
+                    status = '200 OK'
+                    response = self.dispatcher._marshaled_dispatch(body)
+                if self.log_requests:
+                    logging.info('%s "%s %s %s" %s', peer[0], method, path, version,
+                                 status.split()[0])
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: text/xml\r\nContent-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n' %
+                              (status, len(response), 'keep-alive' if keep_alive else 'close')
+                              ).encode('latin-1') + response)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            writer.close()
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self.handle, *self.addr))
+        for sock in server.sockets:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+
+
+def create_server(mode, port=ECHO_PORT, workers=DEFAULT_WORKERS, log_requests=False):
+    """ An echo server of a mode with echo and system.multicall registered """
+    addr = ('', port)
+    if mode == 'asyncio':
+        server = AsyncXMLRPCServer(addr, log_requests=log_requests)
+    elif mode == 'threads':
+        server = ThreadPoolXMLRPCServer(addr, workers, requestHandler=KeepAliveRequestHandler,
+                                        logRequests=log_requests)
+    else:
+        server = SimpleXMLRPCServer(addr, logRequests=log_requests)
+    server.register_function(logged_echo if log_requests else echo, 'echo')
+    server.register_multicall_functions()
+    return server
+
+
+def parse_argument():
+    parser = argparse.ArgumentParser(description='XML-RPC echo server, the probe of a node')
+    parser.add_argument('--mode', choices=MODES, default='threads',
+                        help='How requests are served (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=ECHO_PORT,
+                        help='Port to listen at (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Worker threads of the threads mode, the most requests '
+                        'served at the same time (default: %(default)s)')
+    parser.add_argument('--log-requests', action='store_true',
+                        help='Log every request, off by default to keep probes cheap')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_argument()
+
+    # Set up logging
+    logging.basicConfig(level=logging.DEBUG if args.log_requests else logging.INFO)
 
+    server = create_server(args.mode, args.port, args.workers, args.log_requests)
+    logging.info("Server listening at host %s with port %d in %s mode",
+                 host_name, args.port, args.mode)
 
-try:
-    print("Use Control-C to exit")
-    server.serve_forever()
-except KeyboardInterrupt:
-    print("Exiting")
+    try:
+        print("Use Control-C to exit")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Exiting")
@@ -0,0 +1,25 @@
+""" XML-RPC transport of the echo clients, shared by echo_fanout.py in the
+    nodes and scripts/echo_client.py on the host
+"""
+try:
+    import xmlrpc.client as xmlrpclib
+except ImportError:
+    import xmlrpclib
+
+ECHO_PORT = 11881
+DEFAULT_TIMEOUT = 2.0
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """ Transport keeping its HTTP/1.1 connection open, with a timeout on
+        connecting and on every reply
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
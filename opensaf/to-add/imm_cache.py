@@ -0,0 +1,235 @@
+""" IMM model cache of long-running scaling tools. The AMF classes the scaling
+    decisions look at are kept in memory and indexed like an ImmSnapshot, and
+    they are kept up to date by the changes IMM notifies or by diffing them
+    with IMM every few seconds. A change bumps the version of the cache and of
+    its class, a caller compares the versions before and after a decision to
+    know whether it was made on current objects.
+    imm_offline.ImmModel is the local stand-in, it notifies the changes of the
+    CCBs applied to it:
+        model.subscribe(cache.apply_change)
+"""
+from __future__ import print_function
+import select
+import threading
+import traceback
+from collections import OrderedDict
+
+from imm_snapshot import ImmSnapshot, inst_iter
+
+try:
+    from pyosaf.saAis import eSaAisErrorT, eSaDispatchFlagsT
+    from pyosaf.utils.immoi.implementer import Applier
+except ImportError:
+    Applier = None
+
+CLASSES = ('SaAmfNode', 'SaAmfSU', 'SaAmfSI', 'SaAmfNodeGroup', 'SaAmfSIAssignment')
+# Runtime objects are not changed by CCBs, no applier is told about them
+RUNTIME_CLASSES = ('SaAmfSIAssignment',)
+POLL_INTERVAL = 5.0
+# Seconds between two checks that a listener is stopped
+LISTEN_INTERVAL = 1.0
+APPLIER_NAME = '@scalingCache'
+
+
+class ImmCache(ImmSnapshot):
+    """ ImmSnapshot whose watched classes are kept up to date by apply_change()
+        and refresh(). The other classes are read again after a change of one
+        of their objects is applied or the cache is refreshed, IMM does not
+        tell the applier about them.
+        The lists and indexes handed out are replaced on a change, not
+        modified, a caller may keep using what it read without the lock.
+    """
+
+    def __init__(self, iterator=inst_iter, class_names=CLASSES):
+        ImmSnapshot.__init__(self, iterator)
+        self.watched = tuple(class_names)
+        # Objects by DN of the watched classes read, in IMM order
+        self.instances = dict()
+        # Classes changed since they were indexed
+        self.dirty = set()
+        self.version = 0
+        self.versions = dict((class_name, 0) for class_name in self.watched)
+        self.lock = threading.RLock()
+
+    def objects(self, class_name):
+        with self.lock:
+            if class_name in self.dirty:
+                self.dirty.discard(class_name)
+                self.load(class_name, list(self.instances[class_name].values()))
+            elif class_name not in self.classes:
+                objects = self.read(class_name)
+                if class_name in self.watched:
+                    self.instances[class_name] = OrderedDict(
+                        (immobj.dn, immobj) for immobj in objects)
+                self.load(class_name, objects)
+            return self.classes[class_name]
+
+    def changed(self, class_name):
+        """ Count a change of a class, it is indexed again on its next read """
+        self.version += 1
+        self.versions[class_name] = self.versions.get(class_name, 0) + 1
+        if class_name in self.instances:
+            self.dirty.add(class_name)
+            return
+        self.forget([class_name])
+
+    def forget(self, class_names=None):
+        """ Drop classes which are not watched, all by default, they are read
+            again when next used
+        """
+        with self.lock:
+            class_names = [class_name for class_name in class_names or list(self.classes)
+                           if class_name in self.classes and class_name not in self.instances]
+            if not class_names:
+                return
+            by_dn = dict(self.by_dn)
+            for class_name in class_names:
+                for immobj in self.classes.pop(class_name):
+                    if by_dn.get(immobj.dn) is immobj:
+                        del by_dn[immobj.dn]
+            self.by_dn = by_dn
+
+    def class_of(self, dn):
+        immobj = self.by_dn.get(dn)
+        if immobj is not None:
+            return immobj.class_name
+        for class_name, instances in self.instances.items():
+            if dn in instances:
+                return class_name
+        return None
+
+    def apply_change(self, kind, dn, immobj=None):
+        """ Apply a change notified by IMM
+            params:
+                kind - create, modify or delete
+                immobj - the object after a create or modify
+            returns: True if the cache changed
+        """
+        with self.lock:
+            class_name = immobj.class_name if immobj is not None else self.class_of(dn)
+            if class_name not in self.instances:
+                if class_name in self.classes:
+                    self.changed(class_name)
+                    return True
+                # Not read yet, it is current when it is
+                return False
+            instances = self.instances[class_name]
+            if kind == 'delete':
+                if instances.pop(dn, None) is None:
+                    return False
+            else:
+                instances[dn] = immobj
+            self.changed(class_name)
+            return True
+
+    def refresh(self, class_names=None):
+        """ Read watched classes again and apply the objects created, modified
+            and deleted since they were read. The classes not watched are
+            dropped, their changes are not notified.
+            returns: the number of objects of watched classes changed
+        """
+        self.forget()
+        count = 0
+        for class_name in class_names or self.watched:
+            with self.lock:
+                if class_name not in self.instances:
+                    continue
+            # IMM is read without the lock, the cache is read meanwhile
+            current = OrderedDict((immobj.dn, immobj) for immobj in self.read(class_name))
+            with self.lock:
+                instances = self.instances[class_name]
+                changes = len([dn for dn in instances if dn not in current])
+                changes += len([dn for dn, immobj in current.items()
+                                if dn not in instances or instances[dn].attrs != immobj.attrs])
+                if changes:
+                    self.instances[class_name] = current
+                    self.changed(class_name)
+                    count += changes
+        return count
+
+    def stamp(self):
+        """ The versions of the classes now, see changed_since() """
+        with self.lock:
+            return dict(self.versions)
+
+    def changed_since(self, stamp, class_names=None):
+        """ Whether classes, all watched ones by default, changed since the stamp """
+        with self.lock:
+            return any(self.versions.get(class_name, 0) != stamp.get(class_name, 0)
+                       for class_name in class_names or self.watched)
+
+
+class Poller(threading.Thread):
+    """ Refreshes a cache every interval seconds, or at once when woken up """
+
+    def __init__(self, cache, interval=POLL_INTERVAL, class_names=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+        self.class_names = class_names
+        self.woken = threading.Event()
+        self.stopped = False
+
+    def wake(self):
+        self.woken.set()
+
+    def stop(self):
+        self.stopped = True
+        self.woken.set()
+
+    def run(self):
+        while not self.stopped:
+            self.woken.wait(self.interval)
+            self.woken.clear()
+            if self.stopped:
+                return
+            try:
+                self.cache.refresh(self.class_names)
+            except Exception:
+                # IMM may be unavailable for a while, e.g. during a failover
+                traceback.print_exc()
+
+
+class Listener(threading.Thread):
+    """ Wakes a poller up whenever a CCB changing a watched class is applied,
+        notified by an IMM applier. The classes are diffed by the poller rather
+        than in the callback, which runs while IMM applies the CCB.
+        start() raises RuntimeError if the applier cannot be set up.
+    """
+
+    def __init__(self, poller, name=APPLIER_NAME):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if Applier is None:
+            raise RuntimeError('pyosaf is not installed, IMM changes can only be polled')
+        class_names = [class_name for class_name in poller.class_names or poller.cache.watched
+                       if class_name not in RUNTIME_CLASSES]
+        self.name = name
+        self.applier = Applier(class_names=class_names, name=name,
+                               on_apply=lambda *args: poller.wake())
+        self.stopped = threading.Event()
+
+    def start(self):
+        rc = self.applier.init()
+        if rc != eSaAisErrorT.SA_AIS_OK:
+            raise RuntimeError('The IMM applier %s could not be set up: %s' %
+                               (self.name, eSaAisErrorT.whatis(rc)))
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        selection = self.applier.get_selection_object().value
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([selection], [], [], LISTEN_INTERVAL)
+            if not readable:
+                continue
+            rc = self.applier.dispatch(eSaDispatchFlagsT.SA_DISPATCH_ALL)
+            if rc != eSaAisErrorT.SA_AIS_OK:
+                # The poller still refreshes the cache every interval
+                print('The IMM applier %s stopped: %s' % (self.name, eSaAisErrorT.whatis(rc)))
+                return
@@ -0,0 +1,72 @@
+""" IMM distinguished names. A DN is a comma separated list of RDNs, most
+    specific first, a comma escaped with a backslash is part of its RDN, e.g.
+    safSupportedCsType=safVersion=1\\,safCSType=X,safComp=...
+    Parsed DNs are cached, a template DN is parsed once however many nodes
+    it is copied to.
+"""
+
+# Parsed DNs are dropped all at once when there are more
+MAX_PARSED = 100000
+_parsed = dict()
+
+
+def split_dn(dn):
+    """ The RDNs of a DN
+        returns: tuple of (attribute name, RDN) pairs, e.g. ('safSu', 'safSu=SU1')
+    """
+    rdns = _parsed.get(dn)
+    if rdns is None:
+        rdns = []
+        start = 0
+        index = dn.find(',')
+        while index >= 0:
+            if index > 0 and dn[index - 1] == '\\':
+                index = dn.find(',', index + 1)
+                continue
+            rdns.append(dn[start:index])
+            start = index + 1
+            index = dn.find(',', start)
+        rdns.append(dn[start:])
+        rdns = tuple((rdn.split('=', 1)[0], rdn) for rdn in rdns)
+        if len(_parsed) >= MAX_PARSED:
+            _parsed.clear()
+        _parsed[dn] = rdns
+    return rdns
+
+
+def parent_of(dn):
+    """ The parent DN of a DN, a comma escaped with a backslash is part of the RDN
+        returns: parent DN, None for a root object
+    """
+    index = dn.find(',')
+    while index > 0 and dn[index - 1] == '\\':
+        index = dn.find(',', index + 1)
+    if index < 0:
+        return None
+    return dn[index + 1:]
+
+
+def rdn_value(dn):
+    """ The value of the RDN of a DN, e.g. PL-3 for safNode=PL-3,safCluster=... """
+    parent = parent_of(dn)
+    rdn = dn[:len(dn) - len(parent) - 1] if parent else dn
+    return rdn.split('=', 1)[1]
+
+
+def split_rdn(dn):
+    """ The RDN and the parent DN of a DN
+        returns: RDN and parent DN, None for a root object
+    """
+    rdns = split_dn(dn)
+    return rdns[0][1], ','.join(rdn for _, rdn in rdns[1:]) or None
+
+
+def rewrite_dn(dn, replace):
+    """ A DN with the values of some RDNs replaced, in one pass over its RDNs
+        params:
+            replace - maps an RDN attribute name to a function of the RDN,
+                      e.g. 'safSu=SU1', returning the new value
+        returns: the new DN
+    """
+    return ','.join(rdn if name not in replace else '%s=%s' % (name, replace[name](rdn))
+                    for name, rdn in split_dn(dn))
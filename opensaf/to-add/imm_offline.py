@@ -0,0 +1,425 @@
+""" Offline IMM backend: an imm.xml export, e.g. the one immxml-configure
+    generates in setup-opensaf-node, loaded into memory. It serves the
+    InstanceIterator, ImmOmAccessor.get and Ccb calls of the scaling scripts
+    so they can be run, profiled and regression-tested without a cluster.
+"""
+from __future__ import print_function
+import copy
+import functools
+import xml.etree.ElementTree as ET
+from collections import Counter, OrderedDict
+
+from imm_dn import parent_of
+
+# SA_AIS_OK and SA_AIS_ERR_NOT_EXIST
+SUCCESS = 1
+NOT_EXIST = 12
+NUMBER_TYPES = {'SA_INT32_T': int, 'SA_UINT32_T': int, 'SA_INT64_T': int,
+                'SA_UINT64_T': int, 'SA_TIME_T': int, 'SA_FLOAT_T': float,
+                'SA_DOUBLE_T': float}
+# Attributes IMM adds to the objects read with SA_IMM_SEARCH_GET_CONFIG_ATTR
+SYSTEM_ATTRS = ['SaImmAttrAdminOwnerName', 'SaImmAttrClassName', 'SaImmAttrImplementerName']
+
+
+class eSaAmfRedundancyModelT(object):
+    """ The values of pyosaf.saAmf, for use without pyosaf """
+    SA_AMF_2N_REDUNDANCY_MODEL = 1
+    SA_AMF_NPM_REDUNDANCY_MODEL = 2
+    SA_AMF_N_WAY_REDUNDANCY_MODEL = 3
+    SA_AMF_N_WAY_ACTIVE_REDUNDANCY_MODEL = 4
+    SA_AMF_NO_REDUNDANCY_MODEL = 5
+
+
+class eSaAmfAdminOperationIdT(object):
+    """ The values of pyosaf.saAmf, for use without pyosaf """
+    SA_AMF_ADMIN_UNLOCK = 1
+    SA_AMF_ADMIN_LOCK = 2
+    SA_AMF_ADMIN_LOCK_INSTANTIATION = 3
+    SA_AMF_ADMIN_UNLOCK_INSTANTIATION = 4
+
+
+class OfflineImmError(Exception):
+    """ A CCB operation IMM would reject """
+
+
+class OfflineImmObject(object):
+    """ An IMM object with the attribute access of pyosaf's ImmObject:
+        attrs maps a name to [type, [values]], reading an attribute returns its
+        only value, the list of its values or None, setting one replaces its values
+    """
+
+    def __init__(self, dn, class_name, attrs, rdn_attribute):
+        self.__dict__['dn'] = dn
+        self.__dict__['class_name'] = class_name
+        self.__dict__['attrs'] = attrs
+        self.__dict__['rdn_attribute'] = rdn_attribute
+
+    def __getattr__(self, name):
+        attrs = self.__dict__.get('attrs', {})
+        if name not in attrs:
+            raise AttributeError(name)
+        attr_values = attrs[name][1]
+        if not attr_values:
+            return None
+        if len(attr_values) == 1:
+            return attr_values[0]
+        return attr_values
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            self.__dict__[name] = value
+            return
+        attr_values = list(value) if isinstance(value, (list, tuple)) else [value]
+        attr_type = self.attrs[name][0] if name in self.attrs else None
+        self.attrs[name] = [attr_type, attr_values]
+
+    def copy(self):
+        return OfflineImmObject(self.dn, self.class_name, copy.deepcopy(self.attrs),
+                                self.rdn_attribute)
+
+
+class ImmClass(object):
+    """ Definition of an IMM class: its RDN attribute and attribute types """
+
+    def __init__(self, name, rdn, attrs):
+        self.name = name
+        self.rdn = rdn
+        # name: (type, category)
+        self.attrs = attrs
+
+    def config_attrs(self):
+        return [name for name, (_, category) in self.attrs.items() if category == 'SA_CONFIG']
+
+
+def _text(element, tag, default=None):
+    child = element.find(tag)
+    return child.text if child is not None and child.text is not None else default
+
+
+def _instantiate(immobj):
+    """ Set the runtime attributes AMF sets on an instantiated object that the
+        scaling scripts read, an imm.xml has none of them
+    """
+    if immobj.class_name == 'SaAmfSU' and not immobj.attrs.get('saAmfSUHostedByNode', [0, []])[1]:
+        host = immobj.attrs.get('saAmfSUHostNodeOrNodeGroup', [0, []])[1]
+        if host and host[0].startswith('safAmfNode='):
+            immobj.attrs['saAmfSUHostedByNode'] = ['SA_NAME_T', [host[0]]]
+    return immobj
+
+
+def _convert(attr_type, text):
+    return NUMBER_TYPES[attr_type](text) if attr_type in NUMBER_TYPES else text
+
+
+class ImmModel(object):
+    """ The classes and objects of an imm.xml, changed by the CCBs applied to it.
+        Like IMM it notifies its changes, the subscribers are called with the
+        kind of change, create, modify or delete, the DN and a copy of the object
+        after a create or modify.
+    """
+
+    def __init__(self):
+        self.classes = dict()
+        self.objects = OrderedDict()
+        # IMM calls served by kind, and the operations of every applied CCB
+        self.calls = Counter()
+        self.ccb_sizes = []
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """ Call callback(kind, dn, immobj) for every change from now on """
+        self.subscribers.append(callback)
+
+    def notify(self, kind, dn):
+        immobj = self.objects.get(dn)
+        for callback in self.subscribers:
+            callback(kind, dn, immobj.copy() if immobj is not None else None)
+
+    @classmethod
+    def load(cls, path):
+        """ Read an imm.xml export
+            returns: ImmModel
+        """
+        model = cls()
+        for element in ET.parse(path).getroot():
+            tag = element.tag.split('}')[-1]
+            if tag == 'class':
+                attrs = dict()
+                rdn = element.find('rdn')
+                for attr in [rdn] + element.findall('attr'):
+                    attrs[_text(attr, 'name')] = (_text(attr, 'type'), _text(attr, 'category'))
+                model.classes[element.get('name')] = ImmClass(element.get('name'),
+                                                              _text(rdn, 'name'), attrs)
+            elif tag == 'object':
+                model.add_object(element)
+        return model
+
+    def add_object(self, element):
+        self.add(element.get('class'), _text(element, 'dn'),
+                 dict((_text(attr, 'name'), [value.text or '' for value in attr.findall('value')])
+                      for attr in element.findall('attr')))
+
+    def define(self, name, rdn, attrs):
+        """ Add a class, attrs maps an attribute name to (type, category) """
+        attrs = dict(attrs)
+        attrs.setdefault(rdn, ('SA_NAME_T', 'SA_CONFIG'))
+        self.classes[name] = ImmClass(name, rdn, attrs)
+
+    def add(self, class_name, dn, attr_values):
+        """ Add an object of a defined class, attr_values maps an attribute name
+            to a list of values, as text or of the type of the attribute
+        """
+        imm_class = self.classes[class_name]
+        parent = parent_of(dn)
+        rdn = dn[:len(dn) - len(parent) - 1] if parent else dn
+        attrs = dict()
+        for name, (attr_type, _) in imm_class.attrs.items():
+            attrs[name] = [attr_type, []]
+        attrs[imm_class.rdn][1] = [rdn]
+        for name, attr_values in attr_values.items():
+            attr_type = imm_class.attrs.get(name, ('SA_STRING_T', None))[0]
+            attrs[name] = [attr_type, [_convert(attr_type, value) for value in attr_values]]
+        kind = 'modify' if dn in self.objects else 'create'
+        self.objects[dn] = _instantiate(OfflineImmObject(dn, class_name, attrs, imm_class.rdn))
+        self.notify(kind, dn)
+
+    def remove(self, dn):
+        """ Remove an object without a CCB, e.g. a runtime object such as an SI
+            assignment
+        """
+        if self.objects.pop(dn, None) is not None:
+            self.notify('delete', dn)
+
+    def write(self, path):
+        """ Write the classes and the configuration objects as an imm.xml """
+        root = ET.Element('imm:IMM-contents', {
+            'xmlns:imm': 'http://www.saforum.org/IMMSchema',
+            'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance'})
+        for imm_class in self.classes.values():
+            element = ET.SubElement(root, 'class', {'name': imm_class.name})
+            for name, (attr_type, category) in sorted(imm_class.attrs.items()):
+                attr = ET.SubElement(element, 'rdn' if name == imm_class.rdn else 'attr')
+                ET.SubElement(attr, 'name').text = name
+                ET.SubElement(attr, 'type').text = attr_type
+                ET.SubElement(attr, 'category').text = category
+        for dn, immobj in self.objects.items():
+            imm_class = self.classes[immobj.class_name]
+            if imm_class.attrs[imm_class.rdn][1] != 'SA_CONFIG':
+                continue
+            element = ET.SubElement(root, 'object', {'class': immobj.class_name})
+            ET.SubElement(element, 'dn').text = dn
+            for name in sorted(imm_class.config_attrs()):
+                attr_values = immobj.attrs.get(name, [None, []])[1]
+                if name == imm_class.rdn or not attr_values:
+                    continue
+                attr = ET.SubElement(element, 'attr')
+                ET.SubElement(attr, 'name').text = name
+                for attr_value in attr_values:
+                    ET.SubElement(attr, 'value').text = str(attr_value)
+        ET.ElementTree(root).write(path)
+
+    def iterator(self, class_name, root_name=None):
+        """ Stand-in for InstanceIterator """
+        return OfflineIterator(self, class_name, root_name)
+
+    def accessor(self):
+        """ Stand-in for ImmOmAccessor """
+        return OfflineAccessor(self)
+
+    def ccb(self, flags=None, dry_run=False):
+        """ Stand-in for Ccb """
+        return OfflineCcb(self, flags, dry_run)
+
+    def apply(self, operations):
+        """ Apply the operations of a CCB, all or none of them """
+        self.calls['ccb apply'] += 1
+        self.ccb_sizes.append(len(operations))
+        objects = OrderedDict(self.objects)
+        # Child DNs by parent DN, built on the first delete
+        children = None
+        # The DNs changed, in the order of the operations
+        changed = OrderedDict()
+        for operation in operations:
+            kind, dn = operation[0], operation[1]
+            self.calls['ccb ' + kind] += 1
+            if kind == 'create':
+                immobj = operation[2]
+                parent = parent_of(dn)
+                if dn in objects:
+                    raise OfflineImmError('Object exists: %s' % dn)
+                if parent and parent not in objects:
+                    raise OfflineImmError('No parent of %s' % dn)
+                objects[dn] = _instantiate(immobj)
+                changed[dn] = None
+                if children is not None:
+                    children.setdefault(parent, []).append(dn)
+            elif kind == 'delete':
+                if dn not in objects:
+                    raise OfflineImmError('No object %s' % dn)
+                if children is None:
+                    children = dict()
+                    for child in objects:
+                        children.setdefault(parent_of(child), []).append(child)
+                # The subtree of the object goes with it
+                subtree = [dn]
+                while subtree:
+                    child = subtree.pop()
+                    if objects.pop(child, None) is not None:
+                        changed[child] = None
+                        subtree.extend(children.get(child, []))
+            else:
+                if dn not in objects:
+                    raise OfflineImmError('No object %s' % dn)
+                immobj = objects[dn] = objects[dn].copy()
+                changed[dn] = None
+                attr_name, value = operation[2], operation[3]
+                attr = immobj.attrs.setdefault(attr_name, [None, []])
+                if kind == 'add':
+                    attr[1].append(value)
+                elif kind == 'delete-value':
+                    if value not in attr[1]:
+                        raise OfflineImmError('%s of %s has no value %s' % (attr_name, dn, value))
+                    attr[1].remove(value)
+                else:
+                    attr[1] = [value]
+        before = self.objects
+        self.objects = objects
+        for dn in changed:
+            if dn not in objects:
+                if dn in before:
+                    self.notify('delete', dn)
+            else:
+                self.notify('create' if dn not in before else 'modify', dn)
+
+
+class OfflineIterator(object):
+    """ The objects of a class, under root_name when set """
+
+    def __init__(self, model, class_name, root_name=None):
+        self.model = model
+        self.class_name = class_name
+        self.root_name = root_name
+        self.objects = None
+
+    def init(self):
+        self.model.calls['iterator'] += 1
+        suffix = ',' + self.root_name if self.root_name else None
+        self.objects = [immobj.copy() for dn, immobj in self.model.objects.items()
+                        if immobj.class_name == self.class_name and
+                        (not suffix or dn == self.root_name or dn.endswith(suffix))]
+        return SUCCESS
+
+    def __iter__(self):
+        return iter(self.objects)
+
+
+class OfflineAccessor(object):
+    """ Reads single objects of the model """
+
+    def __init__(self, model):
+        self.model = model
+
+    def init(self):
+        return SUCCESS
+
+    def get(self, object_name, attr_name_list=None):
+        """ returns: result code and a copy of the object, None if there is none """
+        self.model.calls['get'] += 1
+        immobj = self.model.objects.get(object_name)
+        if immobj is None:
+            return NOT_EXIST, None
+        immobj = immobj.copy()
+        for name in SYSTEM_ATTRS:
+            immobj.attrs[name] = ['SA_STRING_T', [immobj.class_name] if name == 'SaImmAttrClassName'
+                                  else []]
+        if attr_name_list and 'SA_IMM_SEARCH_GET_CONFIG_ATTR' in attr_name_list:
+            imm_class = self.model.classes.get(immobj.class_name)
+            if imm_class:
+                keep = set(imm_class.config_attrs()) | set(SYSTEM_ATTRS)
+                for name in list(immobj.attrs):
+                    if name not in keep:
+                        del immobj.attrs[name]
+        return SUCCESS, immobj
+
+
+class OfflineCcb(object):
+    """ Collects the operations of a CCB and applies them to the model, or only
+        prints them with dry_run. Without a model it is a dry run of a live IMM.
+    """
+
+    def __init__(self, model=None, flags=None, dry_run=False):
+        self.model = model
+        self.dry_run = dry_run or model is None
+        self.operations = []
+
+    def init(self):
+        return SUCCESS
+
+    def create(self, obj, parent_name=None):
+        rdn = obj.attrs[obj.rdn_attribute][1][0]
+        dn = '%s,%s' % (rdn, parent_name) if parent_name else rdn
+        immobj = OfflineImmObject(dn, obj.class_name, copy.deepcopy(obj.attrs), obj.rdn_attribute)
+        self.operations.append(('create', dn, immobj))
+
+    def delete(self, object_name):
+        self.operations.append(('delete', object_name))
+
+    def modify_value_add(self, object_name, attr_name, value):
+        self.operations.append(('add', object_name, attr_name, value))
+
+    def modify_value_delete(self, object_name, attr_name, value):
+        self.operations.append(('delete-value', object_name, attr_name, value))
+
+    def modify_value_replace(self, object_name, attr_name, value):
+        self.operations.append(('replace', object_name, attr_name, value))
+
+    def apply(self):
+        if self.dry_run:
+            print('-CCB (dry run), %d operations:' % len(self.operations))
+            for operation in self.operations:
+                print('  ' + describe(operation))
+        if self.model is not None and not self.dry_run:
+            self.model.apply(self.operations)
+        return SUCCESS
+
+
+def describe(operation):
+    """ One line of a CCB operation, as printed by a dry run """
+    if operation[0] == 'create':
+        return 'create %s %s' % (operation[2].class_name, operation[1])
+    if operation[0] == 'delete':
+        return 'delete %s' % operation[1]
+    sign = {'add': '+=', 'delete-value': '-=', 'replace': '='}[operation[0]]
+    return 'modify %s %s %s %s' % (operation[1], operation[2], sign, operation[3])
+
+
+def print_command(command):
+    """ Stand-in for subprocess.call of the admin commands of a dry or offline run """
+    print('  would run: %s' % ' '.join(command))
+    return 0
+
+
+def backends(metrics, inst_iter, accessor_class, ccb_class, model=None, dry_run=False):
+    """ The IMM and admin command backends of a scaling script, all timed by
+        metrics: the IMM of the cluster through the pyosaf classes given, an
+        ImmModel, or printing the CCB operations and admin commands instead of
+        applying them with dry_run
+        returns: iterator and Ccb factories, admin command runner and the
+                 initialized accessor
+        raises: RuntimeError if pyosaf is not installed, the classes are None,
+                and there is no model
+    """
+    admin_call = None
+    if model is not None:
+        inst_iter, accessor_class = model.iterator, model.accessor
+        ccb_class = functools.partial(model.ccb, dry_run=dry_run)
+        admin_call = print_command
+    elif accessor_class is None:
+        raise RuntimeError('pyosaf is not installed, only --imm-xml can be scaled')
+    elif dry_run:
+        ccb_class = OfflineCcb
+        admin_call = print_command
+    accessor = metrics.accessor(accessor_class())
+    accessor.init()
+    return (metrics.iterator(inst_iter), metrics.ccb(ccb_class), metrics.command(admin_call),
+            accessor)
@@ -0,0 +1,184 @@
+""" In-memory snapshot of the IMM classes the scaling scripts look at.
+    Every class is read once with one InstanceIterator and indexed by DN,
+    by ancestor DN, by hosting node, by protecting SG and by node group member.
+"""
+import copy
+
+from imm_dn import parent_of, rdn_value
+
+try:
+    from pyosaf.utils.immom.iterator import InstanceIterator as inst_iter
+except ImportError:
+    # Offline, the iterator of an imm_offline.ImmModel is passed in
+    inst_iter = None
+
+
+def values(immobj, attr_name):
+    """ All values of an attribute as a list, also for single-valued ones """
+    attr = immobj.attrs.get(attr_name)
+    if not attr or not attr[1]:
+        return []
+    return list(attr[1])
+
+
+def value(immobj, attr_name):
+    """ The first value of an attribute, None when it has none """
+    attr_values = values(immobj, attr_name)
+    return attr_values[0] if attr_values else None
+
+
+def clone_object(immobj):
+    """ A copy of an ImmObject with its own attributes, made without going through
+        the attribute lookup of ImmObject
+    """
+    clone = object.__new__(type(immobj))
+    clone.__dict__.update(immobj.__dict__)
+    clone.__dict__['attrs'] = copy.deepcopy(immobj.attrs)
+    return clone
+
+
+class ImmSnapshot(object):
+    """ Objects of IMM classes read on first use and indexed. An index is
+        replaced when a class is indexed again, not modified.
+    """
+
+    def __init__(self, iterator=inst_iter):
+        self.iterator = iterator
+        self.classes = dict()
+        self.by_dn = dict()
+        self.by_ancestor = dict()
+        self.sus_by_node = dict()
+        self.sis_by_sg = dict()
+        self.nodes_by_hostname = dict()
+        self.groups_by_node = dict()
+
+    def objects(self, class_name):
+        """ All objects of a class in IMM order, read once
+            returns: list of ImmObjects
+        """
+        if class_name not in self.classes:
+            self.load(class_name, self.read(class_name))
+        return self.classes[class_name]
+
+    def read(self, class_name):
+        """ All objects of a class read from IMM
+            returns: list of ImmObjects
+        """
+        _iter = self.iterator(class_name)
+        _iter.init()
+        return list(_iter)
+
+    def load(self, class_name, objects):
+        """ Index the objects of a class, replacing the ones indexed before """
+        by_dn = dict(self.by_dn)
+        for immobj in self.classes.get(class_name, []):
+            if by_dn.get(immobj.dn) is immobj:
+                del by_dn[immobj.dn]
+        by_ancestor = dict()
+        for immobj in objects:
+            by_dn[immobj.dn] = immobj
+            parent = parent_of(immobj.dn)
+            while parent:
+                by_ancestor.setdefault(parent, []).append(immobj)
+                parent = parent_of(parent)
+        self.by_dn = by_dn
+        self.by_ancestor[class_name] = by_ancestor
+        self.classes[class_name] = objects
+        self.index(class_name, objects)
+
+    def index(self, class_name, objects):
+        """ Build the attribute indexes of a class """
+        if class_name == 'SaAmfSU':
+            sus_by_node = dict()
+            for itsu in objects:
+                sus_by_node.setdefault(value(itsu, 'saAmfSUHostedByNode'), []).append(itsu)
+            self.sus_by_node = sus_by_node
+        elif class_name == 'SaAmfSI':
+            sis_by_sg = dict()
+            for itsi in objects:
+                sis_by_sg.setdefault(value(itsi, 'saAmfSIProtectedbySG'), []).append(itsi)
+            self.sis_by_sg = sis_by_sg
+        elif class_name == 'SaAmfNode':
+            nodes_by_hostname = dict()
+            for node in objects:
+                clmnode_dn = value(node, 'saAmfNodeClmNode')
+                if clmnode_dn:
+                    nodes_by_hostname.setdefault(rdn_value(clmnode_dn), node)
+            self.nodes_by_hostname = nodes_by_hostname
+        elif class_name == 'SaAmfNodeGroup':
+            groups_by_node = dict()
+            for ngrp in objects:
+                for node_dn in values(ngrp, 'saAmfNGNodeList'):
+                    groups_by_node.setdefault(node_dn, []).append(ngrp)
+            self.groups_by_node = groups_by_node
+
+    def get(self, class_name, dn):
+        """ The object of a class with a DN, None if there is none """
+        self.objects(class_name)
+        immobj = self.by_dn.get(dn)
+        if immobj is not None and immobj.class_name != class_name:
+            return None
+        return immobj
+
+    def under(self, class_name, parent_list):
+        """ Objects of a class anywhere below the parents, like an
+            InstanceIterator rooted at each parent
+            returns: list of ImmObjects
+        """
+        self.objects(class_name)
+        by_ancestor = self.by_ancestor[class_name]
+        result = []
+        for par in parent_list:
+            result.extend(by_ancestor.get(par.dn, []))
+        return result
+
+    def sus_hosted_by(self, amfnode_dn):
+        self.objects('SaAmfSU')
+        return self.sus_by_node.get(amfnode_dn, [])
+
+    def su_hostnames(self):
+        """ The names of the AMF nodes hosting SUs """
+        self.objects('SaAmfSU')
+        return set(rdn_value(node_dn) for node_dn in self.sus_by_node if node_dn)
+
+    def sis_protected_by(self, sg_dn):
+        self.objects('SaAmfSI')
+        return self.sis_by_sg.get(sg_dn, [])
+
+    def node_of_host(self, hostname):
+        """ The AMF node whose CLM node is named hostname, None if there is none """
+        self.objects('SaAmfNode')
+        return self.nodes_by_hostname.get(hostname)
+
+    def node_groups_of(self, amfnode_dn):
+        self.objects('SaAmfNodeGroup')
+        return self.groups_by_node.get(amfnode_dn, [])
+
+
+class ImmReadCache(object):
+    """ Objects read with accessor.get, kept for the duration of one scaling
+        operation. The cached objects are shared, callers must not modify them.
+    """
+
+    def __init__(self, accessor):
+        self.accessor = accessor
+        self.objects = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dn, attr_names=None):
+        """ Same as accessor.get, an object is read once per set of attribute names
+            returns: result code and ImmObject
+        """
+        key = (dn, tuple(sorted(attr_names)) if attr_names else None)
+        if key in self.objects:
+            self.hits += 1
+            return self.objects[key]
+        self.misses += 1
+        result = self.accessor.get(dn, attr_names) if attr_names else self.accessor.get(dn)
+        if result[1] is not None:
+            self.objects[key] = result
+        return result
+
+    def __str__(self):
+        return '{0} hits, {1} misses'.format(self.hits, self.misses)
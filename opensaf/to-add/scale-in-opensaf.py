@@ -9,12 +9,22 @@ import hashlib
 import time
 import argparse
 import os
-import subprocess
+import cProfile
 
-from pyosaf.utils.immom.accessor import ImmOmAccessor
-from pyosaf.utils.immom.ccb import Ccb
-from pyosaf.utils.immom.iterator import InstanceIterator as inst_iter
-from pyosaf.saAmf import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+try:
+    from pyosaf.utils.immom.accessor import ImmOmAccessor
+    from pyosaf.utils.immom.ccb import Ccb
+    from pyosaf.utils.immom.iterator import InstanceIterator as inst_iter
+    from pyosaf.saAmf import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+except ImportError:
+    # Without pyosaf only an imm.xml can be scaled, see --imm-xml
+    ImmOmAccessor = Ccb = inst_iter = None
+    from imm_offline import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+
+from imm_offline import ImmModel, backends
+from imm_snapshot import ImmSnapshot, ImmReadCache, parent_of, values
+from amf_admin import run_jobs, DEFAULT_WORKERS
+from scale_metrics import ScaleMetrics, LOG_PATH
 
 
 TWO_N = eSaAmfRedundancyModelT.SA_AMF_2N_REDUNDANCY_MODEL
@@ -25,32 +35,29 @@ ADMIN_LOCK = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_LOCK
 ADMIN_LOCK_IN = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_LOCK_INSTANTIATION
 ADMIN_UNLOCK_IN = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_UNLOCK_INSTANTIATION
 accessor = None
+# Runs the admin commands, subprocess.call unless offline or dry run
+admin_call = None
+# IMM classes and objects read once per scale-in, see scale_in()
+snapshot = None
+cache = None
+# Phase timers and call histograms, the IMM and admin calls are timed in main
+metrics = ScaleMetrics('scale-in')
 
 
 def find_object_type(class_name, parent_list):
     """ Find objects of a certain class under a parent list
         return: list of ImmObjects
     """
-    result = []
-    for par in parent_list:
-        _iter = inst_iter(class_name, par.dn)
-        _iter.init()
-        for immobj in _iter:
-            result.append(immobj)
-    return result
+    return snapshot.under(class_name, parent_list)
 
 
 def find_node_dns(hostname):
     """ Find the DNs of CLM and AMF node for the hostname
         returns: AMF node DN and CLM node DN
     """
-    _iter = inst_iter('SaAmfNode')
-    _iter.init()
-    for node in _iter:
-        # Get the first value part of the DN
-        hname = node.saAmfNodeClmNode.split(',')[0].split('=')[1]
-        if hname == hostname:
-            return node.dn, node.saAmfNodeClmNode
+    node = snapshot.node_of_host(hostname)
+    if node is not None:
+        return node.dn, node.saAmfNodeClmNode
     raise Exception('Could not find IMM object for hostname [%s]' % hostname)
 
 
@@ -60,9 +67,9 @@ def redundancy_of_su(su_dn):
     """
     # Get the SG DN from the SU DN
     sg_of_su = su_dn.split(',', 1)[1]
-    _, itsg = accessor.get(sg_of_su)
+    _, itsg = cache.get(sg_of_su)
     # Get the redundancy from the SG type
-    _, itsg_t = accessor.get(itsg.saAmfSGType)
+    _, itsg_t = cache.get(itsg.saAmfSGType)
     return itsg_t.saAmfSgtRedundancyModel
 
 
@@ -70,14 +77,8 @@ def find_sus(amfnode_dn, scalable_redundancy):
     """ Find all SUs hosted by a AMF node matching some redundancy models
         returns: list of SUs (ImmObject)
     """
-    sus = []
-    _iter = inst_iter('SaAmfSU')
-    _iter.init()
-    for itsu in _iter:
-        if amfnode_dn == itsu.saAmfSUHostedByNode:
-            if redundancy_of_su(itsu.dn) in scalable_redundancy:
-                sus.append(itsu)
-    return sus
+    return [itsu for itsu in snapshot.sus_hosted_by(amfnode_dn)
+            if redundancy_of_su(itsu.dn) in scalable_redundancy]
 
 
 def find_sis_apps(sus, redundancy):
@@ -88,8 +89,6 @@ def find_sis_apps(sus, redundancy):
     matched_sus = []
     matched_sgs = []
     matched_apps = []
-    protected_sis = []
-    su_svctypes = []
 
     # Collect the SUs, SGs and Apps of a certain redundancy
     for itsu in sus:
@@ -103,105 +102,164 @@ def find_sis_apps(sus, redundancy):
     matched_apps = sorted(set(matched_apps), key=matched_apps.index)
 
     # Collect the SIs protected by the SGs
-    _iter = inst_iter('SaAmfSI')
-    _iter.init()
-    for itsi in _iter:
-        if itsi.saAmfSIProtectedbySG in matched_sgs:
-            protected_sis.append(itsi)
+    matched_sgs = sorted(set(matched_sgs), key=matched_sgs.index)
+    protected_sis = [itsi for sg_dn in matched_sgs for itsi in snapshot.sis_protected_by(sg_dn)]
 
     # Collect the SvcTypes of the SUs
+    su_svctypes = set()
     for itsu in matched_sus:
-        _, su_type = accessor.get(itsu.saAmfSUType)
-        for svc_type in su_type.saAmfSutProvidesSvcTypes:
-            su_svctypes.append(svc_type)
+        _, su_type = cache.get(itsu.saAmfSUType)
+        su_svctypes.update(values(su_type, 'saAmfSutProvidesSvcTypes'))
 
     # Match SvcType in SU and SI
-    result_sis = []
-    for itsi in protected_sis:
-        if itsi.saAmfSvcType in su_svctypes:
-            result_sis.append(itsi)
+    result_sis = [itsi for itsi in protected_sis if itsi.saAmfSvcType in su_svctypes]
 
     return result_sis, matched_apps
 
 
 def find_node_groups(amf_node):
     """ fetch all node groups a node belongs to """
-    matching_groups = []
-    _iter = inst_iter('SaAmfNodeGroup')
-    _iter.init()
-    for ngrp in _iter:
-        if str.find(''.join(ngrp.saAmfNGNodeList), amf_node) >= 0:
-            matching_groups.append(ngrp)
-    return matching_groups
-
+    return snapshot.node_groups_of(amf_node)
 
-def scale_in(hostname):
-    """ Remove the configuration for the host node """
-    print('-Scaling in: %s' % hostname)
-    amfnode_dn, clmnode_dn = find_node_dns(hostname)
-    _, clmnode = accessor.get(clmnode_dn)
-    _, amfnode = accessor.get(amfnode_dn)
 
-    print("lock/lock-in %s %s" % (clmnode_dn, amfnode_dn))
-    subprocess.call(['amf-adm', 'lock', clmnode_dn])
-    subprocess.call(['amf-adm', 'lock', amfnode_dn])
-    subprocess.call(['amf-adm', 'lock-in', amfnode_dn])
+def scale_in(hostnames, workers=DEFAULT_WORKERS, view=None):
+    """ Remove the configuration for the host nodes
+        params:
+            hostnames - hostnames of the nodes to remove
+            workers - most admin operations run at the same time
+            view - ImmSnapshot to read IMM through, e.g. an imm_cache.ImmCache
+                   kept up to date, a new snapshot by default
+    """
+    if isinstance(hostnames, str):
+        hostnames = [hostnames]
+    print('-Scaling in: %s' % ', '.join(hostnames))
+    global snapshot, cache
+    snapshot = view or ImmSnapshot(inst_iter)
+    cache = ImmReadCache(accessor)
+    nodes = []
+    with metrics.phase('find nodes'):
+        for hostname in hostnames:
+            amfnode_dn, clmnode_dn = find_node_dns(hostname)
+            if (amfnode_dn, clmnode_dn) not in nodes:
+                nodes.append((amfnode_dn, clmnode_dn))
+
+    # The commands of one object depend on each other, the objects do not
+    for amfnode_dn, clmnode_dn in nodes:
+        print("lock/lock-in %s %s" % (clmnode_dn, amfnode_dn))
+    with metrics.phase('lock nodes'):
+        run_jobs([[['amf-adm', 'lock', clmnode_dn],
+                   ['amf-adm', 'lock', amfnode_dn],
+                   ['amf-adm', 'lock-in', amfnode_dn]] for amfnode_dn, clmnode_dn in nodes],
+                 workers, admin_call)
+
+    with metrics.phase('find sus'):
+        node_sus = [find_sus(amfnode_dn, [TWO_N, NWAYACTIVE, NORED]) for amfnode_dn, _ in nodes]
+    sus = [itsu for sus_of_node in node_sus for itsu in sus_of_node]
+    for itsu in sus:
+        print(itsu.dn)
+    with metrics.phase('lock sus'):
+        run_jobs([[['amf-adm', 'lock', itsu.dn], ['amf-adm', 'lock-in', itsu.dn]]
+                  for itsu in sus], workers, admin_call)
+
+    print('-Stop opensafd on %s' % ', '.join(hostnames))
+    with metrics.phase('stop nodes'):
+        run_jobs([[["immadm", "-o", "5", "-p", "saClmAction:SA_STRING_T:stop", clmnode_dn]]
+                  for _, clmnode_dn in nodes], workers, admin_call)
+
+    # All the configuration goes away in one CCB, the SUs before the SIs and
+    # the nodes after everything referring to them
+    with metrics.phase('delete'):
+        ccb = delete_operations(nodes, node_sus, sus)
+    with metrics.phase('ccb apply'):
+        ccb.apply()
+    print('-IMM reads: %s' % cache)
+    print('-Scaling in done')
 
-    sus = find_sus(amfnode_dn, [TWO_N, NWAYACTIVE, NORED])
 
+def delete_operations(nodes, node_sus, sus):
+    """ The CCB deleting the nodes, their SUs and the SIs left unassigned
+        returns: Ccb, not applied
+    """
     ccb = Ccb(flags=None)
     ccb.init()
-
     for itsu in sus:
-        print(itsu.dn)
-        subprocess.call(['amf-adm', 'lock', itsu.dn])
-        subprocess.call(['amf-adm', 'lock-in', itsu.dn])
         ccb.delete(itsu.dn)
 
-    print('-Stop opensafd on %s' % hostname)
-    subprocess.call(["immadm", "-o", "5", "-p", "saClmAction:SA_STRING_T:stop", clmnode_dn])
-
-    sis, apps = find_sis_apps(sus, NORED)
-    for itsi in sis:
-        # Check if this SI has a assignment
-        siass = inst_iter('SaAmfSIAssignment')
-        siass.init()
-        assigned = [ass for ass in siass if str.find(ass.dn, itsi.dn) != -1]
+    # The SIs still assigned once the SUs are locked, read in one pass. An
+    # assignment is a child of its SI.
+    siass = inst_iter('SaAmfSIAssignment')
+    siass.init()
+    assigned_sis = set(parent_of(ass.dn) for ass in siass)
 
+    deleted_sis = set()
+    for sus_of_node in node_sus:
+        sis, apps = find_sis_apps(sus_of_node, NORED)
         # Check if the SU App is used by this SI... Why? Not sure, the example
         # I followed did even more stuff here. TODO: Investigate why.
-        usedapp = [app for app in apps if str.find(itsi.dn, app) != -1]
-        si_app = itsi.dn.split(',')[1:][0]  # Last split is the SI App
-        if not assigned and usedapp and si_app in apps:
-            csis = find_object_type('SaAmfCSI', [itsi])
-            for csi in csis:
-                print(csi.dn)
-                ccb.delete(csi.dn)
-            print(itsi.dn)
-            ccb.delete(itsi.dn)
+        apps = set(apps)
+        for itsi in sis:
+            if itsi.dn in deleted_sis:
+                continue
+            if itsi.dn not in assigned_sis and parent_of(itsi.dn) in apps:
+                csis = find_object_type('SaAmfCSI', [itsi])
+                for csi in csis:
+                    print(csi.dn)
+                    ccb.delete(csi.dn)
+                print(itsi.dn)
+                ccb.delete(itsi.dn)
+                deleted_sis.add(itsi.dn)
 
     print("-Update node groups")
-    node_groups = find_node_groups(amfnode_dn)
-    for ngr in node_groups:
-        ccb.modify_value_delete(ngr.dn, "saAmfNGNodeList", amfnode_dn)
+    for amfnode_dn, _ in nodes:
+        node_groups = find_node_groups(amfnode_dn)
+        for ngr in node_groups:
+            ccb.modify_value_delete(ngr.dn, "saAmfNGNodeList", amfnode_dn)
 
-    ccb.delete(amfnode.dn)
-    ccb.delete(clmnode.dn)
-
-    ccb.apply()
-    print('-Scaling in done')
+    for amfnode_dn, clmnode_dn in nodes:
+        ccb.delete(amfnode_dn)
+        ccb.delete(clmnode_dn)
+    return ccb
 
 
 if __name__ == '__main__':
-    accessor = ImmOmAccessor()
-    accessor.init()
-
     parser = argparse.ArgumentParser(
         description='Scales OpenSAF by adding and removing node configuration')
     parser.add_argument(
-        '--hostname', type=str, required=True,
-        help='Hostname for the new node.')
+        '--hostname', type=str, required=True, nargs='+',
+        help='Hostnames of the nodes to remove.')
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='Number of admin operations run at the same time.')
+    parser.add_argument(
+        '--imm-xml', type=str, default=None,
+        help='Scale the model of an imm.xml export in memory instead of the IMM '
+        'of the cluster.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Print the CCB operations and admin commands instead of applying them.')
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help='Print the phase times and IMM call histograms as JSON.')
+    parser.add_argument(
+        '--log-file', type=str, default=LOG_PATH,
+        help='File the metrics are appended to as a line of JSON, none if empty.')
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help='Write cProfile statistics of the scale-in to this file.')
 
     args = parser.parse_args()
 
-    scale_in(args.hostname)
+    try:
+        model = ImmModel.load(args.imm_xml) if args.imm_xml else None
+        inst_iter, Ccb, admin_call, accessor = backends(metrics, inst_iter, ImmOmAccessor, Ccb,
+                                                        model, args.dry_run)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(scale_in, args.hostname, args.workers)
+        profiler.dump_stats(args.profile)
+    else:
+        scale_in(args.hostname, args.workers)
+    metrics.report(args.log_file, args.metrics, hostnames=args.hostname)
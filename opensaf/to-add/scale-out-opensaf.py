@@ -5,17 +5,28 @@
 """
 
 from __future__ import print_function
-import re
 import hashlib
 import time
 import argparse
 import os
-import subprocess
-
-from pyosaf.utils.immom.accessor import ImmOmAccessor
-from pyosaf.utils.immom.ccb import Ccb
-from pyosaf.utils.immom.iterator import InstanceIterator as inst_iter
-from pyosaf.saAmf import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+import cProfile
+from collections import namedtuple
+
+try:
+    from pyosaf.utils.immom.accessor import ImmOmAccessor
+    from pyosaf.utils.immom.ccb import Ccb
+    from pyosaf.utils.immom.iterator import InstanceIterator as inst_iter
+    from pyosaf.saAmf import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+except ImportError:
+    # Without pyosaf only an imm.xml can be scaled, see --imm-xml
+    ImmOmAccessor = Ccb = inst_iter = None
+    from imm_offline import eSaAmfRedundancyModelT, eSaAmfAdminOperationIdT
+
+from imm_offline import ImmModel, backends
+from imm_dn import rewrite_dn, split_rdn
+from imm_snapshot import ImmSnapshot, ImmReadCache, clone_object, values
+from amf_admin import run_jobs
+from scale_metrics import ScaleMetrics, LOG_PATH
 
 
 TWO_N = eSaAmfRedundancyModelT.SA_AMF_2N_REDUNDANCY_MODEL
@@ -25,7 +36,20 @@ ADMIN_UNLOCK = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_UNLOCK
 ADMIN_LOCK = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_LOCK
 ADMIN_LOCK_IN = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_LOCK_INSTANTIATION
 ADMIN_UNLOCK_IN = eSaAmfAdminOperationIdT.SA_AMF_ADMIN_UNLOCK_INSTANTIATION
+ALLOWED_CLASSES = ['SaAmfNode', 'SaClmNode', 'SaAmfSU', 'SaAmfSI', 'SaAmfCSI', 'SaAmfComp',
+                   'SaAmfCompCsType', 'SaAmfNodeSwBundle', 'SaAmfHealthcheck', 'SaAmfCSIAttribute']
 accessor = None
+# Runs the admin commands, subprocess.call unless offline or dry run
+admin_call = None
+# IMM classes and objects read once per scale-out, see scale_out()
+snapshot = None
+cache = None
+# Phase timers and call histograms, the IMM and admin calls are timed in main
+metrics = ScaleMetrics('scale-out')
+
+# The objects of a template node prepared for write, with the SUs the node
+# hosted when it was read
+Template = namedtuple('Template', 'amfnode_dn conf_objects nodegroups su_dns read_at')
 
 
 def print_object(immobj, new_dn=None):
@@ -34,7 +58,7 @@ def print_object(immobj, new_dn=None):
         print(new_dn)
     else:
         print(immobj.dn)
-    for key, value in immobj.attrs.iteritems():
+    for key, value in immobj.attrs.items():
         val = ''
         if value[1]:
             val = value[1]
@@ -48,26 +72,16 @@ def find_object_type(class_name, parent_list):
     """ Find objects of a certain class under a parent list
         return: list of ImmObjects
     """
-    result = []
-    for par in parent_list:
-        _iter = inst_iter(class_name, par.dn)
-        _iter.init()
-        for immobj in _iter:
-            result.append(immobj)
-    return result
+    return snapshot.under(class_name, parent_list)
 
 
 def find_node_dns(hostname):
     """ Find the DNs of CLM and AMF node for the hostname
         returns: AMF node DN and CLM node DN
     """
-    _iter = inst_iter('SaAmfNode')
-    _iter.init()
-    for node in _iter:
-        # Get the first value part of the DN
-        hname = node.saAmfNodeClmNode.split(',')[0].split('=')[1]
-        if hname == hostname:
-            return node.dn, node.saAmfNodeClmNode
+    node = snapshot.node_of_host(hostname)
+    if node is not None:
+        return node.dn, node.saAmfNodeClmNode
     raise Exception('Could not find IMM object for hostname [%s]' % hostname)
 
 
@@ -77,9 +91,9 @@ def redundancy_of_su(su_dn):
     """
     # Get the SG DN from the SU DN
     sg_of_su = su_dn.split(',', 1)[1]
-    _, itsg = accessor.get(sg_of_su)
+    _, itsg = cache.get(sg_of_su)
     # Get the redundancy from the SG type
-    _, itsg_t = accessor.get(itsg.saAmfSGType)
+    _, itsg_t = cache.get(itsg.saAmfSGType)
     return itsg_t.saAmfSgtRedundancyModel
 
 
@@ -87,14 +101,8 @@ def find_sus(amfnode_dn, scalable_redundancy):
     """ Find all SUs hosted by a AMF node matching some redundancy models
         returns: list of SUs (ImmObject)
     """
-    sus = []
-    _iter = inst_iter('SaAmfSU')
-    _iter.init()
-    for itsu in _iter:
-        if amfnode_dn == itsu.saAmfSUHostedByNode:
-            if redundancy_of_su(itsu.dn) in scalable_redundancy:
-                sus.append(itsu)
-    return sus
+    return [itsu for itsu in snapshot.sus_hosted_by(amfnode_dn)
+            if redundancy_of_su(itsu.dn) in scalable_redundancy]
 
 
 def find_sis_apps(sus, redundancy):
@@ -105,8 +113,6 @@ def find_sis_apps(sus, redundancy):
     matched_sus = []
     matched_sgs = []
     matched_apps = []
-    protected_sis = []
-    su_svctypes = []
 
     # Collect the SUs, SGs and Apps of a certain redundancy
     for itsu in sus:
@@ -120,23 +126,17 @@ def find_sis_apps(sus, redundancy):
     matched_apps = sorted(set(matched_apps), key=matched_apps.index)
 
     # Collect the SIs protected by the SGs
-    _iter = inst_iter('SaAmfSI')
-    _iter.init()
-    for itsi in _iter:
-        if itsi.saAmfSIProtectedbySG in matched_sgs:
-            protected_sis.append(itsi)
+    matched_sgs = sorted(set(matched_sgs), key=matched_sgs.index)
+    protected_sis = [itsi for sg_dn in matched_sgs for itsi in snapshot.sis_protected_by(sg_dn)]
 
     # Collect the SvcTypes of the SUs
+    su_svctypes = set()
     for itsu in matched_sus:
-        _, su_type = accessor.get(itsu.saAmfSUType)
-        for svc_type in su_type.saAmfSutProvidesSvcTypes:
-            su_svctypes.append(svc_type)
+        _, su_type = cache.get(itsu.saAmfSUType)
+        su_svctypes.update(values(su_type, 'saAmfSutProvidesSvcTypes'))
 
     # Match SvcType in SU and SI
-    result_sis = []
-    for itsi in protected_sis:
-        if itsi.saAmfSvcType in su_svctypes:
-            result_sis.append(itsi)
+    result_sis = [itsi for itsi in protected_sis if itsi.saAmfSvcType in su_svctypes]
 
     return result_sis, matched_apps
 
@@ -147,6 +147,7 @@ def prepare_for_write(objects):
     """
     conf_objects = []
     for immobj in objects:
+        # Not cached, the objects read here are modified
         _, immobj = accessor.get(immobj.dn, ['SA_IMM_SEARCH_GET_CONFIG_ATTR'])
         del immobj.attrs['SaImmAttrAdminOwnerName']
         del immobj.attrs['SaImmAttrClassName']
@@ -157,13 +158,7 @@ def prepare_for_write(objects):
 
 def find_node_groups(amf_node):
     """ Fetch all node groups a node belongs to """
-    matching_groups = []
-    _iter = inst_iter('SaAmfNodeGroup')
-    _iter.init()
-    for ngrp in _iter:
-        if str.find(''.join(ngrp.saAmfNGNodeList), amf_node) >= 0:
-            matching_groups.append(ngrp)
-    return matching_groups
+    return snapshot.node_groups_of(amf_node)
 
 
 def collect_scalable_immobjects(from_amfnode_dn, from_clmnode_dn):
@@ -178,38 +173,38 @@ def collect_scalable_immobjects(from_amfnode_dn, from_clmnode_dn):
     csis = find_object_type('SaAmfCSI', sis)
     csiattrs = find_object_type('SaAmfCSIAttribute', csis)
 
-    swbundles = []
-    _iter = inst_iter(class_name='SaAmfNodeSwBundle', root_name=from_amfnode_dn)
-    _iter.init()
-    for immobj in _iter:
-        swbundles.append(immobj)
-
-    _, from_amfnode = accessor.get(from_amfnode_dn)
-    _, from_clmnode = accessor.get(from_clmnode_dn)
+    _, from_amfnode = cache.get(from_amfnode_dn)
+    swbundles = find_object_type('SaAmfNodeSwBundle', [from_amfnode])
+    _, from_clmnode = cache.get(from_clmnode_dn)
 
     # Order is important
     return [from_amfnode, from_clmnode] + sus + sis + csis + comps + \
         comps_cs + swbundles + hchks + csiattrs
 
 
-def modify_immobject(immobj, suffix, new_amfnode_dn, new_hostname):
-    """ Rename DN and change attributes for one IMM object """
-    rename_str = None
-    immobj.new_dn = immobj.dn
-    match = re.search('safSu=[^,]*|safSi[^,]*', immobj.new_dn)
-    if match:
-        # We have a SU or SI in the DN string. Generate a hash from it.
-        rename_str = immobj.new_dn[match.start():match.end()] + new_hostname
-        rename_str += suffix
-        rename_str = hashlib.md5(rename_str).hexdigest()[:10]
+def node_renames(suffix, new_hostname):
+    """ The RDN replacements of the DNs of a new node: a SU or SI gets a hash of
+        its RDN, the hostname and the suffix, a node gets the hostname
+        returns: dict for imm_dn.rewrite_dn
+    """
+    hashes = dict()
+
+    def rename(rdn):
+        if rdn not in hashes:
+            hashes[rdn] = hashlib.md5((rdn + new_hostname + suffix).encode('utf-8')).hexdigest()[:10]
+        return hashes[rdn]
+
+    def hostname(rdn):
+        return new_hostname
+
+    return {'safSu': rename, 'safSi': rename, 'safNode': hostname, 'safAmfNode': hostname}
+
 
+def modify_immobject(immobj, suffix, new_amfnode_dn, new_hostname, renames=None):
+    """ Rename DN and change attributes for one IMM object """
+    renames = renames or node_renames(suffix, new_hostname)
     # Rename the DN and store it in new_dn
-    immobj.new_dn = re.sub(r'(safSu|safSi)=([^,]*),', r'\1={0},'.
-                           format(rename_str), immobj.new_dn)
-    immobj.new_dn = re.sub('safNode=[^,]*,', 'safNode={0},'.
-                           format(new_hostname), immobj.new_dn)
-    immobj.new_dn = re.sub('safAmfNode=[^,]*,', 'safAmfNode={0},'.
-                           format(new_hostname), immobj.new_dn)
+    immobj.new_dn = rewrite_dn(immobj.dn, renames)
 
     # Change attributes to match the new node. Admin state is set to something
     # accepted by the AMF OI
@@ -219,97 +214,187 @@ def modify_immobject(immobj, suffix, new_amfnode_dn, new_hostname):
 
     elif immobj.class_name == 'SaAmfNode':
         immobj.saAmfNodeAdminState = ADMIN_LOCK_IN
-        immobj.saAmfNodeClmNode = re.sub(
-            'safNode=[^,]*,', 'safNode={0},'.format(new_hostname),
-            immobj.saAmfNodeClmNode)
+        immobj.saAmfNodeClmNode = rewrite_dn(immobj.saAmfNodeClmNode,
+                                             {'safNode': renames['safNode']})
 
 
 def split_rdn_and_parent(immobj):
     """ Split the DN of the passed in object into RDN and parent DN
         returns: RDN and parent DN as strings
     """
-    rdn = immobj.new_dn.split(',', 1)[0]
-    parent = immobj.new_dn.split(',', 1)[1]
-    # Handle the case when we have two backslashes
-    # At least here is object dn of SaAmfCompCsType class
-    if re.search("\\\\", immobj.new_dn) and re.search("safC.*Type=", immobj.new_dn):
-        parent = immobj.new_dn.split(',', 2)[-1]
-        rdn = re.sub(",{0}".format(parent), "", immobj.new_dn)
-    return rdn, parent
-
-
-def scale_out(new_hostname, from_hostname):
-    """ Scale out one node
-        params:
-            new_hostname - hostname of the new node
-            from_hostname - hostname of the template node
-    """
-    print('-Scaling out to [%s] config copied from [%s]' % (new_hostname,
-                                                            from_hostname))
-    print(new_hostname)
-    print(from_hostname)
-    _iter = inst_iter('SaAmfSU')
-    _iter.init()
-    for itsu in _iter:
-        # Get the first value part of the DN
-        hname = itsu.saAmfSUHostedByNode.split(',')[0].split('=')[1]
-        if hname == new_hostname:
-            print('Node already has SUs, no scaling-out done')
-            return 0
-
-    from_amfnode_dn, from_clmnode_dn = find_node_dns(from_hostname)
-    new_amfnode_dn = from_amfnode_dn.replace(from_hostname, new_hostname)
-    objects = collect_scalable_immobjects(from_amfnode_dn, from_clmnode_dn)
-    conf_objects = prepare_for_write(objects)
+    return split_rdn(immobj.new_dn)
 
-    suffix = str(time.time())
-    for immobj in conf_objects:
-        modify_immobject(immobj, suffix, new_amfnode_dn, new_hostname)
-
-    objs = list()
-    allowed_objs = ['SaAmfNode', 'SaClmNode', 'SaAmfSU', 'SaAmfSI', 'SaAmfCSI', 'SaAmfComp',
-                    'SaAmfCompCsType', 'SaAmfNodeSwBundle', 'SaAmfHealthcheck', 'SaAmfCSIAttribute']
-    for obj in conf_objects:
-        if obj.class_name in allowed_objs:
-            objs.append(obj)
-
-    ccb = Ccb(flags=None)
-    ccb.init()
 
-    for immobj in objs:
+def clone_for_node(conf_objects, suffix, new_amfnode_dn, new_hostname):
+    """ Copy the template objects for a new node
+        returns: list of (ImmObject, parent DN) to create, in creation order
+    """
+    result = []
+    renames = node_renames(suffix, new_hostname)
+    for template in conf_objects:
+        if template.class_name not in ALLOWED_CLASSES:
+            continue
+        immobj = clone_object(template)
+        modify_immobject(immobj, suffix, new_amfnode_dn, new_hostname, renames)
         rdn, parent = split_rdn_and_parent(immobj)
         immobj.attrs[immobj.rdn_attribute][1] = [rdn]
         print_object(immobj, immobj.new_dn)
         del immobj.attrs['new_dn']
-        ccb.create(immobj, parent)
+        result.append((immobj, parent))
+    return result
 
-    nodegroups_to_join = find_node_groups(from_amfnode_dn)
-    for ngr in nodegroups_to_join:
-        ccb.modify_value_add(ngr.dn, "saAmfNGNodeList", new_amfnode_dn)
-    ccb.apply()
 
-    print("-Unlock-in/unlock %s" % new_amfnode_dn)
-    subprocess.call(['amf-adm', 'unlock-in', new_amfnode_dn])
-    subprocess.call(['amf-adm', 'unlock', new_amfnode_dn])
+def read_template(from_hostname):
+    """ Read the objects of the template node and prepare them for write
+        returns: Template
+    """
+    with metrics.phase('collect template'):
+        from_amfnode_dn, from_clmnode_dn = find_node_dns(from_hostname)
+        objects = collect_scalable_immobjects(from_amfnode_dn, from_clmnode_dn)
+        nodegroups = find_node_groups(from_amfnode_dn)
+    with metrics.phase('prepare template'):
+        conf_objects = prepare_for_write(objects)
+    su_dns = frozenset(itsu.dn for itsu in snapshot.sus_hosted_by(from_amfnode_dn))
+    return Template(from_amfnode_dn, conf_objects, nodegroups, su_dns, time.time())
+
+
+def template_of(from_hostname, templates=None):
+    """ The template of a node, taken from templates while the node hosts the
+        same SUs as when it was read
+        params:
+            templates - dict of Templates by hostname kept by a long-running
+                        caller, the template is read every time without it
+        returns: Template
+    """
+    template = templates.get(from_hostname) if templates is not None else None
+    if template is not None:
+        node = snapshot.node_of_host(from_hostname)
+        if node is not None and node.dn == template.amfnode_dn and template.su_dns == \
+                frozenset(itsu.dn for itsu in snapshot.sus_hosted_by(node.dn)):
+            return template
+    template = read_template(from_hostname)
+    if templates is not None:
+        templates[from_hostname] = template
+    return template
+
+
+def scale_out(new_hostnames, from_hostname, nodes_per_ccb=0, templates=None, view=None):
+    """ Scale out nodes
+        params:
+            new_hostnames - hostnames of the new nodes
+            from_hostname - hostname of the template node
+            nodes_per_ccb - nodes created per CCB, all in one CCB with 0
+            templates - dict of Templates by hostname reused across scale-outs
+            view - ImmSnapshot to read IMM through, e.g. an imm_cache.ImmCache
+                   kept up to date, a new snapshot by default
+        returns: DNs of the AMF nodes created
+    """
+    if isinstance(new_hostnames, str):
+        new_hostnames = [new_hostnames]
+    print('-Scaling out to [%s] config copied from [%s]' % (', '.join(new_hostnames),
+                                                            from_hostname))
+    print(' '.join(new_hostnames))
+    print(from_hostname)
+    global snapshot, cache
+    snapshot = view or ImmSnapshot(inst_iter)
+    cache = ImmReadCache(accessor)
+    with metrics.phase('find nodes'):
+        existing = snapshot.su_hostnames()
+    hostnames = []
+    for new_hostname in new_hostnames:
+        if new_hostname in existing:
+            print('Node %s already has SUs, no scaling-out done' % new_hostname)
+        elif new_hostname not in hostnames:
+            hostnames.append(new_hostname)
+    if not hostnames:
+        return []
+
+    # The template is read and prepared once for all the new nodes
+    template = template_of(from_hostname, templates)
+    from_amfnode_dn = template.amfnode_dn
 
+    suffix = str(time.time())
+    nodes_per_ccb = nodes_per_ccb or len(hostnames)
+    new_amfnode_dns = []
+    for start in range(0, len(hostnames), nodes_per_ccb):
+        with metrics.phase('clone'):
+            ccb = Ccb(flags=None)
+            ccb.init()
+            for new_hostname in hostnames[start:start + nodes_per_ccb]:
+                new_amfnode_dn = rewrite_dn(from_amfnode_dn,
+                                            {'safAmfNode': lambda rdn: new_hostname})
+                for immobj, parent in clone_for_node(template.conf_objects, suffix,
+                                                     new_amfnode_dn, new_hostname):
+                    ccb.create(immobj, parent)
+                for ngr in template.nodegroups:
+                    ccb.modify_value_add(ngr.dn, "saAmfNGNodeList", new_amfnode_dn)
+                new_amfnode_dns.append(new_amfnode_dn)
+        with metrics.phase('ccb apply'):
+            ccb.apply()
+
+    print("-Unlock-in/unlock %s" % ' '.join(new_amfnode_dns))
+    with metrics.phase('unlock'):
+        run_jobs([[['amf-adm', 'unlock-in', new_amfnode_dn],
+                   ['amf-adm', 'unlock', new_amfnode_dn]]
+                  for new_amfnode_dn in new_amfnode_dns], call=admin_call)
+
+    print('-IMM reads: %s' % cache)
     print('-Scaling out done')
+    return new_amfnode_dns
 
 
-if __name__ == '__main__':
-    accessor = ImmOmAccessor()
-    accessor.init()
+def use_backends(model=None, dry_run=False):
+    """ Set the IMM and admin command backends, see imm_offline.backends()
+        raises: RuntimeError if pyosaf is not installed and there is no model
+    """
+    global inst_iter, Ccb, admin_call, accessor
+    inst_iter, Ccb, admin_call, accessor = backends(metrics, inst_iter, ImmOmAccessor, Ccb,
+                                                    model, dry_run)
+
 
+if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Scales OpenSAF by adding and removing node configuration')
     parser.add_argument(
-        '--hostname', type=str, required=True,
-        help='Hostname for the new node.')
+        '--hostname', type=str, required=True, nargs='+',
+        help='Hostnames of the new nodes.')
     parser.add_argument(
         '--copy-from', type=str, required=False, help='Hostname of the '
         'existing node to use as template. If not set, the host where the '
         'command is executed will be used as template.',
         default=os.uname()[1])
+    parser.add_argument(
+        '--nodes-per-ccb', type=int, default=0,
+        help='Number of new nodes created per CCB, all nodes in one CCB if 0.')
+    parser.add_argument(
+        '--imm-xml', type=str, default=None,
+        help='Scale the model of an imm.xml export in memory instead of the IMM '
+        'of the cluster.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Print the CCB operations and admin commands instead of applying them.')
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help='Print the phase times and IMM call histograms as JSON.')
+    parser.add_argument(
+        '--log-file', type=str, default=LOG_PATH,
+        help='File the metrics are appended to as a line of JSON, none if empty.')
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help='Write cProfile statistics of the scale-out to this file.')
 
     args = parser.parse_args()
 
-    scale_out(args.hostname, args.copy_from)
+    try:
+        use_backends(ImmModel.load(args.imm_xml) if args.imm_xml else None, args.dry_run)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(scale_out, args.hostname, args.copy_from, args.nodes_per_ccb)
+        profiler.dump_stats(args.profile)
+    else:
+        scale_out(args.hostname, args.copy_from, args.nodes_per_ccb)
+    metrics.report(args.log_file, args.metrics, hostnames=args.hostname,
+                   copy_from=args.copy_from)
@@ -0,0 +1,160 @@
+""" Phase timers and call latency histograms of a scaling operation. The IMM
+    iterator, accessor and CCB and the admin command runner are wrapped so every
+    call is timed, the summary is printed as JSON and appended as one line to a
+    log file.
+"""
+from __future__ import print_function
+import contextlib
+import functools
+import json
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+LOG_PATH = '/var/log/opensaf_scale_out.log'
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+CCB_OPERATIONS = ['create', 'delete', 'modify_value_add', 'modify_value_delete',
+                  'modify_value_replace', 'apply']
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def histogram(durations):
+    """ Count, total and percentiles of durations in seconds, with the number of
+        durations per bucket
+        returns: dict
+    """
+    buckets = OrderedDict()
+    for bound in BUCKETS_MS:
+        buckets['<=%dms' % bound] = 0
+    buckets['>%dms' % BUCKETS_MS[-1]] = 0
+    names = list(buckets)
+    for seconds in durations:
+        index = 0
+        while index < len(BUCKETS_MS) and seconds * 1000 > BUCKETS_MS[index]:
+            index += 1
+        buckets[names[index]] += 1
+    return OrderedDict([('count', len(durations)),
+                        ('total_s', sum(durations)),
+                        ('p50_ms', percentile(durations, 0.50) * 1000),
+                        ('p95_ms', percentile(durations, 0.95) * 1000),
+                        ('max_ms', max(durations) * 1000 if durations else 0.0),
+                        ('buckets', OrderedDict((name, count) for name, count in buckets.items()
+                                                if count))])
+
+
+class ScaleMetrics(object):
+    """ Timers of the phases of one scaling operation and the durations of the
+        calls it makes, by kind. Calls may come from several threads.
+    """
+
+    def __init__(self, operation=None):
+        self.operation = operation
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.calls = dict()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """ Start timing a new operation, for a process running several with
+            the same wrapped backends
+        """
+        with self.lock:
+            self.started = time.time()
+            self.phases = OrderedDict()
+            self.calls = dict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time a phase, the time of a phase entered again is added up """
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    def record(self, kind, seconds):
+        with self.lock:
+            self.calls.setdefault(kind, []).append(seconds)
+
+    def timed(self, kind, func):
+        """ func, recording the duration of every call as kind """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(kind, time.time() - start)
+        return wrapper
+
+    def iterator(self, iterator_class):
+        """ An InstanceIterator factory timing init(), the reads of the objects """
+        def create(*args, **kwargs):
+            _iter = iterator_class(*args, **kwargs)
+            _iter.init = self.timed('iterator init', _iter.init)
+            return _iter
+        return create
+
+    def accessor(self, accessor):
+        """ The accessor with get() timed """
+        accessor.get = self.timed('accessor get', accessor.get)
+        return accessor
+
+    def ccb(self, ccb_class):
+        """ A Ccb factory timing the operations and apply() """
+        def create(*args, **kwargs):
+            ccb = ccb_class(*args, **kwargs)
+            for name in CCB_OPERATIONS:
+                setattr(ccb, name, self.timed('ccb ' + name, getattr(ccb, name)))
+            return ccb
+        return create
+
+    def command(self, call=None):
+        """ An admin command runner, subprocess.call by default, timing each
+            command by its command line without the object, e.g. 'amf-adm lock'
+        """
+        call = call or subprocess.call
+
+        def run(command):
+            start = time.time()
+            try:
+                return call(command)
+            finally:
+                self.record('command ' + ' '.join(command[:-1]), time.time() - start)
+        return run
+
+    def summary(self, **extra):
+        """ The phases and call histograms as a JSON serializable dict """
+        with self.lock:
+            result = OrderedDict([('operation', self.operation),
+                                  ('time', time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                         time.localtime(self.started))),
+                                  ('seconds', time.time() - self.started)])
+            result.update(extra)
+            result['phases'] = OrderedDict(self.phases)
+            result['calls'] = OrderedDict((kind, histogram(self.calls[kind]))
+                                          for kind in sorted(self.calls))
+        return result
+
+    def report(self, log_path=LOG_PATH, show=False, **extra):
+        """ Append the summary to the log as one line of JSON, print it too with show """
+        summary = self.summary(**extra)
+        if show:
+            print(json.dumps(summary, indent=2))
+        if log_path:
+            try:
+                with open(log_path, 'a') as log:
+                    log.write(json.dumps(summary) + '\n')
+            except (IOError, OSError) as e:
+                print('Could not write the metrics to %s: %s' % (log_path, e), file=sys.stderr)
+        return summary
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+""" Scale-out service of the cluster. The opensaf_scale_out hook sends the
+    hostnames of the joining nodes over a local socket, the requests arriving
+    in a burst are scaled out together by one scale_out() of
+    scale-out-opensaf.py. pyosaf is imported and the IMM accessor initialized
+    once, IMM is read through an ImmCache kept up to date between the batches,
+    and the template node is read again only when its SUs change or it is
+    older than --template-ttl.
+    The hook waits for the reply, it scales out by itself when the service is
+    not running.
+"""
+from __future__ import print_function
+import argparse
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import queue
+    import socketserver
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+
+from imm_cache import ImmCache, Listener, Poller
+from imm_dn import rdn_value
+from imm_offline import ImmModel
+from imm_snapshot import inst_iter
+from scale_metrics import LOG_PATH
+
+SOCKET_PATH = '/var/run/opensaf/scale-out.sock'
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scale-out-opensaf.py')
+# Seconds a batch waits for another request, and the most it waits in all
+BATCH_WINDOW = 0.5
+BATCH_MAX = 5.0
+# Seconds a template is used before it is read again
+TEMPLATE_TTL = 600.0
+# Seconds the hook waits for its batch to be scaled out
+REQUEST_TIMEOUT = 600.0
+# Exit code of a request when the service is not running
+NOT_RUNNING = 3
+
+
+def load_scale_out(path=SCRIPT):
+    """ Import scale-out-opensaf.py, its file name is not a module name """
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('scale_out_opensaf', path)
+    spec = importlib.util.spec_from_file_location('scale_out_opensaf', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class NotRunning(Exception):
+    """ Nothing listens at the socket of the service """
+
+
+class Request(object):
+    """ Hostnames to scale out from a template node, replied to once done """
+
+    def __init__(self, hostnames, copy_from):
+        self.hostnames = hostnames
+        self.copy_from = copy_from
+        self.reply = None
+        self.done = threading.Event()
+
+    def finish(self, reply):
+        self.reply = reply
+        self.done.set()
+
+
+def watch_imm(model=None):
+    """ The ImmCache the batches read IMM through: subscribed to the changes of
+        an ImmModel, or polled and woken up by an IMM applier on a CCB
+        returns: cache and the threads keeping it up to date, to stop()
+    """
+    if model is not None:
+        cache = ImmCache(model.iterator)
+        model.subscribe(cache.apply_change)
+        return cache, []
+    cache = ImmCache(inst_iter)
+    poller = Poller(cache)
+    poller.start()
+    threads = [poller]
+    try:
+        listener = Listener(poller)
+        listener.start()
+        threads.append(listener)
+    except RuntimeError as e:
+        print('-IMM is polled every %.0f s only: %s' % (poller.interval, e))
+    return cache, threads
+
+
+class ScaleOutService(object):
+    """ Scales out the queued requests one batch at a time on one thread. The
+        backends of the scale-out module are set up once, see use_backends(),
+        and IMM is read through view, see watch_imm()
+    """
+
+    def __init__(self, module, nodes_per_ccb=0, log_path=LOG_PATH, window=BATCH_WINDOW,
+                 max_wait=BATCH_MAX, template_ttl=TEMPLATE_TTL, view=None):
+        self.module = module
+        self.view = view
+        self.nodes_per_ccb = nodes_per_ccb
+        self.log_path = log_path
+        self.window = window
+        self.max_wait = max_wait
+        self.template_ttl = template_ttl
+        self.templates = dict()
+        self.requests = queue.Queue()
+        self.reconnect = False
+
+    def submit(self, request):
+        self.requests.put(request)
+
+    def next_batch(self):
+        """ The next request and the ones following it within the window
+            returns: list of Requests
+        """
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while True:
+            timeout = min(self.window, deadline - time.time())
+            if timeout <= 0:
+                return batch
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # A batch has one template node in practice, the hook always
+            # copies from the same one
+            templates = []
+            for request in batch:
+                if request.copy_from not in templates:
+                    templates.append(request.copy_from)
+            for copy_from in templates:
+                self.scale_out([request for request in batch if request.copy_from == copy_from])
+
+    def scale_out(self, requests):
+        """ Scale out the nodes of requests with the same template node in one
+            operation and reply to all of them
+        """
+        copy_from = requests[0].copy_from
+        hostnames = []
+        for request in requests:
+            hostnames.extend(hostname for hostname in request.hostnames
+                             if hostname not in hostnames)
+        now = time.time()
+        for hostname, template in list(self.templates.items()):
+            if now - template.read_at > self.template_ttl:
+                del self.templates[hostname]
+        metrics = self.module.metrics
+        metrics.reset()
+        try:
+            if self.reconnect:
+                self.module.accessor.init()
+                self.reconnect = False
+            if self.view is not None:
+                # Components and CSIs of a template are not watched, they are
+                # read again by every batch
+                self.view.forget()
+            created = self.module.scale_out(hostnames, copy_from, self.nodes_per_ccb,
+                                            self.templates, self.view)
+            replies = [{'ok': True, 'created': [amfnode_dn for amfnode_dn in created
+                                                if rdn_value(amfnode_dn) in request.hostnames]}
+                       for request in requests]
+        except Exception as e:
+            # The template or the IMM handle may be what failed, both are
+            # renewed for the next batch
+            traceback.print_exc()
+            self.templates.pop(copy_from, None)
+            self.reconnect = True
+            replies = [{'ok': False, 'error': str(e) or type(e).__name__}] * len(requests)
+        metrics.report(self.log_path, hostnames=hostnames, copy_from=copy_from,
+                       requests=len(requests))
+        sys.stdout.flush()
+        for request, reply in zip(requests, replies):
+            request.finish(reply)
+        if self.view is not None:
+            # The next batch sees the nodes created even if the applier has not
+            # woken the poller up yet
+            try:
+                self.view.refresh()
+            except Exception:
+                traceback.print_exc()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Reads one request as a line of JSON and writes the reply once its batch
+        is scaled out
+    """
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode('utf-8'))
+            request = Request([str(hostname) for hostname in message['hostnames']],
+                              str(message['copy_from']))
+        except (ValueError, KeyError, TypeError) as e:
+            reply = {'ok': False, 'error': 'Bad request: %s' % e}
+        else:
+            self.server.service.submit(request)
+            if request.done.wait(REQUEST_TIMEOUT) is False:
+                reply = {'ok': False, 'error': 'Not scaled out in %d s' % REQUEST_TIMEOUT}
+            else:
+                reply = request.reply
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class ScaleOutServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.service = service
+
+
+def remove_stale_socket(path):
+    """ Remove the socket of a service that is gone
+        raises: RuntimeError if a service answers at the socket
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError('The scale-out service is already running at %s' % path)
+
+
+def serve(service, path=SOCKET_PATH):
+    remove_stale_socket(path)
+    server = ScaleOutServer(path, service)
+    worker = threading.Thread(target=service.run)
+    worker.daemon = True
+    worker.start()
+    print('-Scale-out service listening at %s' % path)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def request_scale_out(hostnames, copy_from, path=SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+    """ Ask the service to scale out nodes and wait until their batch is done
+        returns: reply, dict of ok and the DNs of the AMF nodes of hostnames
+                 created, or the error
+        raises: NotRunning if the service is not running, socket.error if it
+                did not reply, e.g. in timeout seconds
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise NotRunning(str(e))
+            raise
+        sock.sendall((json.dumps({'hostnames': hostnames, 'copy_from': copy_from}) +
+                      '\n').encode('utf-8'))
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error('The scale-out service closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+
+def parse_argument():
+    parser = argparse.ArgumentParser(
+        description='Scale out the nodes joining at the same time together')
+    parser.add_argument(
+        '--socket', type=str, default=SOCKET_PATH,
+        help='Local socket of the service (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('serve', help='Run the scale-out service')
+    command.add_argument(
+        '--nodes-per-ccb', type=int, default=0,
+        help='Number of new nodes created per CCB, all nodes of a batch in one CCB if 0.')
+    command.add_argument(
+        '--batch-window', type=float, default=BATCH_WINDOW,
+        help='Seconds a batch waits for another request (default: %(default)s)')
+    command.add_argument(
+        '--batch-max', type=float, default=BATCH_MAX,
+        help='Most seconds a batch waits for requests (default: %(default)s)')
+    command.add_argument(
+        '--template-ttl', type=float, default=TEMPLATE_TTL,
+        help='Seconds a template node is used before it is read again (default: %(default)s)')
+    command.add_argument(
+        '--imm-xml', type=str, default=None,
+        help='Scale the model of an imm.xml export in memory instead of the IMM '
+        'of the cluster.')
+    command.add_argument(
+        '--dry-run', action='store_true',
+        help='Print the CCB operations and admin commands instead of applying them.')
+    command.add_argument(
+        '--log-file', type=str, default=LOG_PATH,
+        help='File the metrics of a batch are appended to as a line of JSON, none if empty.')
+    command = commands.add_parser('request', help='Scale out nodes by the service')
+    command.add_argument(
+        '--hostname', type=str, required=True, nargs='+',
+        help='Hostnames of the new nodes.')
+    command.add_argument(
+        '--copy-from', type=str, default=os.uname()[1],
+        help='Hostname of the existing node to use as template.')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('a command is required')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_argument()
+    if args.command == 'request':
+        try:
+            reply = request_scale_out(args.hostname, args.copy_from, args.socket)
+        except NotRunning as e:
+            print('The scale-out service is not available: %s' % e, file=sys.stderr)
+            sys.exit(NOT_RUNNING)
+        except socket.error as e:
+            # The service may still be scaling the nodes out, the hook must
+            # not do it too
+            sys.exit('Scaling out failed, no reply of the service: %s' % (str(e) or 'timed out'))
+        if not reply['ok']:
+            sys.exit('Scaling out failed: %s' % reply['error'])
+        for amfnode_dn in reply['created']:
+            print('-Scaled out %s' % amfnode_dn)
+        sys.exit(0)
+
+    scale_out = load_scale_out()
+    model = ImmModel.load(args.imm_xml) if args.imm_xml else None
+    try:
+        scale_out.use_backends(model, args.dry_run)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    # Stopped by a signal the socket is removed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    cache, threads = watch_imm(model)
+    service = ScaleOutService(scale_out, args.nodes_per_ccb, args.log_file, args.batch_window,
+                              args.batch_max, args.template_ttl, cache)
+    try:
+        serve(service, args.socket)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        print('-Scale-out service stopped')
+    finally:
+        for thread in threads:
+            thread.stop()
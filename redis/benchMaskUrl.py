@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+""" Benchmark the search modes of searchMaskUrl on a synthetic tenant dataset,
+    against an in-process fake Redis or a local redis-server
+"""
+import argparse
+import contextlib
+import fnmatch
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from queue import Empty
+
+import redis
+
+from searchMaskUrl import SearchRedisAdmin, DEFAULT_BATCH_SIZE
+
+DEFAULT_TENANTS = 100000
+DEFAULT_MODES = ("batched", "settings-only", "workers")
+# Seconds between two checks that the child running a mode is still alive
+CHILD_POLL_INTERVAL = 1
+
+
+class FakePipeline(object):
+    """ Non-transactional pipeline of FakeRedis, one simulated round trip per execute """
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.commands = []
+
+    def hgetall(self, key):
+        self.commands.append((self.fake.hgetall_local, (key,), {}))
+
+    def hscan(self, key, cursor=0, match=None, count=None):
+        self.commands.append((self.fake.hscan_local, (key, cursor, match), {}))
+
+    def execute(self, raise_on_error=True):
+        self.fake.round_trip()
+        replies = []
+        for func, args, kwargs in self.commands:
+            try:
+                replies.append(func(*args, **kwargs))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                replies.append(e)
+        self.commands = []
+        return replies
+
+
+class FakeRedis(object):
+    """ In-process stand-in of the Redis commands searchMaskUrl uses, with a
+        simulated round trip latency and a count of the reply bytes
+    """
+
+    def __init__(self, latency=0.0):
+        self.data = dict()
+        self.keys = []
+        self.latency = latency
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def hset(self, key, mapping):
+        if key not in self.data:
+            self.keys.append(key)
+        self.data.setdefault(key, dict()).update(mapping)
+
+    def freeze(self):
+        """ SCAN walks the keys in a fixed order, like the slots of a Redis dict """
+        self.keys.sort()
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, nbytes):
+        with self.lock:
+            self.bytes_out += nbytes
+
+    @staticmethod
+    def glob(match):
+        # Redis negates a class with ^, fnmatch with !
+        return match.replace("[^", "[!").encode("utf-8")
+
+    def scan(self, cursor=0, match="*", count=10):
+        self.round_trip()
+        pattern = self.glob(match or "*")
+        cursor = int(cursor)
+        keys = [key for key in self.keys[cursor:cursor + count] if fnmatch.fnmatchcase(key, pattern)]
+        cursor += count
+        self.count(sum(len(key) for key in keys))
+        return (cursor if cursor < len(self.keys) else 0), keys
+
+    def hgetall_local(self, key):
+        data = dict(self.data.get(key, {}))
+        self.count(sum(len(field) + len(value) for field, value in data.items()))
+        return data
+
+    def hscan_local(self, key, cursor=0, match=None):
+        pattern = self.glob(match or "*")
+        data = dict((field, value) for field, value in self.data.get(key, {}).items()
+                    if fnmatch.fnmatchcase(field, pattern))
+        self.count(sum(len(field) + len(value) for field, value in data.items()))
+        return 0, data
+
+    def hgetall(self, key):
+        self.round_trip()
+        return self.hgetall_local(key)
+
+    def hscan(self, key, cursor=0, match=None, count=None):
+        self.round_trip()
+        return self.hscan_local(key, cursor, match)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def info(self, section=None):
+        return {"role": "master", "total_net_output_bytes": self.bytes_out}
+
+
+def generate_tenants(count, settings_keys, hit_ratio, extra_fields, seed=0):
+    """ Synthetic tenant hashes, hit_ratio of them with a custom domain
+        yields: (key, {field: value})
+    """
+    rnd = random.Random(seed)
+    for i in range(count):
+        settings = dict(("option_{0}".format(j), "value {0}".format(rnd.randint(0, 1 << 20)))
+                        for j in range(settings_keys))
+        if rnd.random() < hit_ratio:
+            settings["custom_domain"] = "tenant{0}.mask.example.org".format(i)
+        elif rnd.random() < 0.5:
+            settings["custom_domain"] = ""
+        data = {b"settings": json.dumps(settings).encode("utf-8")}
+        for j in range(extra_fields):
+            data["field_{0}".format(j).encode("utf-8")] = os.urandom(32)
+        # Tenant names spread over the first characters the search partitions on
+        name = hashlib.sha1(str(i).encode("utf-8")).hexdigest()[:12]
+        yield "{0}.example.com".format(name).encode("utf-8"), data
+
+
+def fill(client, tenants, batch_size=1000):
+    """ Write the tenants to a real Redis in pipelined batches """
+    pipe = client.pipeline(transaction=False)
+    for i, (key, data) in enumerate(tenants, 1):
+        pipe.hset(key, mapping=data)
+        if i % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+class BenchSearch(SearchRedisAdmin):
+    """ SearchRedisAdmin connected to the benchmark Redis, timing every fetched batch """
+
+    def __init__(self, target, *args, **kwargs):
+        self.target = target
+        self.latencies = []
+        self.latency_lock = threading.Lock()
+        super(BenchSearch, self).__init__(*args, **kwargs)
+
+    def connect(self, host, port, readonly=False):
+        if isinstance(self.target, FakeRedis):
+            return self.target
+        return super(BenchSearch, self).connect(host, port, readonly)
+
+    def fetch_batch(self, client, keys):
+        start = time.time()
+        result = super(BenchSearch, self).fetch_batch(client, keys)
+        with self.latency_lock:
+            self.latencies.append(time.time() - start)
+        return result
+
+
+def current_rss_kb():
+    """ Resident set size of the process in kB, from /proc where there is one """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def net_output_bytes(target, client):
+    if isinstance(target, FakeRedis):
+        return target.bytes_out
+    return int(client.info("stats")["total_net_output_bytes"])
+
+
+def run_mode(target, endpoint, mode, options):
+    """ Run one search mode and measure it
+        returns: dict of the measurements
+    """
+    kwargs = {"batch_size": options.batch_size}
+    if mode == "settings-only":
+        kwargs["settings_only"] = True
+    elif mode.startswith("workers-"):
+        kwargs["workers"] = int(mode.split("-", 1)[1])
+    baseline_rss = current_rss_kb()
+    search = BenchSearch(target, endpoint, options.pattern, **kwargs)
+    client = search.shards[0][1]
+    bytes_before = net_output_bytes(target, client)
+    workdir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        # Keep the per-partition report of the search out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            search.search(os.path.join(workdir, "mask_url_output"))
+        seconds = time.time() - start
+        with open(os.path.join(workdir, "mask_url_output")) as f:
+            hits = sum(1 for _ in f)
+    finally:
+        shutil.rmtree(workdir)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"mode": mode,
+            "keys": options.tenants,
+            "hits": hits,
+            "seconds": seconds,
+            "keys_per_sec": options.tenants / seconds if seconds else 0,
+            "bytes": net_output_bytes(target, client) - bytes_before,
+            "peak_rss_kb": peak_rss,
+            "rss_growth_kb": max(0, peak_rss - baseline_rss),
+            "batches": len(search.latencies),
+            "batch_p50_ms": percentile(search.latencies, 0.50) * 1000,
+            "batch_p99_ms": percentile(search.latencies, 0.99) * 1000}
+
+
+def _run_mode_child(queue, target, endpoint, mode, options):
+    try:
+        queue.put((run_mode(target, endpoint, mode, options), None))
+    except Exception:
+        # The parent waits for a result, it gets the error instead
+        queue.put((None, traceback.format_exc()))
+        raise
+
+
+def run_isolated(target, endpoint, mode, options):
+    """ Run a mode in a forked child so its peak RSS is its own
+        raises: RuntimeError if the child failed or died without a result
+    """
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        return run_mode(target, endpoint, mode, options)
+    queue = context.Queue()
+    child = context.Process(target=_run_mode_child, args=(queue, target, endpoint, mode, options))
+    child.start()
+    while True:
+        try:
+            result, error = queue.get(timeout=CHILD_POLL_INTERVAL)
+            break
+        except Empty:
+            if not child.is_alive():
+                # The result may have been queued right before the exit
+                try:
+                    result, error = queue.get(timeout=CHILD_POLL_INTERVAL)
+                    break
+                except Empty:
+                    child.join()
+                    raise RuntimeError("{0} died with exit code {1} without a result".format(
+                        mode, child.exitcode))
+    child.join()
+    if error:
+        raise RuntimeError("{0} failed:\n{1}".format(mode, error))
+    return result
+
+
+@contextlib.contextmanager
+def local_redis_server(binary, port):
+    """ Start a throwaway redis-server without persistence on localhost """
+    process = subprocess.Popen([binary, "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = redis.Redis(host="127.0.0.1", port=port)
+    try:
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        yield client
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(results, baseline_path, tolerance):
+    """ Modes slower than the baseline by more than tolerance
+        returns: list of messages
+    """
+    with open(baseline_path) as f:
+        baseline = dict((r["mode"], r) for r in json.load(f)["results"])
+    regressions = []
+    for result in results:
+        before = baseline.get(result["mode"])
+        if before and result["keys_per_sec"] < before["keys_per_sec"] * (1 - tolerance):
+            regressions.append("{0}: {1:.0f} keys/s, baseline {2:.0f} keys/s".format(
+                result["mode"], result["keys_per_sec"], before["keys_per_sec"]))
+    return regressions
+
+
+def parse_argument(args):
+    parser = argparse.ArgumentParser(description="Benchmark the search modes of searchMaskUrl offline")
+    parser.add_argument("-n", "--tenants", type=int, default=DEFAULT_TENANTS,
+                        help="Number of tenant hashes (default: %(default)s)")
+    parser.add_argument("-s", "--settings-keys", dest="settings_keys", type=int, default=20,
+                        help="Number of keys in the settings JSON of a tenant (default: %(default)s)")
+    parser.add_argument("--extra-fields", dest="extra_fields", type=int, default=5,
+                        help="Number of other fields in a tenant hash (default: %(default)s)")
+    parser.add_argument("--hit-ratio", dest="hit_ratio", type=float, default=0.1,
+                        help="Share of tenants with a custom domain (default: %(default)s)")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Batch size of the search (default: %(default)s)")
+    parser.add_argument("-m", "--modes", nargs="+", default=list(DEFAULT_MODES),
+                        help="batched, settings-only, workers or workers-<N> (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[2, 4, 8],
+                        help="Worker counts of the workers mode (default: %(default)s)")
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=0.0,
+                        help="Simulated round trip latency of the fake Redis (default: %(default)s)")
+    parser.add_argument("--redis-server", dest="redis_server", default=None,
+                        help="Path of a redis-server binary to run the benchmark against instead of the fake")
+    parser.add_argument("--port", type=int, default=16379,
+                        help="Port of the local redis-server (default: %(default)s)")
+    parser.add_argument("-o", "--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON results of an earlier run, exit 1 when a mode got slower")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed keys/s drop against the baseline (default: %(default)s)")
+    options = parser.parse_args(args=args)
+    options.pattern = "example"
+    modes = []
+    for mode in options.modes:
+        if mode == "workers":
+            modes.extend("workers-{0}".format(n) for n in options.workers)
+        else:
+            modes.append(mode)
+    options.modes = modes
+    return options
+
+
+def main():
+    options = parse_argument(sys.argv[1:])
+    tenants = generate_tenants(options.tenants, options.settings_keys, options.hit_ratio,
+                               options.extra_fields)
+    with contextlib.ExitStack() as stack:
+        if options.redis_server:
+            client = stack.enter_context(local_redis_server(options.redis_server, options.port))
+            fill(client, tenants)
+            target, endpoint = client, "127.0.0.1:{0}".format(options.port)
+        else:
+            target, endpoint = FakeRedis(options.latency_ms / 1000.0), "fake"
+            for key, data in tenants:
+                target.hset(key, data)
+            target.freeze()
+
+        results = []
+        for mode in options.modes:
+            result = run_isolated(target, endpoint, mode, options)
+            results.append(result)
+            print("{mode:>14}: {keys_per_sec:10.0f} keys/s {bytes:12d} bytes "
+                  "rss +{rss_growth_kb:7d} kB  batch p50 {batch_p50_ms:7.2f} ms "
+                  "p99 {batch_p99_ms:7.2f} ms".format(**result), file=sys.stderr)
+
+    report = {"dataset": {"tenants": options.tenants, "settings_keys": options.settings_keys,
+                          "extra_fields": options.extra_fields, "hit_ratio": options.hit_ratio,
+                          "backend": "redis-server" if options.redis_server else "fake",
+                          "latency_ms": options.latency_ms},
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if options.baseline:
+        regressions = compare(results, options.baseline, options.tolerance)
+        for message in regressions:
+            print("Regression {0}".format(message), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
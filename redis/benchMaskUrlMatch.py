@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" Micro-benchmark of the per-key CPU cost of matching the settings of a tenant
+    hash, the regex loop searchMaskUrl used before against SearchRedisAdmin.mask_url
+"""
+import re
+import json
+import time
+import argparse
+import sys
+
+from searchMaskUrl import SearchRedisAdmin, json_loads
+
+
+def legacy_mask_url(data):
+    """ The matching loop of searchMaskUrl before the fast path """
+    result = None
+    try:
+        for r_key, values in data.items():
+            if re.search("settings", r_key.decode("utf-8")):
+                json_dump = json.loads(values.decode("utf-8"))
+                for s_key, value in json_dump.items():
+                    if re.search("custom_domain", s_key):
+                        if value:
+                            result = value
+    except Exception:
+        pass
+    return result
+
+
+def make_hash(kind, settings_keys):
+    """ A tenant hash with settings_keys settings of which custom_domain is
+        set (hit), empty (empty) or missing (miss)
+    """
+    settings = dict(("option_{0}".format(i), "value {0}".format(i)) for i in range(settings_keys))
+    if kind == "hit":
+        settings["custom_domain"] = "mask.example.com"
+    elif kind == "empty":
+        settings["custom_domain"] = ""
+    return {b"name": b"tenant", b"plan": b"enterprise",
+            b"settings": json.dumps(settings).encode("utf-8")}
+
+
+def per_key(func, data, rounds):
+    """ Microseconds of CPU per call of func """
+    start = time.process_time()
+    for _ in range(rounds):
+        func(data)
+    return (time.process_time() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-key cost of matching the settings of a tenant hash")
+    parser.add_argument("-n", "--rounds", type=int, default=20000, help="Calls per case (default: %(default)s)")
+    parser.add_argument("-s", "--settings-keys", dest="settings_keys", type=int, default=50,
+                        help="Number of keys in the settings JSON (default: %(default)s)")
+    options = parser.parse_args(sys.argv[1:])
+
+    print("JSON decoder: {0}.{1}".format(json_loads.__module__, json_loads.__name__))
+    for kind in ("miss", "empty", "hit"):
+        data = make_hash(kind, options.settings_keys)
+        assert legacy_mask_url(data) == SearchRedisAdmin.mask_url(data)
+        before = per_key(legacy_mask_url, data, options.rounds)
+        after = per_key(SearchRedisAdmin.mask_url, data, options.rounds)
+        print("{0:>5}: before {1:8.2f} us/key, after {2:8.2f} us/key ({3:.1f}x)".format(
+            kind, before, after, before / after if after else 0))
+
+
+if __name__ == '__main__':
+    main()
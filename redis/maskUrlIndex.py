@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+""" Index of the tenants using a mask URL, by custom domain """
+import sqlite3
+import argparse
+import sys
+import os
+import time
+import glob
+
+# Line of a change log marking a synchronization with the watcher, not a changed key
+CHANGE_MARKER = b"\x00changes-marker\x00"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    rdomain TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tenants_rdomain ON tenants (rdomain);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def normalize_domain(value):
+    """ The lower-case host name of a custom domain, without scheme, port, path
+        or trailing dot
+    """
+    domain = str(value).strip().lower()
+    if "://" in domain:
+        domain = domain.split("://", 1)[1]
+    domain = domain.split("/", 1)[0].split(":", 1)[0]
+    return domain.rstrip(".")
+
+
+def reverse_domain(domain):
+    """ Domains are stored reversed so a suffix lookup is a range of the index """
+    return normalize_domain(domain)[::-1]
+
+
+class MaskUrlIndex(object):
+    """ SQLite index from the custom domain to the tenant keys, built from the
+        output of a full search and updated by incremental searches
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def set_meta(self, **values):
+        self.db.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                            [(name, str(value)) for name, value in values.items()])
+
+    def meta(self):
+        return dict(self.db.execute("SELECT name, value FROM meta"))
+
+    def replace(self, rows, changes=None):
+        """ Replace the whole index with the (key, custom domain) rows of a full search """
+        with self.db:
+            self.db.execute("DELETE FROM tenants")
+            self.db.executemany("INSERT OR REPLACE INTO tenants (key, value, rdomain) VALUES (?, ?, ?)",
+                                ((key, str(value), reverse_domain(value)) for key, value in rows))
+            now = time.time()
+            self.set_meta(built_at=now, updated_at=now, changes=changes or "")
+
+    def apply(self, changed, found, changes=None):
+        """ Update the index after an incremental search
+            params:
+                changed - keys re-checked by the search
+                found - {key: custom domain} of the changed keys still using a mask URL
+        """
+        with self.db:
+            self.db.executemany("DELETE FROM tenants WHERE key = ?", ((key,) for key in changed))
+            self.db.executemany("INSERT OR REPLACE INTO tenants (key, value, rdomain) VALUES (?, ?, ?)",
+                                ((key, str(value), reverse_domain(value)) for key, value in found.items()))
+            self.set_meta(updated_at=time.time(), changes=changes or "")
+
+    def lookup(self, domain, suffix=False):
+        """ The tenants using domain, or any domain ending with domain when suffix is set
+            returns: list of (key, custom domain)
+        """
+        rdomain = reverse_domain(domain)
+        if not suffix:
+            cursor = self.db.execute("SELECT key, value FROM tenants WHERE rdomain = ? ORDER BY key",
+                                     (rdomain,))
+        else:
+            # example.com matches example.com and *.example.com, "/" sorts right after "."
+            cursor = self.db.execute("SELECT key, value FROM tenants WHERE rdomain = ? OR "
+                                     "(rdomain >= ? AND rdomain < ?) ORDER BY key",
+                                     (rdomain, rdomain + ".", rdomain + "/"))
+        return cursor.fetchall()
+
+    def status(self):
+        """ How stale the index is
+            returns: dict of tenants, built_at, updated_at, age in seconds and the
+                     number of changes logged since the last update
+        """
+        meta = self.meta()
+        tenants = self.db.execute("SELECT COUNT(*) FROM tenants").fetchone()[0]
+        updated_at = float(meta["updated_at"]) if "updated_at" in meta else None
+        pending = None
+        changes = meta.get("changes")
+        if changes:
+            pending = 0
+            # Logs taken by an incremental search that did not finish are pending too
+            for path in [changes] + glob.glob(glob.escape(changes) + ".*.taken"):
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        pending += sum(1 for line in f if CHANGE_MARKER not in line)
+        return {"tenants": tenants,
+                "built_at": float(meta["built_at"]) if "built_at" in meta else None,
+                "updated_at": updated_at,
+                "age": time.time() - updated_at if updated_at else None,
+                "pending_changes": pending}
+
+
+def parse_argument(args):
+    parser = argparse.ArgumentParser(description="Look up the tenants using a mask URL in the index",
+                                     usage="maskUrlIndex -i index.db lookup example.com")
+    parser.add_argument("-i", "--index", required=True, help="Index file written by searchMaskUrl --index")
+    commands = parser.add_subparsers(dest="command")
+    lookup = commands.add_parser("lookup", help="Tenants using a custom domain")
+    lookup.add_argument("domain", help="Custom domain")
+    lookup.add_argument("-s", "--suffix", action="store_true",
+                        help="Also match the subdomains of the domain")
+    commands.add_parser("status", help="Size and staleness of the index")
+    commands.add_parser("rebuild", help="Rebuild the index with a full search, the other options "
+                                        "are the ones of searchMaskUrl, e.g. -e host -p pattern")
+
+    options, search = parser.parse_known_args(args=args)
+    if search and options.command != "rebuild":
+        parser.error("unrecognized arguments: {0}".format(" ".join(search)))
+    options.search = search
+    return options
+
+
+def main():
+    options = parse_argument(sys.argv[1:])
+    if options.command == "rebuild":
+        # Only a rebuild needs redis, lookups stay free of its import
+        import searchMaskUrl
+        search = searchMaskUrl.parse_argument(options.search + ["--index", options.index])
+        if search.watch or search.incremental:
+            print("A rebuild is a full search, --watch and --incremental do not apply")
+            sys.exit(1)
+        searchMaskUrl.run(search)
+        return
+
+    if not os.path.exists(options.index):
+        print("No index {0}, build it with rebuild".format(options.index))
+        sys.exit(1)
+    index = MaskUrlIndex(options.index)
+    if options.command == "lookup":
+        start = time.time()
+        rows = index.lookup(options.domain, options.suffix)
+        for key, value in rows:
+            print("{0}: {1}".format(key, value))
+        print("{0} tenants in {1:.1f} ms".format(len(rows), (time.time() - start) * 1000))
+    else:
+        status = index.status()
+        print("{0} tenants".format(status["tenants"]))
+        if status["built_at"]:
+            print("built {0}, updated {1} ({2:.0f}s ago)".format(
+                time.ctime(status["built_at"]), time.ctime(status["updated_at"]), status["age"]))
+        if status["pending_changes"] is not None:
+            print("{0} changes logged since the last update".format(status["pending_changes"]))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
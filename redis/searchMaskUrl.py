@@ -6,61 +6,1230 @@ import json
 import argparse
 import sys
 import os
+import string
+import time
+import fnmatch
+import csv
+import shutil
+import tempfile
+import threading
+import glob
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from maskUrlIndex import MaskUrlIndex, CHANGE_MARKER
+
+# Faster JSON decoders are used when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PORT = 6379
+# A JSON key may be spelled with \u escapes in the raw value
+JSON_ESCAPE = b"\\u"
+DEFAULT_OUTPUT = "mask_url_output"
+DEFAULT_FLUSH_EVERY = 1000
+OUTPUT_FORMATS = ("text", "jsonl", "csv")
+DEFAULT_CHECKPOINT_INTERVAL = 30
+# Seconds between two appends of the watcher to the change log
+WATCH_FLUSH_INTERVAL = 1
+# Seconds an incremental search waits for the watcher to log its markers
+CHANGE_MARKER_TIMEOUT = 10
+CHANGE_MARKER_POLL_INTERVAL = 0.05
+# Keyspace notification classes: K keyspace, g generic, h hash, x expired, e evicted
+NOTIFY_FLAGS = "Kghxe"
+# First characters of the keys used to split the keyspace into partitions
+KEY_ALPHABET = string.digits + string.ascii_letters
+GLOB_SPECIAL = "*?[\\"
+REPLICA_FLAGS = {"slave", "replica"}
+BAD_NODE_FLAGS = {"fail", "fail?", "noaddr", "handshake"}
+DEFAULT_PROGRESS_INTERVAL = 10
+# Seconds between two INFO samples of the ops/sec of a shard
+THROTTLE_SAMPLE_INTERVAL = 1
+# Smallest share of the batch size and SCAN COUNT the throttle shrinks to
+THROTTLE_MIN_SCALE = 0.01
+
+
+def partition_patterns(pattern, partitions):
+    """ Split the keys matching *pattern* into partitions by their first character.
+        Every partition is scanned with its own cursors, the last one takes the
+        keys starting with a character outside KEY_ALPHABET.
+        returns: list of partitions, each a list of (match, skip) cursors. Keys
+                 of a cursor matching skip are covered by another cursor.
+    """
+    match = "*{0}*".format(pattern)
+    if partitions <= 1 or not pattern or pattern[0] in GLOB_SPECIAL:
+        return [[(match, None)]]
+
+    groups = min(partitions - 1, len(KEY_ALPHABET))
+    classes = ["[{0}]".format(KEY_ALPHABET[i::groups]) for i in range(groups)]
+    classes.append("[^{0}]".format(KEY_ALPHABET))
+
+    result = []
+    for char_class in classes:
+        # [C]*P* only finds the pattern from the second character on
+        cursors = [(char_class + match, None)]
+        if fnmatch.fnmatchcase(pattern[0], char_class.replace("[^", "[!")):
+            # Keys starting with the pattern, unless already found above
+            cursors.append(("{0}*".format(pattern), match))
+        result.append(cursors)
+    return result
+
+
+def parse_endpoint(endpoint, port=DEFAULT_PORT):
+    """ Split host[:port] into host and port """
+    host, _, endpoint_port = endpoint.partition(":")
+    return host, int(endpoint_port) if endpoint_port else port
+
+
+def parse_cluster_nodes(reply):
+    """ Parse the reply of CLUSTER NODES, either the raw text or the dict of
+        the redis-py response callback
+        returns: dict of {"host:port": {"node_id", "flags", "master_id"}}
+    """
+    if isinstance(reply, dict):
+        return reply
+    if isinstance(reply, bytes):
+        reply = reply.decode("utf-8")
+    nodes = dict()
+    for line in reply.splitlines():
+        items = line.split(" ")
+        if len(items) < 8:
+            continue
+        addr = items[1].split("@")[0]
+        nodes[addr] = {"node_id": items[0], "flags": items[2], "master_id": items[3]}
+    return nodes
+
+
+def _flags(node):
+    flags = node["flags"]
+    if isinstance(flags, bytes):
+        flags = flags.decode("utf-8")
+    return set(flags.split(",")) if isinstance(flags, str) else set(flags)
+
+
+def discover_cluster_shards(client, replicas=False):
+    """ Find the primaries of a Redis Cluster from CLUSTER NODES
+        returns: list of (host, port) to scan, a replica of every primary when
+                 replicas is set and one is healthy
+    """
+    nodes = parse_cluster_nodes(client.execute_command("CLUSTER NODES"))
+    shards = []
+    for addr, node in sorted(nodes.items()):
+        flags = _flags(node)
+        if "master" not in flags or flags & BAD_NODE_FLAGS:
+            continue
+        target = addr
+        if replicas:
+            for r_addr, r_node in sorted(nodes.items()):
+                r_flags = _flags(r_node)
+                if r_node["master_id"] == node["node_id"] and \
+                        r_flags & REPLICA_FLAGS and not r_flags & BAD_NODE_FLAGS:
+                    target = r_addr
+                    break
+        host, _, port = target.rpartition(":")
+        shards.append((host, int(port)))
+    return shards
+
+
+def find_primary(client):
+    """ The primary of a non-cluster endpoint from INFO replication
+        returns: (host, port), None when the endpoint is the primary
+    """
+    info = client.info("replication")
+    if info.get("role") == "slave":
+        return info["master_host"], int(info["master_port"])
+    return None
+
+
+def find_replica(client):
+    """ An online replica of a non-cluster primary from INFO replication
+        returns: (host, port), None when the primary has no online replica
+    """
+    info = client.info("replication")
+    for name, value in sorted(info.items()):
+        if re.match(r"slave\d+$", name) and isinstance(value, dict) and \
+                value.get("state") == "online":
+            return value["ip"], int(value["port"])
+    return None
+
+
+class ReadOnlyConnection(redis.Connection):
+    """ Connection to a cluster replica, READONLY allows reads of the keys of
+        its primary without a MOVED redirection
+    """
+
+    def on_connect(self):
+        super(ReadOnlyConnection, self).on_connect()
+        self.send_command("READONLY")
+        if self.read_response() not in (b"OK", "OK"):
+            raise redis.ConnectionError("READONLY failed on {0}:{1}".format(self.host, self.port))
+
+
+def scan_fraction(cursor):
+    """ Share of the keyspace a SCAN cursor has walked. SCAN visits the buckets
+        in reversed-bit order, so the reversed cursor grows from 0 to 2**64.
+    """
+    return int("{0:064b}".format(cursor)[::-1], 2) / 2.0 ** 64
+
+
+class Throttle(object):
+    """ Paces the commands of the workers of one shard.
+        With latency, the SCAN COUNT and pipeline depth are halved when a round trip
+        takes longer than latency seconds and grown back up to their configured size
+        when it takes less than half. max_ops caps the commands per second sent to
+        the shard and max_server_ops pauses while the shard runs more commands per
+        second than that, ours included.
+    """
+
+    def __init__(self, client, latency=None, max_ops=None, max_server_ops=None):
+        self.client = client
+        self.latency = latency
+        self.max_ops = max_ops
+        self.max_server_ops = max_server_ops
+        self.scale = 1.0
+        self.average = None
+        self.server_ops = None
+        self.sampled_at = 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def size(self, base):
+        """ The current size of a SCAN COUNT or pipeline of configured size base """
+        return max(1, int(base * self.scale))
+
+    def sample(self):
+        """ Refresh the ops/sec of the shard, at most every THROTTLE_SAMPLE_INTERVAL """
+        now = time.time()
+        with self.lock:
+            if now - self.sampled_at < THROTTLE_SAMPLE_INTERVAL:
+                return self.server_ops
+            self.sampled_at = now
+        ops = self.client.info("stats").get("instantaneous_ops_per_sec")
+        self.server_ops = int(ops) if ops is not None else None
+        return self.server_ops
+
+    def wait(self, ops, stopping=None):
+        """ Block until ops more commands may be sent """
+        if self.max_server_ops:
+            while (self.sample() or 0) > self.max_server_ops:
+                if stopping and stopping.is_set():
+                    return
+                time.sleep(THROTTLE_SAMPLE_INTERVAL)
+        if self.max_ops:
+            with self.lock:
+                now = time.time()
+                start = max(now, self.next_slot)
+                self.next_slot = start + float(ops) / self.max_ops
+            if start > now:
+                time.sleep(start - now)
+
+    def observe(self, seconds):
+        """ Adapt the sizes to the duration of one round trip """
+        if not self.latency:
+            return
+        with self.lock:
+            if self.average is None:
+                self.average = seconds
+            else:
+                self.average = 0.7 * self.average + 0.3 * seconds
+            if self.average > self.latency and self.scale > THROTTLE_MIN_SCALE:
+                self.scale = max(THROTTLE_MIN_SCALE, self.scale / 2)
+                # The next round trips decide on the new sizes alone
+                self.average = None
+            elif self.average < self.latency / 2 and self.scale < 1.0:
+                self.scale = min(1.0, self.scale * 1.25)
+                self.average = None
+
+    def describe(self):
+        average = "{0:.1f} ms".format(self.average * 1000) if self.average is not None else "-"
+        server = "{0} ops/s".format(self.server_ops) if self.server_ops is not None else "-"
+        return "size {0:.0%}, round trip {1}, server {2}".format(self.scale, average, server)
+
+
+class Progress(object):
+    """ Done share, rate and ETA of the tasks of a search, printed every
+        interval seconds by a background thread
+    """
+
+    def __init__(self, tasks, interval=DEFAULT_PROGRESS_INTERVAL, throttles=None):
+        self.tasks = dict((task, 0.0) for task in tasks)
+        self.keys = dict((task, 0) for task in tasks)
+        self.interval = interval
+        self.throttles = throttles or dict()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.thread = None
+
+    def update(self, task, done, keys):
+        with self.lock:
+            self.tasks[task] = done
+            self.keys[task] = keys
+
+    def done(self):
+        with self.lock:
+            return sum(self.tasks.values()) / len(self.tasks), sum(self.keys.values())
+
+    def start(self):
+        if self.interval <= 0:
+            return self
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.finished.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        start = time.time()
+        first_done, first_keys = self.done()
+        last_keys = first_keys
+        while not self.finished.wait(self.interval):
+            done, keys = self.done()
+            elapsed = time.time() - start
+            eta = "-"
+            if done > first_done:
+                eta = "{0:.0f}s".format(elapsed * (1 - done) / (done - first_done))
+            print("progress {0:.1%}: {1} keys, {2:.0f} keys/s, ETA {3}".format(
+                done, keys, (keys - last_keys) / float(self.interval), eta))
+            last_keys = keys
+            for name in sorted(self.throttles):
+                if self.throttles[name].latency or self.throttles[name].max_server_ops:
+                    print("  {0}: {1}".format(name, self.throttles[name].describe()))
+            sys.stdout.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def output_mode(path):
+    """ The mode of the file at path, or the one open() would create it with """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+class ResultWriter(object):
+    """ Append the matches to a temporary file next to the output and rename it
+        to the output on commit, so a crash never leaves a half-written output
+    """
+
+    def __init__(self, path, fmt="text", flush_every=DEFAULT_FLUSH_EVERY, header=True,
+                 tmp_path=None, offset=0, count=0, column="mask_url"):
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format {0}".format(fmt))
+        self.path = os.path.abspath(path)
+        self.fmt = fmt
+        self.column = column
+        self.flush_every = max(1, flush_every)
+        self.count = count
+        if tmp_path:
+            # Continue the temporary file of an interrupted search after the
+            # last checkpointed match
+            self.tmp_path = tmp_path
+            self.f = open(tmp_path, "r+")
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            fd, self.tmp_path = tempfile.mkstemp(prefix=".{0}.".format(os.path.basename(self.path)),
+                                                 dir=os.path.dirname(self.path))
+            self.f = os.fdopen(fd, "w")
+        self.csv = csv.writer(self.f) if fmt == "csv" else None
+        if self.csv and header and not tmp_path:
+            self.csv.writerow(["key", column])
+
+    def write(self, key, value):
+        """ Append one match, flushed every flush_every matches. Values other
+            than strings are written as JSON in text and CSV.
+        """
+        if self.fmt == "jsonl":
+            self.f.write(json.dumps({"key": key, self.column: value}) + "\n")
+        else:
+            if not isinstance(value, str):
+                value = json.dumps(value)
+            if self.fmt == "text":
+                self.f.write("{0}: {1}\n".format(key, value))
+            else:
+                self.csv.writerow([key, value])
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.f.flush()
+
+    def position(self):
+        """ Flush and return the offset after the last written match """
+        self.f.flush()
+        return self.f.tell()
+
+    def append(self, other):
+        """ Append the matches of a committed part file """
+        with open(other, "r") as part:
+            shutil.copyfileobj(part, self.f)
+
+    def commit(self):
+        """ Make the matches visible under the output path """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        # mkstemp creates the file readable by its owner only, the output gets
+        # the mode of the one it replaces or of a file opened for writing
+        os.chmod(self.tmp_path, output_mode(self.path))
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """ Drop the matches, the previous output is left untouched """
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def read_results(path, fmt="text", column="mask_url"):
+    """ Read back an output written by ResultWriter
+        yields: (key, value)
+    """
+    with open(path, "r") as f:
+        if fmt == "csv":
+            rows = csv.reader(f)
+            next(rows, None)
+            for key, value in rows:
+                yield key, value
+            return
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if fmt == "jsonl":
+                row = json.loads(line)
+                yield row["key"], row[column]
+            else:
+                key, _, value = line.partition(": ")
+                yield key, value
+
+
+def _key_matcher(pattern):
+    """ The cheapest test of a JSON key against a glob pattern
+        returns: ("eq" | "in" | "glob", pattern)
+    """
+    inner = pattern[1:-1]
+    if not any(c in pattern for c in GLOB_SPECIAL):
+        return "eq", pattern
+    if len(pattern) > 1 and pattern[0] == pattern[-1] == "*" and \
+            not any(c in inner for c in GLOB_SPECIAL):
+        return "in", inner
+    return "glob", pattern
+
+
+class Query(object):
+    """ One question answered by the search: the keys with a hash field matching
+        field whose JSON value at path is non-empty, or matches regex. The value
+        at path is reported, or the project fields of the hash.
+        field and the dot-separated parts of path are glob patterns.
+    """
+
+    def __init__(self, name, field="*settings*", path=None, regex=None, project=None,
+                 output=None):
+        self.name = name
+        self.field_glob = field
+        self.field = _key_matcher(field)
+        self.field = (self.field[0], self.field[1].encode("utf-8"))
+        self.path = [_key_matcher(part) for part in path.split(".")] if path else []
+        self.regex = re.compile(regex) if regex else None
+        self.project = list(project or [])
+        self.output = output
+        # Values without the last literal key of the path in their raw bytes
+        # are not decoded
+        self.raw = None
+        for kind, pattern in reversed(self.path):
+            if kind != "glob":
+                if '"' not in pattern and "\\" not in pattern:
+                    self.raw = pattern.encode("utf-8")
+                break
+
+    @classmethod
+    def load(cls, path):
+        """ Read a JSON list of queries, each an object of the arguments of Query """
+        with open(path, "r") as f:
+            queries = [cls(**query) for query in json.load(f)]
+        names = [query.name for query in queries]
+        if not queries or len(set(names)) != len(names):
+            raise ValueError("{0} must list queries with unique names".format(path))
+        return queries
+
+    def match_field(self, field):
+        kind, pattern = self.field
+        if kind == "eq":
+            return field == pattern
+        if kind == "in":
+            return pattern in field
+        return fnmatch.fnmatchcase(field, pattern)
+
+    def resolve(self, obj, depth=0):
+        """ The values at path in a decoded JSON value """
+        if depth == len(self.path):
+            yield obj
+            return
+        if not isinstance(obj, dict):
+            return
+        kind, pattern = self.path[depth]
+        if kind == "eq":
+            if pattern in obj:
+                for value in self.resolve(obj[pattern], depth + 1):
+                    yield value
+            return
+        for key, value in obj.items():
+            if (pattern in key) if kind == "in" else fnmatch.fnmatchcase(key, pattern):
+                for found in self.resolve(value, depth + 1):
+                    yield found
+
+    def accept(self, value):
+        if self.regex is None:
+            return bool(value)
+        if value is None:
+            return False
+        return self.regex.search(value if isinstance(value, str) else json.dumps(value)) is not None
+
+    def evaluate(self, data, decoded=None):
+        """ Evaluate the query on a fetched hash. decoded caches the JSON values
+            of the hash between the queries of one search.
+            returns: the reported value, None if the hash does not match
+        """
+        if decoded is None:
+            decoded = dict()
+        result = None
+        try:
+            # A failed command in the pipeline is returned in place of its reply
+            if isinstance(data, Exception):
+                raise data
+            for field, raw in data.items():
+                if not self.match_field(field):
+                    continue
+                if not self.path:
+                    values = [raw.decode("utf-8")]
+                elif self.raw and self.raw not in raw and JSON_ESCAPE not in raw:
+                    continue
+                else:
+                    if field not in decoded:
+                        decoded[field] = json_loads(raw)
+                    values = self.resolve(decoded[field])
+                for value in values:
+                    if self.accept(value):
+                        result = value
+        except Exception:
+            pass
+        if result is None or not self.project:
+            return result
+        projection = dict()
+        for name in self.project:
+            value = data.get(name.encode("utf-8"))
+            projection[name] = value.decode("utf-8", "replace") if value is not None else None
+        return projection
+
+
+MASK_URL_QUERY = Query("mask_url", field="*settings*", path="*custom_domain*")
+
+
+class Checkpoint(object):
+    """ SCAN cursors and part files of a search, saved every interval seconds
+        so that an interrupted search can be resumed
+    """
+
+    def __init__(self, path, interval=DEFAULT_CHECKPOINT_INTERVAL, state=None):
+        self.path = path
+        self.interval = interval
+        self.state = state or {"tasks": {}}
+        self.lock = threading.Lock()
+        self.saved = time.time()
+
+    @classmethod
+    def load(cls, path, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        with open(path, "r") as f:
+            return cls(path, interval, json.load(f))
+
+    def update(self, task, **state):
+        """ Record the progress of a task, saved when the interval is over """
+        with self.lock:
+            self.state["tasks"].setdefault(task, {}).update(state)
+            if time.time() - self.saved >= self.interval:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.saved = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ChangeLog(object):
+    """ Keys changed since the last search. The watcher appends the keys of
+        keyspace notifications, an incremental search takes and re-checks them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, keys):
+        with self.lock:
+            with open(self.path, "ab") as f:
+                for key in keys:
+                    f.write(key + b"\n")
+
+    def take(self, mark=None):
+        """ Move the logged keys aside, the watcher goes on with a new log.
+            mark publishes a marker on every shard, see SearchRedisAdmin.mark().
+            The log is taken once the watcher logged the markers, so the changes
+            notified before are in it, and it is read once the markers published
+            after the rename are in the new log, so no append goes to it anymore.
+            returns: paths of the taken logs, including the ones of a failed search
+        """
+        if mark:
+            self.wait(mark())
+        if os.path.exists(self.path):
+            os.rename(self.path, "{0}.{1:.6f}.taken".format(self.path, time.time()))
+            if mark:
+                self.wait(mark())
+            else:
+                # Let an append which opened the log before the rename finish
+                time.sleep(WATCH_FLUSH_INTERVAL)
+        return sorted(glob.glob(glob.escape(self.path) + ".*.taken"))
+
+    def wait(self, markers, timeout=CHANGE_MARKER_TIMEOUT):
+        """ Block until the watcher logged the markers
+            returns: False if some are still missing after timeout seconds
+        """
+        missing = set(markers)
+        offset = 0
+        deadline = time.time() + timeout
+        while missing:
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        missing.discard(line.rstrip(b"\n"))
+            if not missing:
+                break
+            if time.time() > deadline:
+                print("The watcher did not log {0} of the change log markers in {1}s".format(
+                    len(missing), timeout))
+                return False
+            time.sleep(CHANGE_MARKER_POLL_INTERVAL)
+        return True
+
+    @staticmethod
+    def read(taken):
+        keys = set()
+        for path in taken:
+            with open(path, "rb") as f:
+                keys.update(line.rstrip(b"\n") for line in f
+                            if line.strip() and CHANGE_MARKER not in line)
+        return keys
+
+    @staticmethod
+    def done(taken):
+        for path in taken:
+            os.remove(path)
+
+    def clear(self, mark=None):
+        """ Drop the logged keys, a full search checks all of them anyway """
+        if os.path.exists(self.path):
+            self.done(self.take(mark))
 
 
 class SearchRedisAdmin(object):
     """ Search the host with filter domain"""
 
-    def __init__(self, host, pattern):
-        self.r = redis.Redis(host="{}".format(host), port=6379, db=0)
+    def __init__(self, host, pattern, batch_size=DEFAULT_BATCH_SIZE, settings_only=False,
+                 workers=1, partitions=None, port=DEFAULT_PORT, db=0, cluster=False,
+                 replicas=False, queries=None, latency=None, max_ops=None, max_server_ops=None,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        self.stopping = threading.Event()
+        self.workers = max(1, workers)
         self.pattern = pattern
+        self.batch_size = max(1, batch_size)
+        self.queries = list(queries or [MASK_URL_QUERY])
+        self.settings_only = settings_only
+        if settings_only:
+            fields = set(query.field_glob for query in self.queries)
+            if len(fields) > 1 or any(query.project for query in self.queries):
+                raise ValueError("Fetching only the queried fields needs queries on one field "
+                                 "pattern without projection")
+            self.field_match = fields.pop()
+        self.partitions = partitions or self.workers
+        self.db = db
+        endpoints = [host] if isinstance(host, str) else list(host)
+        self.shards = self.find_shards([parse_endpoint(e, port) for e in endpoints],
+                                       cluster, replicas)
+        self.throttles = dict((name, Throttle(client, latency, max_ops, max_server_ops))
+                              for name, client in self.shards)
+        self.progress_interval = progress_interval
+
+    def connect(self, host, port, readonly=False):
+        """ A client with a pool of one connection per worker """
+        kwargs = dict()
+        if readonly:
+            kwargs["connection_class"] = ReadOnlyConnection
+        pool = redis.ConnectionPool(host="{}".format(host), port=port, db=self.db,
+                                    max_connections=self.workers, **kwargs)
+        return redis.Redis(connection_pool=pool)
+
+    def find_shards(self, endpoints, cluster, replicas):
+        """ Resolve the endpoints to the nodes to scan, one per shard
+            returns: list of ("host:port", client)
+        """
+        if cluster:
+            nodes = discover_cluster_shards(self.connect(*endpoints[0]), replicas)
+        else:
+            nodes = []
+            for host, port in endpoints:
+                # Several endpoints of the same shard are scanned once
+                if len(endpoints) > 1 or replicas:
+                    host, port = find_primary(self.connect(host, port)) or (host, port)
+                if (host, port) not in nodes:
+                    nodes.append((host, port))
+            if replicas:
+                nodes = [find_replica(self.connect(*node)) or node for node in nodes]
+        shards = []
+        for host, port in nodes:
+            name = "{0}:{1}".format(host, port)
+            shards.append((name, self.connect(host, port, readonly=cluster and replicas)))
+        return shards
+
+    def scan_batches(self, client, match=None, skip=None, cursor=0, count=None, throttle=None):
+        """ Collect the keys of SCAN pages into batches of about batch_size keys.
+            A batch ends with a page so the search can be resumed from its cursor.
+            count is the SCAN COUNT, batch_size by default, as shrunk by throttle.
+            yields: (keys, cursor of the next page, 0 after the last page)
+        """
+        if match is None:
+            match = "*{0}*".format(self.pattern)
+        count = count or self.batch_size
+        batch = []
+        while True:
+            if throttle:
+                throttle.wait(1, self.stopping)
+            start = time.time()
+            cursor, keys = client.scan(cursor, match=match,
+                                       count=throttle.size(count) if throttle else count)
+            if throttle:
+                throttle.observe(time.time() - start)
+            cursor = int(cursor)
+            for key in keys:
+                if skip and fnmatch.fnmatchcase(key[1:], skip.encode("utf-8")):
+                    continue
+                batch.append(key)
+            if cursor == 0 or len(batch) >= self.batch_size:
+                yield batch, cursor
+                batch = []
+            if cursor == 0:
+                return
+
+    def fetch_batch(self, client, keys):
+        """ Fetch the hashes of the keys in one round trip through a
+            non-transactional pipeline
+            returns: list of (key, {field: value})
+        """
+        pipe = client.pipeline(transaction=False)
+        if not self.settings_only:
+            for key in keys:
+                pipe.hgetall(key)
+            return list(zip(keys, pipe.execute(raise_on_error=False)))
+
+        # Only pull the queried fields. HSCAN returns (cursor, data), keys with
+        # more queried fields than one HSCAN page are finished one by one
+        for key in keys:
+            pipe.hscan(key, 0, match=self.field_match, count=self.batch_size)
+        result = []
+        for key, reply in zip(keys, pipe.execute(raise_on_error=False)):
+            if isinstance(reply, Exception):
+                result.append((key, reply))
+                continue
+            cursor, data = reply
+            while cursor:
+                cursor, more = client.hscan(key, cursor, match=self.field_match,
+                                            count=self.batch_size)
+                data.update(more)
+            result.append((key, data))
+        return result
+
+    def fetch_throttled(self, client, keys, throttle):
+        """ Fetch the hashes of a batch of keys in pipelines of the depth throttle allows
+            returns: list of (key, {field: value})
+        """
+        result = []
+        while keys:
+            depth = throttle.size(self.batch_size)
+            throttle.wait(depth, self.stopping)
+            start = time.time()
+            result.extend(self.fetch_batch(client, keys[:depth]))
+            throttle.observe(time.time() - start)
+            keys = keys[depth:]
+        return result
 
-    def search(self):
+    def fetch(self, client, batches, throttle=None):
+        """ Fetch the hashes of every batch of keys
+            yields: (key, {field: value})
+        """
+        for keys in batches:
+            items = self.fetch_throttled(client, keys, throttle) if throttle else \
+                self.fetch_batch(client, keys)
+            for item in items:
+                yield item
+
+    def matches(self, items):
+        """ Evaluate every query on the fetched hashes, the JSON values of a hash
+            are decoded once for all queries
+            yields: (query index, key, value)
+        """
+        for key, data in items:
+            decoded = dict()
+            for index, query in enumerate(self.queries):
+                value = query.evaluate(data, decoded)
+                if value is not None:
+                    yield index, key.decode("utf-8"), value
+
+    def outputs(self, output):
+        """ The output of every query, the first query writes to output by default
+            and the others to <name>_output next to it
+        """
+        paths = []
+        for index, query in enumerate(self.queries):
+            default = output if index == 0 else os.path.join(
+                os.path.dirname(os.path.abspath(output)), "{0}_output".format(query.name))
+            paths.append(query.output or default)
+        return paths
+
+    def search_partition(self, shard, cursors, writers, task=None, checkpoint=None, count=None,
+                         progress=None):
+        """ Scan one partition of a shard and write the matches of every query
+            into its writer, from the position of task in checkpoint when there is one
+            returns: statistics of the partition
+        """
+        name, client = shard
+        throttle = self.throttles[name]
+        saved = checkpoint.state["tasks"][task] if checkpoint else dict()
+        stats = {"shard": name, "partition": cursors[0][0], "keys": saved.get("keys", 0)}
+        progress_task = "{0} {1}".format(name, cursors[0][0])
+        start = time.time()
+
+        cursor_index = saved.get("cursor_index", 0)
+        cursor = saved.get("cursor", 0)
+        for index in range(cursor_index, len(cursors)):
+            match, skip = cursors[index]
+            if progress:
+                progress.update(progress_task, (index + scan_fraction(cursor)) / len(cursors),
+                                stats["keys"])
+            for keys, cursor in self.scan_batches(client, match, skip, cursor, count, throttle):
+                if self.stopping.is_set():
+                    return None
+                stats["keys"] += len(keys)
+                for query, key, value in self.matches(self.fetch(client, [keys], throttle)):
+                    writers[query].write(key, value)
+                if progress:
+                    done = 1.0 if cursor == 0 else scan_fraction(cursor)
+                    progress.update(progress_task, (index + done) / len(cursors), stats["keys"])
+                if checkpoint:
+                    # A finished cursor continues with the next one
+                    next_index = index + 1 if cursor == 0 else index
+                    checkpoint.update(task, cursor_index=next_index, cursor=cursor,
+                                      offsets=[writer.position() for writer in writers],
+                                      counts=[writer.count for writer in writers],
+                                      keys=stats["keys"])
+        stats["hits"] = sum(writer.count for writer in writers)
+        stats["seconds"] = time.time() - start
+        return stats
+
+    def part_writers(self, outputs, fmt, flush_every, progress=None):
+        """ The part writers of one task for every query, continued from the
+            checkpointed progress of the task when its parts are intact
+        """
+        if progress and all(os.path.exists(part) and os.path.getsize(part) >= offset
+                            for part, offset in zip(progress["parts"], progress["offsets"])):
+            return [ResultWriter(path, fmt, flush_every, header=False, tmp_path=part,
+                                 offset=offset, count=count, column=query.name)
+                    for path, query, part, offset, count in zip(
+                        outputs, self.queries, progress["parts"], progress["offsets"],
+                        progress["counts"])]
+        return [ResultWriter(path, fmt, flush_every, header=False, column=query.name)
+                for path, query in zip(outputs, self.queries)]
+
+    def open_checkpoint(self, path, interval, resume, outputs, fmt, flush_every, partitions):
+        """ Load the checkpoint of an interrupted search, or start a new one
+            returns: Checkpoint and the part writers of every task
+        """
+        tasks = ["{0} {1}".format(name, cursors[0][0]) for name, _ in self.shards
+                 for cursors in partitions]
+        queries = [query.name for query in self.queries]
+        if resume:
+            if not os.path.exists(path):
+                raise ValueError("No checkpoint {0} to resume".format(path))
+            checkpoint = Checkpoint.load(path, interval)
+            if checkpoint.state.get("tasks_order") != tasks or \
+                    checkpoint.state.get("format") != fmt or checkpoint.state.get("queries") != queries:
+                raise ValueError("Checkpoint {0} is of a search with other endpoints, pattern, "
+                                 "partitions, queries or format".format(path))
+        else:
+            checkpoint = Checkpoint(path, interval, {"tasks_order": tasks, "format": fmt,
+                                                     "queries": queries, "started": time.time(),
+                                                     "tasks": {}})
+
+        parts = []
+        for task in tasks:
+            progress = checkpoint.state["tasks"].get(task)
+            writers = self.part_writers(outputs, fmt, flush_every, progress)
+            if not progress or progress["parts"] != [writer.tmp_path for writer in writers]:
+                # The parts are lost, the task starts over
+                checkpoint.state["tasks"][task] = {
+                    "parts": [writer.tmp_path for writer in writers],
+                    "offsets": [0] * len(writers), "counts": [0] * len(writers)}
+            parts.append(writers)
+        checkpoint.save()
+        return checkpoint, parts
+
+    def search(self, output=DEFAULT_OUTPUT, fmt="text", flush_every=DEFAULT_FLUSH_EVERY,
+               checkpoint_path=None, checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+               resume=False, changes=None, index=None):
         """ Scan all the key in redis data. If the key contains custom_domain and not empty,
-            write to the file with format
+            write to the output with format
             key: mask url
+            or as JSON Lines or CSV rows of key and mask url.
+            Every other query writes its matches to its own output in the same pass.
+            With checkpoint_path the progress is saved every checkpoint_interval
+            seconds and resume continues an interrupted search.
+            index is rebuilt from the output of the first query.
         """
-        result = dict()
-        for key in self.r.scan_iter("*{0}*".format(self.pattern)):
+        partitions = partition_patterns(self.pattern, self.partitions)
+        tasks = [(shard, cursors) for shard in self.shards for cursors in partitions]
+        outputs = self.outputs(output)
+        if changes and not resume:
+            changes.clear(self.mark)
+        checkpoint = None
+        progress = Progress(["{0} {1}".format(shard[0], cursors[0][0]) for shard, cursors in tasks],
+                            self.progress_interval, self.throttles)
+        with ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(path, fmt, flush_every, column=query.name))
+                       for path, query in zip(outputs, self.queries)]
+            stack.enter_context(progress)
+            if len(tasks) == 1 and not checkpoint_path:
+                self.report(self.search_partition(tasks[0][0], tasks[0][1], writers,
+                                                  progress=progress))
+                tasks = []
+
+            # Every task streams into its own parts, the parts are joined in task
+            # order so the outputs do not depend on timing
+            task_ids = [None] * len(tasks)
+            parts = []
+            if tasks and checkpoint_path:
+                checkpoint, parts = self.open_checkpoint(checkpoint_path, checkpoint_interval, resume,
+                                                         outputs, fmt, flush_every, partitions)
+                task_ids = checkpoint.state["tasks_order"]
+            elif tasks:
+                parts = [self.part_writers(outputs, fmt, flush_every) for _ in tasks]
             try:
-                data = self.r.hgetall(key)
-                for r_key, values in data.items():
-                    if re.search("settings", r_key.decode("utf-8")):
-                        json_dump = json.loads(values.decode("utf-8"))
-                        for s_key, value in json_dump.items():
-                            if re.search("custom_domain", s_key):
-                                if value:
-                                    result[key.decode("utf-8")] = value
-            except Exception:
-                pass
-
-        file_output = os.path.join(os.getcwd(), "mask_url_output")
-        if os.path.exists(file_output):
-            os.remove(file_output)
-        with open(file_output, 'w') as f:
-            for k, v in result.items():
-                f.write("{0}: {1}\n".format(k, v))
+                # Every shard is scanned by its own workers, as many as its pool has
+                # connections, and the shards are scanned at the same time
+                with ExitStack() as executors:
+                    shard_executors = dict(
+                        (name, executors.enter_context(ThreadPoolExecutor(max_workers=self.workers)))
+                        for name, _ in self.shards)
+                    # Every cursor walks the whole keyspace but only matches the keys of
+                    # its partition, a bigger COUNT still fills a batch per page
+                    count = self.batch_size * len(partitions)
+                    futures = [None] * len(tasks)
+                    # The tasks are submitted partition by partition across the shards
+                    order = sorted(range(len(tasks)), key=lambda i: (i % len(partitions), i))
+                    for i in order:
+                        (shard, cursors), task_parts, task = tasks[i], parts[i], task_ids[i]
+                        futures[i] = shard_executors[shard[0]].submit(
+                            self.search_partition, shard, cursors, task_parts, task, checkpoint,
+                            count, progress)
+                    try:
+                        for future in futures:
+                            self.report(future.result())
+                    except BaseException:
+                        # Stop the other workers at their next batch
+                        self.stopping.set()
+                        raise
+                for task_parts in parts:
+                    for writer, part in zip(writers, task_parts):
+                        part.f.close()
+                        writer.append(part.tmp_path)
+            except BaseException:
+                if checkpoint:
+                    # Keep the parts for --resume
+                    checkpoint.save()
+                    for task_parts in parts:
+                        for part in task_parts:
+                            part.f.close()
+                    parts = []
+                raise
+            finally:
+                for task_parts in parts:
+                    for part in task_parts:
+                        part.abort()
+        if checkpoint:
+            checkpoint.remove()
+        if index:
+            index.replace(read_results(outputs[0], fmt, self.queries[0].name),
+                          changes.path if changes else None)
+
+    def search_incremental(self, changes, output=DEFAULT_OUTPUT, fmt="text",
+                           flush_every=DEFAULT_FLUSH_EVERY, index=None):
+        """ Re-check only the keys in the change log on top of the previous outputs,
+            index is updated with the changes of the first query
+        """
+        outputs = self.outputs(output)
+        for path in outputs:
+            if not os.path.exists(path):
+                raise ValueError("No previous output {0}, run a full search first".format(path))
+        taken = changes.take(self.mark)
+        keys = sorted(changes.read(taken))
+        batches = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+        found = [dict() for _ in self.queries]
+        # A key is on one shard only, the others reply nothing or MOVED
+        for name, client in self.shards:
+            for query, key, value in self.matches(self.fetch(client, batches, self.throttles[name])):
+                found[query].setdefault(key, value)
+
+        changed = set(key.decode("utf-8") for key in keys)
+        with ExitStack() as stack:
+            for path, query, query_found in zip(outputs, self.queries, found):
+                writer = stack.enter_context(ResultWriter(path, fmt, flush_every, column=query.name))
+                for key, value in read_results(path, fmt, query.name):
+                    if key not in changed:
+                        writer.write(key, value)
+                for key in sorted(query_found):
+                    writer.write(key, query_found[key])
+                print("{0}: {1} changed keys, {2} hits, {3} matches".format(
+                    query.name, len(keys), len(query_found), writer.count))
+        if index:
+            index.apply(changed, found[0], changes.path)
+        changes.done(taken)
+
+    def mark(self):
+        """ Publish a marker as a keyspace notification of every shard, the watcher
+            logs it after the keys changed on the shard before, see ChangeLog.take()
+            returns: the markers of the shards with a subscriber
+        """
+        token = "{0:.6f}".format(time.time()).encode("utf-8")
+        markers = []
+        for name, client in self.shards:
+            # The key contains the pattern so the channel matches the one of the watcher
+            marker = self.pattern.encode("utf-8") + CHANGE_MARKER + token + b" " + name.encode("utf-8")
+            if client.publish(b"__keyspace@" + str(self.db).encode("utf-8") + b"__:" + marker, b"marker"):
+                markers.append(marker)
+        return markers
+
+    def enable_notifications(self, client):
+        """ Add the keyspace notification classes the watcher needs to the
+            notify-keyspace-events of a node
+        """
+        current = client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        if "A" in current:
+            current = current.replace("A", "g$lshzxetd")
+        flags = "".join(sorted(set(current) | set(NOTIFY_FLAGS)))
+        client.config_set("notify-keyspace-events", flags)
+
+    def watch(self, changes, enable=False):
+        """ Log the keys matching the pattern changed on any shard until interrupted.
+            notify-keyspace-events must contain Kghxe (or KA), enable sets it.
+        """
+        channel = "__keyspace@{0}__:*{1}*".format(self.db, self.pattern)
+        prefix = len(channel) - len("*{0}*".format(self.pattern))
+        pending = set()
+        lock = threading.Lock()
+        marked = threading.Event()
+
+        def listen(name, client):
+            own_marker = b" " + name.encode("utf-8")
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(channel)
+            while not self.stopping.is_set():
+                message = pubsub.get_message(timeout=WATCH_FLUSH_INTERVAL)
+                if message and message["type"] == "pmessage":
+                    key = message["channel"][prefix:]
+                    # A cluster broadcasts the markers of the other shards too
+                    if CHANGE_MARKER in key and not key.endswith(own_marker):
+                        continue
+                    with lock:
+                        pending.add(key)
+                    if CHANGE_MARKER in key:
+                        marked.set()
+            pubsub.close()
+
+        threads = []
+        for name, client in self.shards:
+            if enable:
+                self.enable_notifications(client)
+            thread = threading.Thread(target=listen, args=(name, client))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        print("Watching {0} on {1} shards".format(channel, len(threads)))
+        try:
+            while all(thread.is_alive() for thread in threads):
+                # A marker is logged at once, an incremental search waits for it
+                marked.wait(WATCH_FLUSH_INTERVAL)
+                marked.clear()
+                with lock:
+                    keys = sorted(pending)
+                    pending.clear()
+                if keys:
+                    changes.append(keys)
+        finally:
+            self.stopping.set()
+            with lock:
+                if pending:
+                    changes.append(sorted(pending))
+
+    @staticmethod
+    def report(stats):
+        """ Print the throughput of one partition """
+        rate = stats["keys"] / stats["seconds"] if stats["seconds"] else 0
+        print("{0} {1}: {2} keys, {3} hits in {4:.2f}s ({5:.0f} keys/s)".format(
+            stats["shard"], stats["partition"], stats["keys"], stats["hits"], stats["seconds"], rate))
+
+    @staticmethod
+    def mask_url(data):
+        """ The non-empty custom_domain in the settings of a hash, None if there is none.
+            Settings without custom_domain in their raw bytes are not decoded.
+        """
+        return MASK_URL_QUERY.evaluate(data)
 
 
 def parse_argument(args):
     parser = argparse.ArgumentParser(description="Find all tenants which use Mask URL",
                                      epilog="Input endpoint and search pattern",
                                      usage="searchMaskUrl -e example.com -p example.com")
-    parser.add_argument("-e", "--endpoint", dest="host", nargs=1, help="Endpoint of the redis admin")
+    parser.add_argument("-e", "--endpoint", dest="host", nargs="+",
+                        help="Endpoints host[:port] of the redis admin, one per shard")
     parser.add_argument("-p", "--pattern", nargs=1, help="Pattern to filter the tenant")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of keys fetched per pipeline round trip (default: %(default)s)")
+    parser.add_argument("--settings-only", dest="settings_only", action="store_true",
+                        help="Only fetch the fields the queries look at (*settings* by default) with HSCAN "
+                             "instead of HGETALL")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of partitions scanned at the same time (default: %(default)s)")
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="Number of key-prefix partitions (default: same as --workers)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port of the endpoints without one (default: %(default)s)")
+    parser.add_argument("--db", type=int, default=0, help="Database number (default: %(default)s)")
+    parser.add_argument("--cluster", action="store_true",
+                        help="Discover the primaries of a Redis Cluster from the first endpoint")
+    parser.add_argument("--replicas", action="store_true",
+                        help="Scan a replica of every shard instead of the primary when one is online")
+    parser.add_argument("-o", "--output", default=os.path.join(os.getcwd(), DEFAULT_OUTPUT),
+                        help="Output file, replaced when the search is done (default: %(default)s)")
+    parser.add_argument("-f", "--format", dest="fmt", choices=OUTPUT_FORMATS, default="text",
+                        help="Output format (default: %(default)s)")
+    parser.add_argument("--flush-every", dest="flush_every", type=int, default=DEFAULT_FLUSH_EVERY,
+                        help="Number of matches written between flushes (default: %(default)s)")
+
+    parser.add_argument("-q", "--queries", default=None,
+                        help="JSON file of the queries answered in one pass instead of the mask URL")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file of the search (default: <output>.checkpoint)")
+    parser.add_argument("--checkpoint-interval", dest="checkpoint_interval", type=int,
+                        default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help="Seconds between checkpoints, 0 disables them (default: %(default)s)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted search from its checkpoint")
+    parser.add_argument("--changes", default=None,
+                        help="Log of the keys changed since the last search (default: <output>.changes)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Log the keys changed on the shards to --changes until interrupted")
+    parser.add_argument("--enable-notifications", dest="enable_notifications", action="store_true",
+                        help="Let --watch add Kghxe to notify-keyspace-events of the shards")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-check the keys in --changes on top of the previous output")
+    parser.add_argument("--latency-budget", dest="latency_budget", type=float, default=None,
+                        help="Milliseconds a SCAN or pipeline round trip may take, the SCAN COUNT and "
+                             "pipeline depth shrink below their full size to stay under it")
+    parser.add_argument("--max-ops-per-sec", dest="max_ops", type=float, default=None,
+                        help="Most commands per second sent to each shard")
+    parser.add_argument("--max-server-ops", dest="max_server_ops", type=int, default=None,
+                        help="Pause while a shard runs more commands per second than this, ours included")
+    parser.add_argument("--progress-interval", dest="progress_interval", type=float,
+                        default=DEFAULT_PROGRESS_INTERVAL,
+                        help="Seconds between progress reports, 0 disables them (default: %(default)s)")
+    parser.add_argument("--index", default=None,
+                        help="Index of the tenants by custom domain, rebuilt by a full search and "
+                             "updated by --incremental, see maskUrlIndex.py")
 
     return parser.parse_args(args=args)
 
 
+def run(options):
+    """ Run the search, watcher or incremental search of the parsed options """
+    s = SearchRedisAdmin(options.host, options.pattern[0], batch_size=options.batch_size,
+                         settings_only=options.settings_only, workers=options.workers,
+                         partitions=options.partitions, port=options.port, db=options.db,
+                         cluster=options.cluster, replicas=options.replicas,
+                         queries=Query.load(options.queries) if options.queries else None,
+                         latency=options.latency_budget / 1000.0 if options.latency_budget else None,
+                         max_ops=options.max_ops, max_server_ops=options.max_server_ops,
+                         progress_interval=options.progress_interval)
+    changes = ChangeLog(options.changes or options.output + ".changes")
+    index = MaskUrlIndex(options.index) if options.index else None
+    if options.watch:
+        try:
+            s.watch(changes, options.enable_notifications)
+        except KeyboardInterrupt:
+            print("Exiting")
+    elif options.incremental:
+        s.search_incremental(changes, options.output, options.fmt, options.flush_every, index)
+    else:
+        checkpoint = None
+        if options.checkpoint_interval > 0:
+            checkpoint = options.checkpoint or options.output + ".checkpoint"
+        s.search(options.output, options.fmt, options.flush_every, checkpoint,
+                 options.checkpoint_interval, options.resume, changes, index)
+
+
 def main():
     if len(sys.argv) <= 1:
         print("Please input")
         sys.exit(1)
-    options = parse_argument(sys.argv[1:])
-    host = options.host
-    pattern = options.pattern
-    s = SearchRedisAdmin(host[0], pattern[0])
-    s.search()
+    run(parse_argument(sys.argv[1:]))
 
 
 if __name__ == '__main__':